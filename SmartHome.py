@@ -4,6 +4,7 @@ import time
 from src.DBManager import DBManager
 from src.DeviceManager import DeviceManager
 from src.CommunicationManager import CommunicationManager
+from src.TransitionManager import TransitionManager
 from src.WebServerManager import WebServerManager
 from src.MQTTManager import MQTTManager
 from src.Logger import setup_logger
@@ -23,10 +24,13 @@ class SmartHome:
         self.communication_manager = CommunicationManager(
             self.device_manager, self.shutdown_flag
         )
+        self.transition_manager = TransitionManager(
+            self.communication_manager, self.shutdown_flag
+        )
         self.webserver_manager = WebServerManager(
-            self.db_manager, self.communication_manager, self.shutdown_flag
+            self.db_manager, self.communication_manager, self.transition_manager, self.shutdown_flag
         )
-        # self.mqtt_manager = MQTTManager(self.db_manager, self.communication_manager, self.shutdown_flag)
+        # self.mqtt_manager = MQTTManager(self.db_manager, self.communication_manager, self.transition_manager, self.shutdown_flag)
         self.db_manager.set_http_password("test")
 
     def stop(self):
@@ -59,8 +63,12 @@ class SmartHome:
         time.sleep(1)  # Wait for server
         self.start_thread_and_catch_exceptions(self.communication_manager.listen)
         self.start_thread_and_catch_exceptions(
-            self.communication_manager.update_all_devices
+            self.communication_manager.send_pending_commands
         )
+        self.start_thread_and_catch_exceptions(self.transition_manager.run)
+        self.start_thread_and_catch_exceptions(self.communication_manager.track_liveness)
+        self.start_thread_and_catch_exceptions(self.communication_manager.pair_devices)
+        self.start_thread_and_catch_exceptions(self.communication_manager.run_schedules)
         self.check_for_restart()
 
 
@@ -2,7 +2,7 @@
 #include "RFconfig.h"
 #include "CONFIG_HARDWARE.h"
 
-#define FIRMWARE_VERSION                                0x02
+#define FIRMWARE_VERSION                                0x03
 #define DEVICE_TYPE                                     DEVICE_LED_CONTROLLER_3CH
 #define NUM_SEND_RETRIES                                1                           // Must be >= 1
 
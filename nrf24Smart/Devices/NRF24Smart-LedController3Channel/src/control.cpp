@@ -271,9 +271,21 @@ void _setStatus(const uint8_t *data, uint8_t length)
     }
 }
 
+// A SET message can contain several SetMessages one after the other
 void setStatus(const uint8_t *data, uint8_t length)
 {
-    _setStatus(data, length);
+    while (data != nullptr && length >= 4)
+    {
+        uint8_t size = 3 + data[2];
+        if (size > length)
+        {
+            Serial.println(F("ERROR: Incompatible SetMessage size!"));
+            break;
+        }
+        _setStatus(data, size);
+        data += size;
+        length -= size;
+    }
     setOutput();
 }
 
@@ -180,6 +180,14 @@ void connectToServer()
                         Serial.println(F("ServerPacket not valid!"));
                         break;
                     }
+                    // Other new devices may be waiting for an answer at the same time, skip answers
+                    // that name another device. Answers without a UUID are from an older server.
+                    const uint8_t deviceUUID[4] = DEVICE_UUID;
+                    if (pck.getSize() >= 5 && memcmp(pck.getDATA() + 1, deviceUUID, 4) != 0)
+                    {
+                        Serial.println(F("New ID for another device!"));
+                        continue;
+                    }
                     uint8_t newID = pck.getDATA()[0];
                     Serial.print("New ID: ");
                     Serial.println(newID);
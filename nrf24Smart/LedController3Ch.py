@@ -18,7 +18,23 @@ class LedController3Ch(DeviceStatus):
         "cct_mired",  # virtual
         "brightness_percent",  # virtual
     ]
-    supported_versions = [1,2]
+    parameter_targets = {
+        "cct": "rgb",
+        "cct_mired": "rgb",
+        "brightness_percent": "brightness",
+    }
+    parameter_components = {"rgb": ["ch_1", "ch_2", "ch_3"]}
+    change_parameters = {
+        "power": [CHANGE_TYPES.TOGGLE],
+        "brightness": [CHANGE_TYPES.INCREASE, CHANGE_TYPES.DECREASE],
+        "ch_1": [CHANGE_TYPES.INCREASE, CHANGE_TYPES.DECREASE],
+        "ch_2": [CHANGE_TYPES.INCREASE, CHANGE_TYPES.DECREASE],
+        "ch_3": [CHANGE_TYPES.INCREASE, CHANGE_TYPES.DECREASE],
+    }
+    scene_parameters = ["power", "brightness", "rgb"]
+    streamable_parameters = ["brightness", "brightness_percent", "ch_1", "ch_2", "ch_3", "rgb", "cct", "cct_mired"]
+    supported_versions = [1,2,3]
+    multi_set_versions = [3]
     min_cct = 2500
     max_cct = 6500
     mqtt_discovery_paramters = [
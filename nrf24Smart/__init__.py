@@ -1,4 +1,4 @@
-from .message import DeviceMessage, HostMessage, RemoteMessage, SetMessage, CHANGE_TYPES, MSG_TYPES
+from .message import DeviceMessage, HostMessage, RemoteMessage, SetMessage, MultiSetMessage, CHANGE_TYPES, MSG_TYPES
 from .devices import DeviceStatus
 from .LedController3Ch import LedController3Ch
 from .RotRemote import RotRemote
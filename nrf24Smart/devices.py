@@ -6,7 +6,21 @@ from nrf24Smart import SetMessage, CHANGE_TYPES
 
 class DeviceStatus:
     settable_parameters = []
+    # Virtual parameters that are sent to the device as another parameter
+    parameter_targets = {}
+    # Parameters that set several values on the device at once, with the parameters of the single values
+    parameter_components = {}
+    # Parameters that can be streamed without waiting for an ack for every value
+    streamable_parameters = []
+    # Parameters the firmware changes relative to its current value, with the CHANGE_TYPES it supports for them
+    change_parameters = {}
+    # Parameters captured in a scene, together they restore what the device shows
+    scene_parameters = []
+    # Configuration parameters, their SET messages are sent with background priority
+    background_parameters = ["status_interval", "target", "output_power_limit"]
     supported_versions = []
+    # Firmware versions that accept several SetMessages in one SET message
+    multi_set_versions = []
     mqtt_discovery_paramters = []
 
     def __init__(self, data: list[int]):
@@ -23,6 +37,71 @@ class DeviceStatus:
     def create_set_message(cls, param: str, new_val: str) -> Optional[SetMessage]:
         raise NotImplementedError()
 
+    @classmethod
+    def create_change_message(cls, param: str, change_type: CHANGE_TYPES, step: int = 1) -> Optional[SetMessage]:
+        """
+        Creates a SetMessage that toggles, increases or decreases param on the device by step.
+        Returns None if the firmware does not support the change_type for param.
+        """
+        if change_type not in cls.change_parameters.get(param, []) or not 0 <= step <= 255:
+            return None
+        return SetMessage(cls.settable_parameters.index(param), change_type, [step])
+
+    @classmethod
+    def supports_multi_set(cls, version: int) -> bool:
+        return version in cls.multi_set_versions
+
+    @classmethod
+    def matches_status(cls, param: str, new_val: str, status: Optional[dict]) -> bool:
+        """
+        Returns whether setting param to new_val leaves the reported status unchanged.
+        The SET message of the value is compared with the one of the reported value of its target,
+        so virtual parameters like cct are compared with what the device actually stores.
+        """
+        if not status:
+            return False
+        target = cls.get_target(param)
+        try:
+            reported = cls.get_param(target, status)
+        except NotImplementedError:
+            return False
+        if reported is None:
+            return False
+        new_msg = cls.create_set_message(param, str(new_val))
+        reported_msg = cls.create_set_message(target, str(reported))
+        return new_msg is not None and reported_msg is not None and new_msg.get_raw() == reported_msg.get_raw()
+
+    @classmethod
+    def merge_desired(cls, state: dict, param: str, new_val: str):
+        """
+        Adds setting param to new_val to a desired state of the device.
+        Entries that set the same values on the device are replaced, a single value that is part of a combined
+        parameter (ch_3 of rgb) is merged into it, so the entries of the state never overlap.
+        """
+        target = cls.get_target(param)
+        components = cls.parameter_components.get(target, [])
+        for key in [key for key in state if cls.get_target(key) == target or cls.get_target(key) in components]:
+            del state[key]
+        for combined, parts in cls.parameter_components.items():
+            if target not in parts or (record := cls.create_set_message(param, str(new_val))) is None:
+                continue
+            for key in [key for key in state if cls.get_target(key) == combined]:
+                if (combined_record := cls.create_set_message(key, str(state[key]))) is None:
+                    continue
+                values = combined_record.newValue
+                values[parts.index(target)] = record.newValue[0]
+                del state[key]
+                state[combined] = ",".join(str(value) for value in values)
+                return
+        state[param] = new_val
+
+    @classmethod
+    def get_target(cls, param: str) -> str:
+        """
+        Returns the parameter a SET of param is written to on the device
+        """
+        return cls.parameter_targets.get(param, param)
+
     @classmethod
     def parse_to_float(cls, value: list[int], round_value: int = 0) -> Optional[float]:
         try:
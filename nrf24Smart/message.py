@@ -1,4 +1,5 @@
 from enum import Enum
+from typing import Optional
 import logging
 
 class MSG_TYPES(Enum):
@@ -37,7 +38,66 @@ class SetMessage:
     def __str__(self) -> str:
         return (
             f"SetMessage varIndex:{self.varIndex} changeType:{self.changeType} valueSize:{self.valueSize} newValue:{self.newValue}")
-    
+
+
+class MultiSetMessage:
+    """
+    Several SetMessages packed into the data of one SET HostMessage.
+    The records are simply concatenated, every record starts with varIndex, changeType and valueSize.
+    Only supported by firmware versions listed in multi_set_versions of the device class.
+    """
+
+    # A ServerPacket carries 26 data bytes including the two checksum bytes
+    MAX_SIZE = 24
+
+    def __init__(self, set_messages: Optional[list[SetMessage]] = None):
+        # The given list is copied, the records that do not fit are left out
+        self.set_messages: list[SetMessage] = []
+        self.size = 0
+        for set_message in set_messages or []:
+            self.add(set_message)
+
+    def add(self, set_message: SetMessage) -> bool:
+        """
+        Adds a SetMessage if it still fits into the payload. Returns whether it was added.
+        """
+        size = len(set_message.get_raw())
+        if self.size + size > self.MAX_SIZE:
+            return False
+        self.set_messages.append(set_message)
+        self.size += size
+        return True
+
+    def get_raw(self) -> list[int]:
+        raw = []
+        for set_message in self.set_messages:
+            raw += set_message.get_raw()
+        return raw
+
+    @classmethod
+    def from_raw(cls, raw: list[int]) -> Optional["MultiSetMessage"]:
+        """
+        Parses the data of a SET HostMessage, returns None if it is not a valid sequence of SetMessages
+        """
+        msg = cls()
+        pos = 0
+        while pos < len(raw):
+            if len(raw) - pos < 4:
+                return None
+            index, change_type, value_size = raw[pos : pos + 3]
+            if value_size == 0 or pos + 3 + value_size > len(raw) or change_type > CHANGE_TYPES.DECREASE.value:
+                return None
+            if not msg.add(SetMessage(index, CHANGE_TYPES(change_type), raw[pos + 3 : pos + 3 + value_size])):
+                return None
+            pos += 3 + value_size
+        return msg if msg.set_messages else None
+
+    def __len__(self) -> int:
+        return len(self.set_messages)
+
+    def __str__(self) -> str:
+        return "MultiSetMessage [" + ", ".join(str(set_message) for set_message in self.set_messages) + "]"
+
 
 
 class DeviceMessage:
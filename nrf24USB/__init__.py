@@ -1,2 +1,3 @@
-from .device import NRF24Device
-from .packet_reader import PACKET_TYPES, SpecialBytes
\ No newline at end of file
+from .device import NRF24Device, TxRequest, TX_STATUS
+from .packet_reader import PACKET_TYPES, SpecialBytes
+from .tx_scheduler import TxScheduler, TX_PRIORITY
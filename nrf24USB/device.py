@@ -1,31 +1,79 @@
 import serial
 import time
 import threading
-from threading import Lock
 import queue
 import logging
+from enum import Enum
 from typing import Optional
 
 from .packet_reader import PacketReader, SpecialBytes, PACKET_TYPES
+from .tx_scheduler import TxScheduler, TX_PRIORITY
+
+
+class TX_STATUS(Enum):
+    QUEUED = 0
+    OK = 1  # Acknowledged by the receiver
+    ERROR = 2  # NRF24USB device reported that the receiver did not acknowledge
+    TIMEOUT = 3  # NRF24USB device did not respond in time
+    SENT = 4  # Written without requesting an acknowledgement
+
+
+class TxRequest:
+    """
+    A message waiting to be written by the write loop.
+    The caller can wait() for the result, status and response are set by the write loop.
+    """
+
+    __slots__ = (
+        "destination", "data", "require_ack", "priority", "status", "response", "done", "queued_time", "sent_time"
+    )
+
+    def __init__(
+        self, destination: int, data: list[int], require_ack: bool = True, priority: TX_PRIORITY = TX_PRIORITY.INTERACTIVE
+    ):
+        self.destination = destination
+        self.data = data
+        self.require_ack = require_ack
+        self.priority = priority
+        self.status = TX_STATUS.QUEUED
+        self.response: Optional[list[int]] = None
+        self.done = threading.Event()
+        self.queued_time = time.monotonic()
+        self.sent_time: Optional[float] = None
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        return self.done.wait(timeout)
+
+    def finish(self, status: TX_STATUS, response: Optional[list[int]] = None):
+        self.status = status
+        self.response = response
+        self.done.set()
 
 
 class NRF24Device:
     """
-    Class for NRF24Device that provides functionalities to start read loop, initialize the device,
-    send packets and messages, get messages, handle packets, read loop, stop read loop and destructor.
+    Class for NRF24Device that provides functionalities to start the read and write loops, initialize the device,
+    send packets and messages, get messages, handle packets, stop the loops and destructor.
+
+    Reading and writing run in separate threads that only exchange data through queues:
+    the read loop parses packets and dispatches them, responses to sent messages are handed to the
+    write loop through the response_queue. The write loop is the only writer of the serial port
+    once the device is initialized.
     """
 
     def __init__(
         self,
-        port: str,
+        port,
         channel: int,
         address: int,
         baudrate: int = 115200,
         use_clear_text: bool = False,
         blink_on_message: bool = True,
+        ack_timeout: float = 0.5,
     ):
         """
         Initializes the NRF24Device with provided port, channel, address, and baudrate.
+        port is either the name of a serial port or an already opened serial like object.
         Raises ValueError if the provided channel and address are out of allowed range.
         """
         if not 0 <= channel <= 125:
@@ -33,22 +81,34 @@ class NRF24Device:
         if not 0 <= address <= 255:
             raise ValueError("Address must be between 0 and 255.")
 
-        self.lock = Lock()
         self.connected: bool = False
+        self.connected_event = threading.Event()
         self.channel: int = channel
         self.address: int = address
         self.stop_event = threading.Event()  # Create an event to signal the thread to stop
         self.msg_queue = queue.Queue()  # Create a new queue
+        self.tx_queue = TxScheduler()  # Messages waiting to be written, by priority and airtime budget
+        self.response_queue = queue.Queue()  # Responses of the NRF24USB device to written messages
+        self.ack_timeout: float = ack_timeout
         self.error: bool = False
-        self.last_send_response: Optional[tuple] = None
         self.use_clear_text: bool = use_clear_text
         self.blink_on_message: bool = blink_on_message
+        self.read_thread = None
+        self.write_thread = None
+
+        # Statistics, kept as plain ints so that they cost nothing on the send path
+        self.msgs_sent = 0
+        self.ack_timeouts = 0
+        self.send_errors = 0
         try:
-            self.serial_port = serial.Serial(port, baudrate, timeout=None)
-            self.read_thread = None
+            if isinstance(port, str):
+                # The timeout lets the read loop block until data arrives while still checking the stop_event
+                self.serial_port = serial.Serial(port, baudrate, timeout=0.1)
+            else:
+                self.serial_port = port
             self.reader = PacketReader(self.serial_port, use_clear_text)
         except Exception as err:
-            logging.error(f"Could not connect to Serial Device {port}:{baudrate}")
+            logging.error("Could not connect to Serial Device %s:%s", port, baudrate)
             self.error = True
 
     def wait_for_init(self):
@@ -65,19 +125,25 @@ class NRF24Device:
 
     def start_read_loop(self):
         """
-        Starts the read loop in a new thread. If the read thread is already running, stops it before starting a new one.
+        Starts the read loop and the write loop in new threads. If the threads are already running, stops them before starting new ones.
         """
         if self.read_thread is not None and self.read_thread.is_alive():
             self.stop_read_loop()
+        self.stop_event.clear()
         self.read_thread = threading.Thread(target=self.read_loop, name="read_loop", daemon=True)
         self.read_thread.start()  # Start a new thread that runs the read_loop function
+        self.write_thread = threading.Thread(target=self.write_loop, name="write_loop", daemon=True)
+        self.write_thread.start()
 
     def initialize_device(self):
         """
         Initializes the NRF24USB device. Checks and sets the INIT message from the device. Raises ConnectionError if the device
         does not send correct INIT message or does not react correctly to Host INIT message.
         """
-        logging.info(f"Initialize NRF24USB Device with channel: {self.channel} address: {self.address} ...")
+        logging.info("Initialize NRF24USB Device with channel: %s address: %s ...", self.channel, self.address)
+
+        self.connected = False
+        self.connected_event.clear()
 
         # Try to Read the INIT message of the device
         (type, data) = self.reader.wait_for_packet(timeout=3.0)
@@ -86,7 +152,9 @@ class NRF24Device:
         self.firmware_version = data[0]  # uint8_t
         self.serial_nr = data[1:5]  # 32-bit serial number
         logging.info(
-            f"NRF24USBDevice reports Firmware version: {self.firmware_version} Serial: {':'.join(f'{x:02X}' for x in  self.serial_nr)}"
+            "NRF24USBDevice reports Firmware version: %s Serial: %s",
+            self.firmware_version,
+            ":".join(f"{x:02X}" for x in self.serial_nr),
         )
 
         # Send the Host INIT message containing the channel and address
@@ -99,118 +167,188 @@ class NRF24Device:
             raise ConnectionError("Device did not react correctly to Host INIT message")
         logging.info("Device initialized successfully!")
         self.connected = True
+        self.connected_event.set()
 
-    def _send_packet_bs(self, data: bytes, msg_type: PACKET_TYPES):
+    def _encode_packet_bs(self, data: bytes, msg_type: PACKET_TYPES) -> bytearray:
         """
-        Sends packet to the NRF24USB device usig byte stuffing. Takes bytes of data and message type as arguments.
+        Encodes a packet for the NRF24USB device usig byte stuffing. Takes bytes of data and message type as arguments.
         """
-        logging.debug(f"sending packet bs {msg_type} {list(data)}")
-        self.serial_port.write(bytes([msg_type.value]))  # Write the packet type
+        logging.debug("sending packet bs %s %s", msg_type, data)
+        packet = bytearray([msg_type.value])  # Write the packet type
         for byte_value in data:
             if SpecialBytes.is_special_byte(byte_value):
-                self.serial_port.write(bytes([SpecialBytes.ESCAPE_BYTE]))
-                self.serial_port.write(bytes([byte_value]))
-            else:
-                self.serial_port.write(bytes([byte_value]))
+                packet.append(SpecialBytes.ESCAPE_BYTE)
+            packet.append(byte_value)
+        return packet
 
-    def _send_packet_clear(self, data: bytes, msg_type: PACKET_TYPES):
+    def _encode_packet_clear(self, data: bytes, msg_type: PACKET_TYPES) -> bytearray:
         """
-        Sends packet to the NRF24USB device using clear text. Takes bytes of data and message type as arguments.
+        Encodes a packet for the NRF24USB device using clear text. Takes bytes of data and message type as arguments.
         """
-        logging.debug(f"sending packet clear {msg_type} {list(data)}")
-        self.serial_port.write(msg_type.name.encode('utf-8'))
+        logging.debug("sending packet clear %s %s", msg_type, data)
+        packet = bytearray(msg_type.name.encode('utf-8'))
         for byte_value in data:
-            self.serial_port.write(b":")
-            self.serial_port.write(str((byte_value)).encode('utf-8'))
+            packet += b":" + str(byte_value).encode('utf-8')
+        return packet
 
     def send_packet(self, data: bytes, msg_type: PACKET_TYPES):
         """
         Sends packet to the NRF24USB device. Takes bytes of data and message type as arguments.
-        """ 
-        self.serial_port.write(b";")
+        The packet is written with a single write call.
+        """
         if self.use_clear_text:
-            self._send_packet_clear(data, msg_type)
+            packet = self._encode_packet_clear(data, msg_type)
         else:
-            self._send_packet_bs(data, msg_type)
-        self.serial_port.write(b";")
+            packet = self._encode_packet_bs(data, msg_type)
+        self.serial_port.write(b";" + packet + b";")
 
+    def send_msg_async(
+        self, destination: int, data: list[int], require_ack=True, priority: TX_PRIORITY = TX_PRIORITY.INTERACTIVE
+    ) -> TxRequest:
+        """
+        Queues a message for the destination and returns immediately.
+        The returned TxRequest can be used to wait for the result, see wait_for_result.
+        Once the loops are stopped the request is finished with ERROR right away.
+        """
+        request = TxRequest(destination, data, require_ack, priority)
+        if self.stop_event.is_set():
+            request.finish(TX_STATUS.ERROR)
+            return request
+        self.tx_queue.put(request)
+        return request
 
-    def send_msg(self, destination: int, data: list[int], require_ack=True) -> Optional[list[int]]:
+    def wait_for_result(self, request: TxRequest) -> TxRequest:
+        """
+        Waits until the write loop finished the request. Gives up with ERROR once the loops are stopped,
+        so a sender does not hang on a request the write loop will never write.
+        """
+        while not request.wait(self.ack_timeout):
+            if self.stop_event.is_set():
+                request.finish(TX_STATUS.ERROR)
+        return request
+
+    def send_msg(
+        self, destination: int, data: list[int], require_ack=True, priority: TX_PRIORITY = TX_PRIORITY.INTERACTIVE
+    ) -> Optional[list[int]]:
         """
         Sends message to the destination. Takes destination, list of integers as data, and acknowledgement requirement as arguments.
+        Messages with a higher priority are written first, see TxScheduler.
         Returns received data on successful acknowledgement or None otherwise.
         """
 
         # Make sure nrf24USB is connected
         if not self.connected:
             logging.warning("Waiting with send_msg while nrfDevice is not connected")
-            while not self.connected:
-                time.sleep(1)
-
-        raw_msg_hex = [hex(i) for i in data]
-        with self.lock:
-            #print(f"send to id:{destination} {raw_msg_hex}")
-            self.send_packet(bytes([destination, require_ack]) + bytes(data), PACKET_TYPES.MSG)
-        if not require_ack:
+
+        request = self.wait_for_result(self.send_msg_async(destination, data, require_ack, priority))
+        if request.status is TX_STATUS.OK:
+            return request.response
+        if request.status is TX_STATUS.SENT:
             return []
+        return None
 
-        # Wait for Device to respond
-        start_time = time.time()
-        self.last_send_response = None
-        time.sleep(0.1)
-        while self.last_send_response is None:
-            #time.sleep(0.1)
-            if time.time() - start_time > 0.5:
-                logging.error(f"Timeout while waiting for response from NRF24USB device")
-                return None
+    def write_message(self, request: TxRequest):
+        """
+        Writes a single message and waits for the response of the NRF24USB device if an acknowledgement is required.
+        Only called from the write loop.
+        """
+        # Drop responses that arrived after an earlier request timed out
+        while not self.response_queue.empty():
+            self.response_queue.get_nowait()
+
+        #print(f"send to id:{destination} {raw_msg_hex}")
+        self.send_packet(bytes([request.destination, request.require_ack]) + bytes(request.data), PACKET_TYPES.MSG)
+        request.sent_time = time.monotonic()
+        self.msgs_sent += 1
 
-        #print("t: ", time.time() - start_time)
+        # Wait for Device to respond. It also responds to messages without acknowledgement
+        # as soon as they are on air, so the response can not be mistaken for the next one.
         try:
-            (recv_type, recv_data) = self.last_send_response  # type: ignore
-        except ValueError:
-            logging.error(f"Cant unpack last_send_response: {self.last_send_response}")
-            return None
+            (recv_type, recv_data) = self.response_queue.get(timeout=self.ack_timeout)
+        except queue.Empty:
+            logging.error("Timeout while waiting for response from NRF24USB device")
+            self.ack_timeouts += 1
+            request.finish(TX_STATUS.TIMEOUT)
+            return
 
-        if recv_type is PACKET_TYPES.OK:
-            return recv_data
-        elif recv_type is PACKET_TYPES.ERROR:
-            return None
+        if not request.require_ack:
+            request.finish(TX_STATUS.SENT, [])
+        elif recv_type is PACKET_TYPES.OK:
+            request.finish(TX_STATUS.OK, recv_data)
         else:
-            logging.error(f"Unknow recv_type: {recv_type}")
+            self.send_errors += 1
+            request.finish(TX_STATUS.ERROR)
+
+    def write_loop(self):
+        """
+        Writes the queued messages one after another until the stop event is set.
+        Writing pauses while the NRF24USB device is not initialized.
+        """
+        logging.info("NRF24USB Write Loop Started!")
+        while not self.stop_event.is_set():
+            if (request := self.tx_queue.get(timeout=0.5)) is None:
+                continue
+            while not self.connected_event.wait(timeout=0.5):
+                if self.stop_event.is_set():
+                    break
+            if not self.connected_event.is_set():
+                request.finish(TX_STATUS.ERROR)
+                break
+            try:
+                self.write_message(request)
+            except Exception as e:
+                logging.exception("An exception occured during writeLoop: %s", e)
+                request.finish(TX_STATUS.ERROR)
+
+        # Release everybody still waiting for a result
+        for request in self.tx_queue.drain():
+            request.finish(TX_STATUS.ERROR)
+        logging.info("NRF24USB Write Loop Stopped!")
 
     def get_message(self):
         """
         Retrieves and returns the message from the queue. Returns None if the queue is empty.
         """
+        if (msg := self.get_timed_message()) is None:
+            return None
+        return msg[0]
+
+    def get_timed_message(self, timeout: float = 0) -> Optional[tuple[list[int], float]]:
+        """
+        Retrieves the message from the queue together with its time.monotonic() arrival time.
+        Blocks up to timeout seconds for a message. Returns None if the queue is still empty.
+        """
         while True:
             try:
-                (type, data) = self.msg_queue.get(block=True, timeout=0)
+                (type, data, rx_time) = self.msg_queue.get(block=timeout > 0, timeout=timeout if timeout > 0 else None)
                 if type is PACKET_TYPES.MSG:
-                    return data
+                    return data, rx_time
             except queue.Empty:
                 return None
 
-    def handle_packet(self, packet_type: PACKET_TYPES, packet_data: list[int]):
+    def handle_packet(self, packet_type: PACKET_TYPES, packet_data: list[int], rx_time: Optional[float] = None):
         """
         Handles packet based on the type. Logs error for ERROR type, attempts to reconnect for INIT type,
         puts the message into the queue for MSG type, and logs warning for other types.
         """
         if packet_type == PACKET_TYPES.ERROR:
             logging.error(
-                f"NRF24USB Device reported ERROR: {bytes(packet_data).decode(errors='ignore') if packet_data is not None else ''}"
+                "NRF24USB Device reported ERROR: %s",
+                bytes(packet_data).decode(errors="ignore") if packet_data is not None else "",
             )
-            self.last_send_response = (packet_type, None)
+            self.response_queue.put((packet_type, None))
         elif packet_type == PACKET_TYPES.INIT:  # Device might have restarted attempt a reconnect
             logging.warning("NRF24USB Device appears to have reset!")
             self.connected = False
+            self.connected_event.clear()
             self.initialize_device()
         elif packet_type == PACKET_TYPES.MSG:
-            logging.debug(f"Put packet in queque {packet_type} {packet_data}")
-            self.msg_queue.put((packet_type, packet_data))  # Put the message into the queue
-        elif packet_type in (PACKET_TYPES.OK, PACKET_TYPES.ERROR):
-            self.last_send_response = (packet_type, packet_data)
+            logging.debug("Put packet in queque %s %s", packet_type, packet_data)
+            self.msg_queue.put((packet_type, packet_data, rx_time))  # Put the message into the queue
+        elif packet_type == PACKET_TYPES.OK:
+            self.response_queue.put((packet_type, packet_data))
         else:
-            logging.warning(f"MSG_TYPE {packet_type} {packet_data} was ignored!")
+            logging.warning("MSG_TYPE %s %s was ignored!", packet_type, packet_data)
 
     def read_loop(self):
         """
@@ -220,29 +358,31 @@ class NRF24Device:
         logging.info("NRF24USB Read Loop Started!")
         try:
             while not self.stop_event.is_set():  # Inner loop for processing bytes
-                with self.lock:
-                    if not self.connected:
-                        self.initialize_device()
-                    if (pck := self.reader.read_packet()) is None:
-                        continue
-                    (packet_type, packet_data) = pck
-                    if packet_type is not None:
-                        self.handle_packet(packet_type, packet_data)
+                if not self.connected:
+                    self.initialize_device()
+                if (pck := self.reader.read_packet()) is None:
+                    continue
+                rx_time = time.monotonic()
+                (packet_type, packet_data) = pck
+                if packet_type is not None:
+                    self.handle_packet(packet_type, packet_data, rx_time)
         except Exception as e:
-            logging.exception(f"An exception occured during readLoop: {e}")
+            logging.exception("An exception occured during readLoop: %s", e)
             self.connected = False
+            self.connected_event.clear()
 
         logging.info("NRF24USB Read Loop Stopped!")
 
     def stop_read_loop(self):
         """
-        Stops the read loop if the read thread is not None. Waits for the thread to finish if called from another thread.
+        Stops the read and write loops if they are running. Waits for the threads to finish if called from another thread.
         """
         if self.read_thread != None:
             logging.info("Stopping Read Loop ...")
             self.stop_event.set()  # Set the stop event
-            if threading.current_thread() != self.read_thread:
-                self.read_thread.join()  # Wait for the thread to finish if called from another thread
+            for thread in (self.read_thread, self.write_thread):
+                if thread is not None and threading.current_thread() != thread:
+                    thread.join()  # Wait for the thread to finish if called from another thread
         try:
             self.serial_port.close()
         except AttributeError:
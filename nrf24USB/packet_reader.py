@@ -4,7 +4,6 @@ import time
 from enum import Enum
 from typing import Optional
 from collections import deque
-from threading import Lock
 
 
 class PACKET_TYPES(Enum):
@@ -29,13 +28,21 @@ class SpecialBytes:
 
 
 class PacketReader:
+    """
+    Reads and parses the packets of the NRF24USB device.
+    The reader is not thread safe, it must only be used from a single thread (the read loop).
+    """
+
     def __init__(self, port: serial.Serial, use_clear_text: bool = False):
         self.port = port
         self.intermediate_buffer = deque()
         self.use_clear_text = use_clear_text
         self.reset_buffer()
-        self.lock = Lock()
-        self.packet_lock = Lock()
+
+        # Statistics, kept as plain ints so that they cost nothing on the read path
+        self.frames_received = 0
+        self.frames_decoded = 0
+        self.frames_invalid = 0
 
     def reset_buffer(self):
         """Resets the buffer and other related flags/counts for a new packet."""
@@ -53,15 +60,14 @@ class PacketReader:
         :raises TimeoutError: If a packet isn't received within the timeout.
         :return: The received packet's type and data as a tuple.
         """
-        with self.lock:
-            start_time = time.time()
-            self.reset_buffer()
-            while time.time() - start_time < timeout:
-                if (pck := self.read_packet()) is not None:
-                    logging.info(f"time needed: {time.time() - start_time}")
-                    return pck
+        start_time = time.time()
+        self.reset_buffer()
+        while time.time() - start_time < timeout:
+            if (pck := self.read_packet()) is not None:
+                logging.info("time needed: %s", time.time() - start_time)
+                return pck
 
-            raise TimeoutError
+        raise TimeoutError
 
     def parse_packet(self, buffer) -> Optional[tuple[Optional[PACKET_TYPES], list]]:
         """
@@ -99,7 +105,7 @@ class PacketReader:
         try:
             msg_type = PACKET_TYPES(ord_type)
         except ValueError:
-            logging.warning(f"Unknown packet type: {ord_type}")
+            logging.warning("Unknown packet type: %s", ord_type)
             return None
         return msg_type, buffer[1:]
     
@@ -151,7 +157,13 @@ class PacketReader:
                 if self.message_started: # End Of Message
                     self.message_started = False
                     #print("End Of Message")
-                    return self.parse_packet(self.data_buffer)
+                    self.frames_received += 1
+                    pck = self.parse_packet(self.data_buffer) if self.data_buffer else None
+                    if pck is None:
+                        self.frames_invalid += 1
+                    else:
+                        self.frames_decoded += 1
+                    return pck
                 
                 #print("start Of Message")
                 self.message_started = True
@@ -166,18 +178,18 @@ class PacketReader:
     def read_packet(self) -> Optional[tuple[Optional[PACKET_TYPES], list]]:
         """
         Reads a packet from the serial port.
+        Already buffered packets are returned first, otherwise it blocks until data arrives or the port times out.
 
         :return: The received packet's type and data as a tuple, or None if no packet is available.
         """
-        with self.packet_lock:
-            if self.port.in_waiting > 0:
-                byte_data = self.port.read_all()
-                # print(byte_data)
-                if byte_data is not None:
-                    self.intermediate_buffer.extend(byte_data)
-
-                pck  =  self.check_parse_intermediate_buffer()
-                if pck is not None:
-                    logging.info(pck)
-                    return pck
-            return None
+        pck = self.check_parse_intermediate_buffer()
+        if pck is None:
+            byte_data = self.port.read(max(1, self.port.in_waiting))
+            # print(byte_data)
+            if byte_data:
+                self.intermediate_buffer.extend(byte_data)
+            pck = self.check_parse_intermediate_buffer()
+        # Every received frame, only logged at DEBUG so no record is created on the radio thread otherwise
+        if pck is not None:
+            logging.debug("%s", pck)
+        return pck
@@ -0,0 +1,138 @@
+import threading
+import time
+from collections import deque
+from enum import Enum
+from typing import Optional
+
+
+class TX_PRIORITY(Enum):
+    INTERACTIVE = 0  # Commands a user waits for
+    AUTOMATION = 1  # Transitions, streamed values and rules
+    BACKGROUND = 2  # Configuration, rebinding and pairing
+
+
+class TokenBucket:
+    """
+    Allows rate frames per second on average and bursts of up to burst frames.
+    A rate of None means unlimited.
+    """
+
+    def __init__(self, rate: Optional[float], burst: float = 1.0):
+        self.rate = rate
+        self.burst = max(1.0, burst)
+        self.tokens = self.burst
+        self.last_update = time.monotonic()
+
+    def refill(self, now: float):
+        if self.rate is not None:
+            self.tokens = min(self.burst, self.tokens + (now - self.last_update) * self.rate)
+        self.last_update = now
+
+    def wait_time(self, now: float) -> float:
+        """
+        Returns how long to wait until a frame may be sent, 0 if it may be sent right away
+        """
+        if self.rate is None:
+            return 0.0
+        self.refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def consume(self, now: float):
+        if self.rate is not None:
+            self.refill(now)
+            self.tokens -= 1
+
+
+class TxLane:
+    """
+    The queue and statistics of one priority class
+    """
+
+    def __init__(self, rate: Optional[float], burst: float):
+        self.queue = deque()
+        self.bucket = TokenBucket(rate, burst)
+        self.sent = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+
+class TxScheduler:
+    """
+    Replaces a plain FIFO in front of the write loop.
+    Every priority class has its own queue and token bucket, and all classes share a global token bucket
+    for the airtime of the single radio. get() always returns the oldest request of the highest priority
+    class that is allowed to send, so interactive commands never wait behind bulk traffic.
+    Without a rate limit of its own INTERACTIVE is only limited by the global budget.
+    """
+
+    def __init__(
+        self,
+        rates: Optional[dict[TX_PRIORITY, Optional[float]]] = None,
+        global_rate: Optional[float] = 200.0,
+        burst: float = 5.0,
+    ):
+        if rates is None:
+            rates = {TX_PRIORITY.INTERACTIVE: None, TX_PRIORITY.AUTOMATION: 100.0, TX_PRIORITY.BACKGROUND: 20.0}
+        self.lanes = {priority: TxLane(rates.get(priority), burst) for priority in TX_PRIORITY}
+        self.global_bucket = TokenBucket(global_rate, burst)
+        self.condition = threading.Condition()
+
+    def put(self, request):
+        with self.condition:
+            self.lanes[request.priority].queue.append(request)
+            self.condition.notify()
+
+    def get(self, timeout: float) -> Optional[object]:
+        """
+        Waits up to timeout seconds for a request that may be sent and returns it, None otherwise
+        """
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                wait = deadline - now
+                if wait <= 0:
+                    return None
+                for lane in self.lanes.values():
+                    if not lane.queue:
+                        continue
+                    lane_wait = max(lane.bucket.wait_time(now), self.global_bucket.wait_time(now))
+                    if lane_wait <= 0:
+                        lane.bucket.consume(now)
+                        self.global_bucket.consume(now)
+                        request = lane.queue.popleft()
+                        waited = now - request.queued_time
+                        lane.sent += 1
+                        lane.total_wait += waited
+                        lane.max_wait = max(lane.max_wait, waited)
+                        return request
+                    wait = min(wait, lane_wait)
+                self.condition.wait(wait)
+
+    def drain(self) -> list:
+        """
+        Removes and returns all queued requests
+        """
+        with self.condition:
+            requests = []
+            for lane in self.lanes.values():
+                requests += lane.queue
+                lane.queue.clear()
+            return requests
+
+    def qsize(self, priority: Optional[TX_PRIORITY] = None) -> int:
+        if priority is not None:
+            return len(self.lanes[priority].queue)
+        return sum(len(lane.queue) for lane in self.lanes.values())
+
+    def get_stats(self) -> dict:
+        with self.condition:
+            return {
+                priority.name.lower(): {
+                    "queued": len(lane.queue),
+                    "sent": lane.sent,
+                    "avg_wait_ms": round(1000 * lane.total_wait / lane.sent, 2) if lane.sent else 0.0,
+                    "max_wait_ms": round(1000 * lane.max_wait, 2),
+                }
+                for priority, lane in self.lanes.items()
+            }
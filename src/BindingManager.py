@@ -0,0 +1,121 @@
+from threading import Lock
+from typing import Optional
+
+from nrf24Smart import RemoteMessage, HostMessage, MSG_TYPES, CHANGE_TYPES
+from nrf24USB import TX_PRIORITY
+from src.DeviceManager import DeviceManager
+from src.Logger import setup_logger
+from src.Metrics import metrics
+
+logger = setup_logger()
+
+binding_actions = metrics.counter(
+    "nrf_binding_actions_total", "Actions of bindings triggered by remote events", ("result",)
+)
+
+ACTIONS = {
+    "toggle": CHANGE_TYPES.TOGGLE,
+    "increase": CHANGE_TYPES.INCREASE,
+    "decrease": CHANGE_TYPES.DECREASE,
+}
+
+
+class BindingManager:
+    """
+    Maps the events of remotes directly to actions on other devices, so a button press does not have to
+    go through MQTT and back. A binding triggers on an event of a remote and toggles, increases or decreases
+    a parameter of its target, without a target the action goes to the TARGET_UUID of the RemoteMessage.
+
+    The bindings are stored in the DB and kept in a dict by remote and event for the lookup. Actions are
+    relative changes, so they are queued once with interactive priority and not retried or coalesced like
+    the SETs of the parameter_buffer. The value the target reports in its OK status becomes its desired value.
+    """
+
+    def __init__(self, device_manager: DeviceManager):
+        self.device_manager = device_manager
+        self.db_manager = device_manager.db_manager
+        self.lock = Lock()
+        self.bindings = {}
+        # Parameters changed by an action by uuid_string of the target, until its OK status arrived
+        self.changed = {}
+        self.load()
+
+    def load(self):
+        """
+        Reads the bindings from the DB
+        """
+        bindings = {}
+        for binding in self.db_manager.get_bindings():
+            bindings.setdefault((str(binding["remote"]), binding["event"]), []).append(binding)
+        with self.lock:
+            self.bindings = bindings
+
+    def add_binding(
+        self, remote: list[int], event: str, target: Optional[list[int]], parameter: str, action: str, step: int = 1
+    ) -> Optional[int]:
+        """
+        Adds a binding and returns its id, or None if the remote, the target or the action is not supported
+        """
+        if (change_type := ACTIONS.get(action)) is None:
+            logger.warning("Unknown binding action %s", action)
+            return None
+        if self.db_manager.search_device_in_db(remote) is None:
+            logger.warning("Remote with uuid:%s not in DB!", remote)
+            return None
+        if target is not None:
+            if (device := self.db_manager.search_device_in_db(target)) is None:
+                logger.warning("Target with uuid:%s not in DB!", target)
+                return None
+            class_obj = self.device_manager.get_supported_device(device["type"])
+            if class_obj is None or class_obj.create_change_message(parameter, change_type, step) is None:
+                logger.warning("Device of type %s does not support %s of %s", device["type"], action, parameter)
+                return None
+
+        binding = {"remote": remote, "event": event, "target": target, "parameter": parameter, "action": action, "step": step}
+        if (binding_id := self.db_manager.add_binding(binding)) is not None:
+            self.load()
+        return binding_id
+
+    def remove_binding(self, binding_id: int) -> bool:
+        if not self.db_manager.remove_binding(binding_id):
+            return False
+        self.load()
+        return True
+
+    def trigger(self, msg: RemoteMessage, event: str) -> int:
+        """
+        Queues the actions bound to an event of a remote. Returns the number of queued actions.
+        """
+        with self.lock:
+            bindings = self.bindings.get((str(msg.UUID), event), [])
+        queued = 0
+        for binding in bindings:
+            target = binding["target"] if binding["target"] is not None else msg.TARGET_UUID
+            if self.run_action(target, binding["parameter"], ACTIONS[binding["action"]], binding["step"]):
+                queued += 1
+                binding_actions.labels("queued").inc()
+            else:
+                binding_actions.labels("failed").inc()
+        return queued
+
+    def run_action(self, target: list[int], parameter: str, change_type: CHANGE_TYPES, step: int) -> bool:
+        if (device := self.db_manager.search_device_in_db(target)) is None:
+            logger.warning("Binding target with uuid:%s not in DB!", target, extra={"device": target})
+            return False
+        class_obj = self.device_manager.get_supported_device(device["type"])
+        if class_obj is None or (set_message := class_obj.create_change_message(parameter, change_type, step)) is None:
+            logger.warning("Device of type %s does not support %s of %s", device["type"], change_type, parameter)
+            return False
+
+        msg = HostMessage(uuid=self.db_manager.uuid, msg_type=MSG_TYPES.SET, data=set_message.get_raw())
+        self.device_manager.send_msg_to_device_async(device["id"], msg.get_raw(), priority=TX_PRIORITY.INTERACTIVE)
+        with self.lock:
+            self.changed.setdefault(str(target), set()).add(parameter)
+        return True
+
+    def pop_changed(self, uuid: list[int]) -> set:
+        """
+        Returns the parameters changed by actions since the last OK status of a device
+        """
+        with self.lock:
+            return self.changed.pop(str(uuid), set())
@@ -0,0 +1,114 @@
+import heapq
+import time
+from threading import Condition, Event
+from typing import Callable, Optional
+
+from src.Logger import setup_logger
+from src.Metrics import metrics
+
+logger = setup_logger()
+
+
+class CommandScheduler:
+    """
+    Wakes up devices with pending commands.
+    Devices are kept in a heap ordered by the time they are due. Devices that are due at the same
+    time are processed in the order they were scheduled, so every device gets its turn.
+    A device is only scheduled once, scheduling it again keeps the earlier due time.
+    Several workers can call run, a device is only processed by one of them at a time: scheduling
+    a device that is being processed takes effect once it is finished.
+    """
+
+    def __init__(self, shutdown_flag: Event):
+        self.shutdown_flag = shutdown_flag
+        self.heap = []
+        self.due = {}
+        self.num_scheduled = 0
+        # Devices being processed by a worker, with the due time they were scheduled for in the meantime
+        self.active = {}
+        self.condition = Condition()
+        # Delay after which a device is processed again when processing it raised an exception
+        self.error_delay = 1.0
+        metrics.gauge("nrf_scheduler_devices", "Devices with pending commands waiting for their turn").set_function(
+            lambda: len(self.due)
+        )
+
+    def schedule(self, uuid: list[int], delay: float = 0.0):
+        """
+        Process the device with the given uuid after delay seconds
+        """
+        uuid_string = str(uuid)
+        due_time = time.monotonic() + delay
+        with self.condition:
+            if uuid_string in self.active:
+                if (deferred := self.active[uuid_string]) is None or due_time < deferred:
+                    self.active[uuid_string] = due_time
+                return
+            self.push(uuid_string, uuid, due_time)
+
+    def push(self, uuid_string: str, uuid: list[int], due_time: float):
+        """
+        Adds the device to the heap, must be called with the condition held
+        """
+        if uuid_string in self.due and self.due[uuid_string] <= due_time:
+            return
+        self.due[uuid_string] = due_time
+        self.num_scheduled += 1
+        heapq.heappush(self.heap, (due_time, self.num_scheduled, uuid_string, uuid))
+        self.condition.notify()
+
+    def get_next(self, timeout: float) -> Optional[list[int]]:
+        """
+        Waits up to timeout seconds for the next due device and returns its uuid.
+        The device is active until finish is called for it.
+        """
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                # Skip entries that were replaced by an earlier due time
+                while self.heap and self.due.get(self.heap[0][2]) != self.heap[0][0]:
+                    heapq.heappop(self.heap)
+                if self.heap and self.heap[0][0] <= now:
+                    _, _, uuid_string, uuid = heapq.heappop(self.heap)
+                    del self.due[uuid_string]
+                    self.active[uuid_string] = None
+                    return uuid
+                if now >= deadline:
+                    return None
+                wait = deadline - now
+                if self.heap:
+                    wait = min(wait, self.heap[0][0] - now)
+                self.condition.wait(wait)
+
+    def finish(self, uuid: list[int], delay: Optional[float]):
+        """
+        Ends the processing of a device, it is processed again after delay seconds (None if it is done)
+        or when it was scheduled while it was active
+        """
+        uuid_string = str(uuid)
+        with self.condition:
+            due_time = self.active.pop(uuid_string, None)
+            if delay is not None:
+                retry_time = time.monotonic() + delay
+                due_time = retry_time if due_time is None else min(due_time, retry_time)
+            if due_time is not None:
+                self.push(uuid_string, uuid, due_time)
+
+    def run(self, process: Callable[[list[int]], Optional[float]]):
+        """
+        Calls process for every due device until the shutdown_flag is set.
+        process returns the delay after which the device has to be processed again, or None if it is done.
+        A device whose processing raised is processed again after error_delay seconds.
+        """
+        while not self.shutdown_flag.is_set():
+            uuid = self.get_next(timeout=0.5)
+            if uuid is None:
+                continue
+            delay = self.error_delay
+            try:
+                delay = process(uuid)
+            except Exception as e:
+                logger.exception("Processing device %s failed: %s", uuid, e)
+            finally:
+                self.finish(uuid, delay)
@@ -1,15 +1,85 @@
-from nrf24Smart import DeviceMessage, HostMessage, RemoteMessage, MSG_TYPES
+from nrf24Smart import DeviceMessage, HostMessage, RemoteMessage, MultiSetMessage, MSG_TYPES
+from nrf24USB import TX_PRIORITY, TX_STATUS
 import time
 from datetime import datetime
 from src.DeviceManager import DeviceManager
 from src.Logger import setup_logger
-from threading import Event
-from typing import Optional
-from collections import deque
-import queue
+from src.Metrics import metrics
+from src.Tracing import tracer, MessageTrace
+from src.CommandScheduler import CommandScheduler
+from src.RetryPolicy import RetryPolicy
+from src.ConnectionHealth import ConnectionHealth
+from src.LivenessTracker import LivenessTracker, liveness_transitions
+from src.PairingManager import PairingManager
+from src.MessagePipeline import PipelineStage
+from src.EventBus import event_bus
+from src.BindingManager import BindingManager
+from src.RulesEngine import RulesEngine
+from src.ScheduleManager import ScheduleManager
+from threading import Event, Lock, Thread
+from typing import Callable, Optional
+import logging
 
 logger = setup_logger()
 
+listen_duration = metrics.histogram(
+    "nrf_listen_iteration_seconds", "Time spent processing a received message in the listen loop"
+)
+connection_health_gauge = metrics.gauge(
+    "nrf_device_connection_health", "Share of messages received of the last messages sent by a device", ("uuid",)
+)
+connection_health_longterm = metrics.gauge(
+    "nrf_device_connection_health_longterm",
+    "Exponentially decayed share of messages received from a device",
+    ("uuid",),
+)
+set_updates = metrics.counter("nrf_set_updates_total", "Parameter updates requested through set_device_param")
+set_updates_coalesced = metrics.counter(
+    "nrf_set_updates_coalesced_total", "Parameter updates replaced by a newer update before they were sent"
+)
+set_frames = metrics.counter("nrf_set_frames_total", "SET messages sent to devices")
+stream_frames = metrics.counter("nrf_stream_frames_total", "Unacknowledged SET messages sent for streamed parameters")
+set_results = metrics.counter(
+    "nrf_set_results_total", "Results of acknowledged SET messages and dropped commands per device", ("uuid", "result")
+)
+set_retries = metrics.counter("nrf_set_retries_total", "SET messages retried after a failure per device", ("uuid",))
+battery_flushes = metrics.counter(
+    "nrf_battery_flushes_total", "Held commands flushed to battery powered devices after they woke up"
+)
+set_updates_suppressed = metrics.counter(
+    "nrf_set_updates_suppressed_total", "Parameter updates not sent because the device already reported the value"
+)
+reconcile_runs = metrics.counter(
+    "nrf_reconcile_runs_total", "Comparisons of the desired state of a device with its reported status"
+)
+reconcile_params = metrics.counter(
+    "nrf_reconcile_params_total", "Parameters queued because the reported status drifted from the desired state"
+)
+confirm_latency = metrics.histogram(
+    "nrf_set_confirm_latency_seconds", "Time from a confirmed SET request until the OK status reflected the value"
+)
+
+
+class SetConfirmation:
+    """
+    A parameter update a caller waits for until an OK status of the device reports the new value.
+    """
+
+    def __init__(self, parameter: str, value: str):
+        self.parameter = parameter
+        self.value = value
+        self.start_time = time.monotonic()
+        self.confirmed: Optional[bool] = None  # None while waiting, False if the command was given up
+        self.latency: Optional[float] = None
+        self.event = Event()
+
+    def finish(self, confirmed: bool):
+        self.latency = time.monotonic() - self.start_time
+        self.confirmed = confirmed
+        if confirmed:
+            confirm_latency.observe(self.latency)
+        self.event.set()
+
 
 class CommunicationManager:
     def __init__(self, device_manager: DeviceManager, shutdown_flag: Event):
@@ -25,80 +95,130 @@ class CommunicationManager:
 
         # Internal Buffer for puffering status changes
         self.parameter_buffer = {}
-        self.failed_sends = {}
-
-        # Internal Dict for storing msg_nums to calculate a connection health
-        self.max_msg_num_length = 20
-        self.msg_nums = {}
-
-        # Devices where we are waiting for an ack message
+        self.buffer_lock = Lock()
+
+        # When pending parameters were set and how often sending them failed, by uuid_string and parameter
+        self.command_info = {}
+
+        # Devices with pending parameters are processed by the scheduler on send_workers threads
+        self.scheduler = CommandScheduler(shutdown_flag)
+        self.send_workers = 4
+
+        # Failed sends are retried according to the RetryPolicy of the device (retry_policies by uuid_string
+        # or the default retry_policy), device_failures counts the consecutive failures of a device
+        self.retry_policy = RetryPolicy()
+        self.retry_policies = {}
+        self.device_failures = {}
+
+        # Battery powered devices only listen for a short time after they sent a message. Commands for them
+        # are held until their next STATUS or REMOTE message and then sent within the wake_window.
+        self.hold_battery_commands: bool = True
+        self.wake_window = 0.2
+        self.awake_until = {}
+        self.battery_retry_policy = RetryPolicy(base_delay=0.02, max_delay=0.1, max_attempts=100, deadline=24 * 3600)
+
+        # Maximum number of SET messages per second sent to a single device, 0 disables the limit
+        self.max_send_rate = 20.0
+        self.last_send = {}
+
+        # Streamed parameters per device, whether the latest value was sent unacknowledged and when it is
+        # committed. The settled value is committed stream_commit_delay seconds after the last value.
+        self.stream_state = {}
+        self.last_stream_update = {}
+        self.max_stream_rate = 30.0
+        self.stream_commit_delay = 0.3
+        self.last_stream_send = {}
+        # Acknowledged SET messages sent to commit streamed values, the TransitionManager counts them against its budget
+        self.stream_commits = 0
+
+        # Devices that do not send a message within their status_interval are marked offline
+        self.liveness = LivenessTracker(self.db_manager, shutdown_flag)
+
+        # New devices are paired on their own thread (see pair_devices)
+        self.pairing = PairingManager(device_manager, shutdown_flag)
+
+        # Actions on devices triggered directly by the events of remotes
+        self.bindings = BindingManager(device_manager)
+
+        # Automations triggered by the events of remotes and the status of devices
+        self.rules = RulesEngine(self)
+
+        # Commands that run at set times (see run_schedules)
+        self.schedules = ScheduleManager(self, shutdown_flag)
+
+        # Devices that rebooted or came back online. Their desired state is compared with the next
+        # reported status and the parameters that drifted are sent again.
+        self.needs_reconcile = set()
+
+        # Called with the uuid of a removed device, e.g. by the TransitionManager to stop its transitions
+        self.forget_handlers: list[Callable[[list[int]], None]] = []
+
+        # ConnectionHealth trackers by uuid_string over the last health_window_size msg_nums.
+        # The health is written to the DB when it changed by health_threshold since it was last written,
+        # together with the next status of the device (health_updates).
+        self.health_window_size = 20
+        self.health_threshold = 0.1
+        self.connection_health = {}
+        self.reported_health = {}
+        self.health_updates = {}
+
+        # Devices where we are waiting for an ack message, with the time the SET was sent.
+        # The next SET to a device is sent once the OK status arrived or status_ack_timeout passed.
         self.wait_for_status_acks: bool = True
-        self.wait_for_status = set()
-
-        # Queque to notify the mqttManager about events
-        self.event_queue = queue.Queue()
-
-    def calc_missing(self, lst) -> int:
-        # Create a complete set from the smallest to the largest number in the list
-        complete_set = set(range(min(lst), max(lst) + 1))
-
-        # Convert the original list to a set
-        lst_set = set(lst)
-
-        # Find the difference between the complete set and the original set
-        missing_set = complete_set - lst_set
-
-        # Return the number of missing entries
-        return len(missing_set)
-
-    def reset_connection_health(self, uuid: list[int]):
-        uuid_string = str(uuid)
-        if (
-            self.db_manager.search_device_in_db(uuid) is None
-            or uuid_string not in self.msg_nums
-        ):
-            return
-
-        logger.debug(f"reset list for uuid {uuid}")
-        self.msg_nums[uuid_string].clear()
-        self.msg_nums[uuid_string].append(0)
+        self.wait_for_status = {}
+        self.status_ack_timeout = 0.1
+
+        # Parameters update_device took to send, by uuid_string. They stay in flight until the status of the
+        # device in the DB reports them, a failed send may still have reached the device. set_device_param
+        # does not suppress a value while a parameter of the same target is in flight.
+        self.in_flight = {}
+
+        # SetConfirmations by uuid_string that wait for an OK status of the device
+        self.confirmations = {}
+
+        # Maximum time the listener blocks waiting for a message before checking the shutdown_flag
+        self.listen_timeout = 0.5
+
+        # Stages of the message pipeline (see listen). Frames are decoded and checked against the DB by
+        # decode_workers threads, the state is updated by a single thread in the order of the messages.
+        # A full decode queue drops, a full state queue blocks the decode workers. The persist queue holds
+        # one update per device, a new update of a device is merged into the one still waiting.
+        self.decode_workers = 2
+        self.decode_stage = PipelineStage(
+            "decode", self.decode_stage_handler, shutdown_flag, self.decode_workers, maxsize=256, drop_when_full=True
+        )
+        self.state_stage = PipelineStage("state", self.state_stage_handler, shutdown_flag, maxsize=256)
+        self.persist_stage = PipelineStage(
+            "persist", self.persist_update, shutdown_flag, maxsize=1024, merge=self.merge_updates
+        )
+        # Fields of a device that are written to the DB for a status message
+        self.status_fields = (
+            "uuid", "version", "status_interval", "battery_level", "battery_percent", "status", "last_seen"
+        )
 
-    def update_connection_health(self, uuid: list[int], msg_num: int):
+    def update_connection_health(self, uuid: list[int], msg_num: int) -> bool:
         """
-        Updates the Connection Status by calcualting the missed messages
+        Updates the connection health of a device with the msg_num of a received message.
+        The health is written with the next status update once it changed by at least health_threshold.
+        Returns False if the msg_num was already received.
         """
-        # Return early if device not in db
-        if self.db_manager.search_device_in_db(uuid) is None:
-            return
-
         uuid_string = str(uuid)
+        if (tracker := self.connection_health.get(uuid_string)) is None:
+            tracker = self.connection_health[uuid_string] = ConnectionHealth(self.health_window_size)
+        if not tracker.update(msg_num):
+            return False
 
-        # Check if device_id is in msg_nums
-        if uuid_string not in self.msg_nums:
-            # If uuid_string is not in msg_nums, initialize it
-            logger.debug(f"initialize id {uuid_string}")
-            self.msg_nums[uuid_string] = deque(maxlen=self.max_msg_num_length)
-            self.msg_nums[uuid_string].append(msg_num)
-
-        # If msg_num either cycles back to 0 or the device resets, reset the list
-        elif msg_num == 0 or msg_num < max(self.msg_nums[uuid_string]):
-            self.reset_connection_health(uuid)
-
-        elif msg_num in self.msg_nums[uuid_string]:
-            logger.warning(
-                f"Repeated msg_num {msg_num} in {self.msg_nums[uuid_string]} for device {uuid}"
-            )
-
-        # Add the msg_num to the list for uuid_string
-        else:
-            self.msg_nums[uuid_string].append(msg_num)
-
-        # Calculate the connection health
-        num_missing = self.calc_missing(self.msg_nums[uuid_string])
-        connection_health = 1 - num_missing / (
-            len(self.msg_nums[uuid_string]) + num_missing
-        )
-        self.db_manager.update_connection_health(uuid, connection_health)
+        health = tracker.health
+        connection_health_gauge.labels(uuid_string).set(health)
+        connection_health_longterm.labels(uuid_string).set(tracker.longterm)
+        reported = self.reported_health.get(uuid_string)
+        if reported is None or abs(health - reported) >= self.health_threshold or (health == 1 and reported != 1):
+            self.reported_health[uuid_string] = health
+            self.health_updates[uuid_string] = {
+                "connection_health": round(health, 2),
+                "connection_health_longterm": round(tracker.longterm, 2),
+            }
+        return True
 
     def check_device_message(
         self, msg: DeviceMessage | RemoteMessage
@@ -109,19 +229,23 @@ class CommunicationManager:
         """
         device = self.db_manager.search_device_in_db(msg.UUID)
         if device == None:
-            logger.warning(f"Device with uuid:{msg.UUID} not in DB!")
+            logger.warning("Device with uuid:%s not in DB!", msg.UUID, extra={"device": msg.UUID})
             return None
 
         # Check if the class exists in the supported_devices list
         class_obj = self.device_manager.get_supported_device(device["type"])
         if class_obj == None:
-            logger.warning(f"Unsupported Device of type:{device['type']} in DB!")
+            logger.warning("Unsupported Device of type:%s in DB!", device["type"])
             return None
 
         # Check that id and uuid match the db
         if msg.ID != device.get("id"):
             logger.warning(
-                f"Mismatched ID and UUID! Device with UUID:{msg.UUID} reports ID:{msg.ID} instead of {device.get('id')}"
+                "Mismatched ID and UUID! Device with UUID:%s reports ID:%s instead of %s",
+                msg.UUID,
+                msg.ID,
+                device.get("id"),
+                extra={"device": msg.UUID},
             )
             return None
 
@@ -129,31 +253,31 @@ class CommunicationManager:
             # Check the firmware Version
             if msg.FIRMWARE_VERSION not in class_obj.supported_versions:
                 logger.error(
-                    f"Device with UUID {msg.UUID} reports unsupported Firmware Version {msg.FIRMWARE_VERSION}"
+                    "Device with UUID %s reports unsupported Firmware Version %s", msg.UUID, msg.FIRMWARE_VERSION
                 )
             if msg.FIRMWARE_VERSION != device.get("version"):
                 logger.warning(
-                    f"Device with UUID {msg.UUID} changed Firmware Version from {device.get('version')} to {msg.FIRMWARE_VERSION}"
+                    "Device with UUID %s changed Firmware Version from %s to %s",
+                    msg.UUID,
+                    device.get("version"),
+                    msg.FIRMWARE_VERSION,
                 )
 
             device["version"] = msg.FIRMWARE_VERSION
             device["status_interval"] = msg.STATUS_INTERVAL
         return device, class_obj
 
-    def handle_status_message(self, msg: DeviceMessage):
+    def handle_status_message(
+        self, msg: DeviceMessage, device: dict, class_obj, trace: Optional[MessageTrace] = None
+    ) -> Optional[dict]:
         """
-        Updates the status of a device given a DeviceMessage.
-        The method fetches the device from the database, checks its type and updates its status.
+        Updates the status of a device given a DeviceMessage and the device checked by check_device_message.
+        Returns the fields of the device that have to be written to the DB.
         """
-        ret = self.check_device_message(msg)
-        if ret:
-            device, class_obj = ret
-        else:
-            return
-
-        if msg.MSG_TYPE == MSG_TYPES.OK.value and msg.ID in self.wait_for_status:
-            self.wait_for_status.remove(msg.ID)
+        if msg.MSG_TYPE == MSG_TYPES.OK.value and self.wait_for_status.pop(msg.ID, None) is not None:
             # print("removed ID:", msg.ID)
+            self.scheduler.schedule(msg.UUID)
+        self.device_awake(device)
 
         # Create an instance of the class
         try:
@@ -164,236 +288,728 @@ class CommunicationManager:
                 device["battery_percent"] = round(msg.BATTERY / 2.55)
             device["status"] = instance.get_status()
             device["last_seen"] = time.strftime("%Y-%m-%d %H:%M:%S")
-            self.db_manager.update_device_in_db(device)
+            if trace is not None:
+                trace.mark("status")
         except Exception as err:
             logger.error(err)
+            tracer.finish(trace)
+            return None
+        # Only the fields taken from the message, other fields may have changed since the device was read
+        update = {key: device[key] for key in self.status_fields if key in device}
+
+        # A status sent before an outstanding SET arrived would look like drift
+        if msg.MSG_TYPE == MSG_TYPES.OK.value:
+            self.confirm_parameters(device, class_obj)
+            # The result of a toggle or step of a binding is the new desired value
+            for parameter in self.bindings.pop_changed(msg.UUID):
+                if (value := class_obj.get_param(parameter, device["status"])) is not None:
+                    self.update_desired_state(class_obj, msg.UUID, parameter, str(value))
+
+        self.rules.on_status(msg.UUID, device["status"])
 
-    def handle_remote_message(self, msg: RemoteMessage):
+        if str(msg.UUID) in self.needs_reconcile and msg.ID not in self.wait_for_status:
+            self.needs_reconcile.discard(str(msg.UUID))
+            self.reconcile_device(device, class_obj)
+        return update
+
+    def handle_remote_message(self, msg: RemoteMessage, device: dict, class_obj):
         """
-        Handles Remote messages address to the server. They are then forwarded to the MQTT interface
+        Handles Remote messages address to the server. Their events trigger the bound actions and are published on the event_bus
         """
-        ret = self.check_device_message(msg)
-        if ret:
-            device, class_obj = ret
-        else:
-            return
-
-        event = "unknow"
+        self.device_awake(device)
+        self.liveness.seen(msg.UUID)
+        event = f"event_{msg.LAYER}:{msg.VALUE}"
         if hasattr(class_obj, "get_remote_event") and callable(
             getattr(class_obj, "get_remote_event")
         ):
             event = class_obj.get_remote_event(msg.LAYER, msg.VALUE)
-        self.event_queue.put((msg.UUID, event))
+        # Bound actions first, they should not wait for the subscribers
+        self.bindings.trigger(msg, event)
+        self.rules.on_event(msg.UUID, event)
+        event_bus.publish("remote", msg.UUID, event)
+
+    def device_awake(self, device: dict):
+        """
+        Called for every message received from a device. A battery powered device listens for a short time
+        after sending, commands held for it are flushed now.
+        """
+        if not device.get("battery_powered") or not self.hold_battery_commands:
+            return
+        uuid_string = str(device["uuid"])
+        self.awake_until[uuid_string] = time.monotonic() + self.wake_window
+        if self.parameter_buffer.get(uuid_string):
+            battery_flushes.inc()
+            self.scheduler.schedule(device["uuid"])
+
+    def is_reachable(self, device: dict) -> bool:
+        """
+        Returns whether a device currently listens for SET messages
+        """
+        if not device.get("battery_powered") or not self.hold_battery_commands:
+            return True
+        return time.monotonic() < self.awake_until.get(str(device["uuid"]), 0)
+
+    def confirm_parameters(self, device: dict, class_obj):
+        """
+        Finishes the SetConfirmations of a device whose value the reported status reflects
+        """
+        with self.buffer_lock:
+            waiting = self.confirmations.get(str(device["uuid"]), [])
+            confirmed = [c for c in waiting if class_obj.matches_status(c.parameter, c.value, device.get("status"))]
+            for confirmation in confirmed:
+                waiting.remove(confirmation)
+        for confirmation in confirmed:
+            confirmation.finish(True)
+
+    def set_device_online(self, uuid: list[int]):
+        """
+        Marks a device online. A device that was offline is reconciled once its next status arrived.
+        """
+        if self.db_manager.update_device_offline_status(uuid, False):
+            liveness_transitions.labels("online").inc()
+            self.needs_reconcile.add(str(uuid))
+
+    def reconcile_device(self, device: dict, class_obj) -> int:
+        """
+        Queues the desired parameters of a device that differ from its reported status.
+        Parameters with a newer pending value are left alone, the queued ones are sent together
+        in as few SET messages as the firmware allows. Returns the number of queued parameters.
+        """
+        uuid = device["uuid"]
+        uuid_string = str(uuid)
+        reconcile_runs.inc()
+        desired = self.db_manager.get_desired_state(uuid)
+        status = device.get("status")
+        queued = []
+        with self.buffer_lock:
+            pending = self.parameter_buffer.setdefault(uuid_string, {})
+            info = self.command_info.setdefault(uuid_string, {})
+            for parameter, value in desired.items():
+                target = class_obj.get_target(parameter)
+                if any(class_obj.get_target(key) == target for key in pending):
+                    continue
+                if class_obj.matches_status(parameter, value, status):
+                    continue
+                pending[parameter] = value
+                info[parameter] = {"queued": time.monotonic(), "attempts": 0, "desired": True}
+                queued.append(parameter)
+        if queued:
+            logger.info("Reconcile %s of device with uuid:%s", queued, uuid, extra={"device": uuid})
+            reconcile_params.inc(len(queued))
+            self.scheduler.schedule(uuid)
+        return len(queued)
 
     def handle_boot_message(self, msg: DeviceMessage):
         """
         Checks the BOOT message from a device.
-        It validates that the UUID of the server corresponds to the stored UUID reported by the Device
+        It validates that the UUID of the server corresponds to the stored UUID reported by the Device.
+        The device lost its state, it is reconciled once its next status arrived.
         """
-        logger.info(f"BOOT message from device:{msg.UUID}")
+        logger.info("BOOT message from device:%s", msg.UUID)
+        self.needs_reconcile.add(str(msg.UUID))
+        if (tracker := self.connection_health.get(str(msg.UUID))) is not None:
+            tracker.reset()
 
     def handle_init_mesage(self, msg: DeviceMessage):
         """
-        Initializes a new Device with the device_manager
+        Hands a new Device to the PairingManager, the listener does not wait for the pairing
         """
-        self.device_manager.init_new_device(msg)
+        self.pairing.submit(msg)
 
     def listen(self):
         """
-        Listens for incoming messages.
-        If a message is available, it processes the message according to its type.
+        Listens for incoming messages and runs the stages of the message pipeline until the shutdown_flag is set:
+        RX (this thread) -> decode -> state -> persist, the persist stage hands changes on to the publishers.
+        This thread only moves the received frames into the decode stage, a slow stage fills its queue
+        and frames are dropped there instead of blocking the reception.
         """
+        threads = []
+        for stage in (self.decode_stage, self.state_stage, self.persist_stage):
+            threads += stage.start()
+
         while not self.shutdown_flag.is_set():
-            time.sleep(0.01)
-            data = self.device_manager.get_device_message()
-            if not data:
-                continue
-            if len(data) < 6:
-                logger.warning("Message from device to short")
-                continue
+            timed_msg = self.device_manager.get_device_message(timeout=self.listen_timeout)
+            # Drain everything that arrived while processing
+            while timed_msg:
+                data, rx_time = timed_msg
+                trace = tracer.start(rx_time)
+                with listen_duration.time():
+                    # Frames of a device are decoded by the same worker to keep their order
+                    if not self.decode_stage.put((data, trace), key=tuple(data[1:5])):
+                        tracer.finish(trace, "dropped")
+                timed_msg = self.device_manager.get_device_message()
+
+        for thread in threads:
+            thread.join()
+        logger.info("Stopped listen")
 
-            if data[5] == MSG_TYPES.REMOTE.value:
-                msg = RemoteMessage(data)
-                if not msg.is_valid:
-                    logger.warning(f"invalid RemoteMessage! {msg.raw_data}")
-                    continue
-                self.handle_remote_message(msg)
-            else:
-                msg = DeviceMessage(data)
-                
-                if not msg.is_valid:
-                    logger.warning(f"invalid message! {msg.raw_data}")
-                    continue
-                uuid = msg.UUID
-                self.db_manager.update_device_offline_status(uuid, False)
+    def handle_device_message(self, data: list[int], trace: Optional[MessageTrace] = None):
+        """
+        Processes a raw message received from a device through all stages on the calling thread.
+        """
+        if (decoded := self.decode_message(data, trace)) is not None:
+            if (update := self.update_state(*decoded, trace)) is not None:
+                self.persist_update(update, trace)
 
-                if msg.MSG_TYPE == MSG_TYPES.INIT.value:
-                    self.handle_init_mesage(msg)
-                elif msg.MSG_TYPE == MSG_TYPES.BOOT.value:
-                    self.handle_boot_message(msg)
-                else:
-                    uuid_string = str(uuid)
-                    if (
-                        uuid_string in self.msg_nums
-                        and msg.MSG_NUM == self.msg_nums[uuid_string][-1]
-                    ):
-                        logger.warning(
-                            f"Ignore msg with repeated msg_num {msg.MSG_NUM} for {uuid_string}"
-                        )
-                        continue
-                    self.update_connection_health(uuid, msg.MSG_NUM)
-
-                    if msg.MSG_TYPE in (MSG_TYPES.STATUS.value, MSG_TYPES.OK.value):
-                        self.handle_status_message(msg)
-                    else:
-                        logger.warning(f"->Unknown DeviceMessage {msg}")
+    def decode_stage_handler(self, data: list[int], trace: Optional[MessageTrace]):
+        if (decoded := self.decode_message(data, trace)) is not None:
+            self.state_stage.put((*decoded, trace))
 
-        logger.info("Stopped listen")
+    def state_stage_handler(self, msg: DeviceMessage | RemoteMessage, device: dict, class_obj, trace):
+        if (update := self.update_state(msg, device, class_obj, trace)) is not None:
+            if not self.persist_stage.put((update, trace), key=str(msg.UUID)):
+                tracer.finish(trace, "dropped")
 
-    def update_device(self, device: dict):
-        uuid = device["uuid"]
-        id = device["id"]
+    @staticmethod
+    def merge_updates(queued: tuple, item: tuple) -> tuple:
+        """
+        Merges a DB update of a device into the one still waiting in the persist queue, the latest fields win
+        """
+        update, trace = queued
+        new_update, new_trace = item
+        tracer.finish(trace, "coalesced")
+        return {**update, **new_update}, new_trace
+
+    def decode_message(self, data: list[int], trace: Optional[MessageTrace] = None) -> Optional[tuple]:
+        """
+        Decodes a raw message received from a device and checks it against the DB.
+        Runs in parallel for different devices and must not touch the state of the CommunicationManager.
+        Returns the message with the device and the class_obj, or None if the message is handled or invalid.
+        Every message but INIT has to come from a device in the DB.
+        """
+        if trace is not None:
+            trace.mark("queue")
+        if len(data) < 6:
+            logger.warning("Message from device to short")
+            tracer.finish(trace)
+            return None
+
+        if data[5] == MSG_TYPES.REMOTE.value:
+            msg = RemoteMessage(data)
+            if not msg.is_valid:
+                logger.warning("invalid RemoteMessage! %s", msg.raw_data)
+                tracer.finish(trace)
+                return None
+        else:
+            msg = DeviceMessage(data)
+            if not msg.is_valid:
+                logger.warning("invalid message! %s", msg.raw_data)
+                tracer.finish(trace)
+                return None
+        if trace is not None:
+            trace.uuid, trace.msg_type = msg.UUID, msg.MSG_TYPE
+            trace.mark("decode")
+
+        if msg.MSG_TYPE == MSG_TYPES.INIT.value:
+            # New devices are only tracked once they are paired
+            self.handle_init_mesage(msg)
+            tracer.finish(trace, "init")
+            return None
+
+        if (ret := self.check_device_message(msg)) is None:
+            tracer.finish(trace, "validate")
+            return None
+        if trace is not None:
+            trace.mark("validate")
+        return msg, *ret
+
+    def update_state(
+        self, msg: DeviceMessage | RemoteMessage, device: dict, class_obj, trace: Optional[MessageTrace] = None
+    ) -> Optional[dict]:
+        """
+        Updates the state of the CommunicationManager with a decoded message, called for one message at a time.
+        Returns the fields of the device that have to be written to the DB.
+        """
+        if isinstance(msg, RemoteMessage):
+            self.handle_remote_message(msg, device, class_obj)
+            tracer.finish(trace, "remote")
+            return None
+
+        uuid = msg.UUID
+        self.liveness.seen(uuid, msg.STATUS_INTERVAL)
+        self.set_device_online(uuid)
+
+        if msg.MSG_TYPE == MSG_TYPES.BOOT.value:
+            self.handle_boot_message(msg)
+            tracer.finish(trace, "boot")
+            return None
+        if not self.update_connection_health(uuid, msg.MSG_NUM):
+            logger.warning("Ignore msg with repeated msg_num %s for %s", msg.MSG_NUM, uuid, extra={"device": uuid})
+            tracer.finish(trace, "status")
+            return None
+        if msg.MSG_TYPE not in (MSG_TYPES.STATUS.value, MSG_TYPES.OK.value):
+            logger.warning("->Unknown DeviceMessage %s", msg)
+            tracer.finish(trace, "status")
+            return None
+        if (update := self.handle_status_message(msg, device, class_obj, trace)) is not None:
+            update.update(self.health_updates.pop(str(uuid), {}))
+        return update
+
+    def persist_update(self, update: dict, trace: Optional[MessageTrace] = None):
+        """
+        Writes the fields of a device to the DB, the DBManager hands the changes on to the publishers
+        """
+        self.db_manager.update_device_in_db(update, trace)
+        if "status" in update and self.in_flight.get(str(update["uuid"])):
+            self.settle_in_flight(update["uuid"], update["status"])
+
+    def settle_in_flight(self, uuid: list[int], status: dict):
+        """
+        Drops the parameters in flight to a device that its status reports
+        """
+        if (device := self.db_manager.search_device_in_db(uuid)) is None:
+            return
+        if (class_obj := self.device_manager.get_supported_device(device["type"])) is None:
+            return
+        with self.buffer_lock:
+            in_flight = self.in_flight.get(str(uuid), {})
+            for key in [key for key, value in in_flight.items() if class_obj.matches_status(key, value, status)]:
+                del in_flight[key]
+
+    def update_device(self, uuid: list[int]) -> Optional[float]:
+        """
+        Sends the next pending parameters of a device. Devices whose firmware supports it get all pending
+        parameters that fit into one SET message, older firmware gets one parameter per message.
+        Streamed parameters are sent without waiting for an ack, their last value is committed with an
+        acknowledged SET once no new value arrived for stream_commit_delay seconds.
+        Returns the delay after which the device has to be processed again, or None if nothing is pending.
+        """
         uuid_string = str(uuid)
-        keys_unsupported = set()
-        keys_updated = []
+        now = time.monotonic()
+        delays = []
+        with self.buffer_lock:
+            pending = self.parameter_buffer.get(uuid_string)
+            if not pending:
+                return None
+            stream_state = self.stream_state.get(uuid_string, {})
+            stream_items, items = [], []
+            for key, value in pending.items():
+                if (state := stream_state.get(key)) is None:
+                    items.append((key, value))
+                elif not state["sent"]:
+                    stream_items.append((key, value))
+                elif (remaining := state["commit"] - now) > 0:
+                    delays.append(remaining)
+                else:
+                    items.append((key, value))
+
+        if (device := self.db_manager.search_device_in_db(uuid)) is None:
+            logger.error("Device with uuid:%s not in DB!", uuid, extra={"device": uuid})
+            self.clear_pending_parameters(uuid_string)
+            return None
+        id = device["id"]
 
         if (
             class_obj := self.device_manager.get_supported_device(device["type"])
         ) == None:
-            logger.error(f"Database contains not supported device {device['type']}")
-            return
+            logger.error("Database contains not supported device %s", device["type"])
+            return None
 
-        if (
-            uuid_string not in self.parameter_buffer
-            or self.parameter_buffer[uuid_string] == {}
-        ):
-            return
+        # Held until the device wakes up, device_awake schedules it again
+        if not self.is_reachable(device):
+            return None
 
-        dict_copy = dict(self.parameter_buffer[uuid_string])
-        for key, value in dict_copy.items():
-            if (set_message := class_obj.create_set_message(key, value)) == None:
-                logger.error(
-                    f"set_status contains not supported parameter {key}: {value}"
+        # Intermediate values of a stream are not acknowledged and not retried.
+        # The other pending parameters are sent in the same pass and do not wait until the stream pauses.
+        if stream_items:
+            last_stream = self.last_stream_send.get(id, 0)
+            if (remaining := last_stream + 1 / self.max_stream_rate - now) > 0:
+                delays.append(remaining)
+            elif (sent := self.create_set_message(class_obj, device, uuid_string, stream_items)) is not None:
+                set_message, streamed = sent
+                msg = HostMessage(uuid=self.db_manager.uuid, msg_type=MSG_TYPES.SET, data=set_message.get_raw())
+                self.last_stream_send[id] = time.monotonic()
+                stream_frames.inc()
+                self.device_manager.send_msg_to_device(
+                    id, msg.get_raw(), require_ack=False, priority=TX_PRIORITY.AUTOMATION
                 )
-                keys_unsupported.add(key)
+                with self.buffer_lock:
+                    pending = self.parameter_buffer.get(uuid_string, {})
+                    stream_state = self.stream_state.get(uuid_string, {})
+                    # The same value may have been set again without streaming in the meantime
+                    for key, value in streamed:
+                        if pending.get(key) == value and (state := stream_state.get(key)) is not None:
+                            state["sent"] = True
+                            delays.append(max(0.0, state["commit"] - now))
+                # Streamed values that did not fit into the message go out with the next stream frame
+                if len(streamed) < len(stream_items):
+                    delays.append(1 / self.max_stream_rate)
+
+        if not items:
+            return min(delays) if delays else None
+
+        # Pace the sends by the OK status the device answers a SET with
+        if (sent_time := self.wait_for_status.get(id)) is not None:
+            remaining = sent_time + self.status_ack_timeout - time.monotonic()
+            if remaining > 0:
+                return min(delays + [remaining])
+            self.wait_for_status.pop(id, None)
+
+        # Per device rate limit, the latest value is sent once the device is due again
+        if self.max_send_rate > 0 and (last_send := self.last_send.get(id)) is not None:
+            remaining = last_send + 1 / self.max_send_rate - time.monotonic()
+            if remaining > 0:
+                return min(delays + [remaining])
+
+        if (sent := self.create_set_message(class_obj, device, uuid_string, items)) is None:
+            return 0
+        set_message, sent = sent
+
+        msg = HostMessage(
+            uuid=self.db_manager.uuid,
+            msg_type=MSG_TYPES.SET,
+            data=set_message.get_raw(),
+        )
+        logger.debug("sending SET %s to device %s", sent, uuid)
+        self.last_send[id] = time.monotonic()
+        set_frames.inc()
+        # The most urgent of the packed parameters, configuration parameters are always background
+        with self.buffer_lock:
+            if any(key in self.stream_state.get(uuid_string, {}) for key, _ in sent):
+                self.stream_commits += 1
+            in_flight = self.in_flight.setdefault(uuid_string, {})
+            for key, value in sent:
+                target = class_obj.get_target(key)
+                for other in [other for other in in_flight if class_obj.get_target(other) == target]:
+                    del in_flight[other]
+                in_flight[key] = value
+            info = self.command_info.get(uuid_string, {})
+            priorities = [
+                TX_PRIORITY.BACKGROUND
+                if key in class_obj.background_parameters
+                else info.get(key, {}).get("priority") or TX_PRIORITY.INTERACTIVE
+                for key, _ in sent
+            ]
+        priority = min(priorities, key=lambda p: p.value)
+        # Set before sending, the OK status of the device can be handled before the send returns
+        if self.wait_for_status_acks:
+            self.wait_for_status[id] = time.monotonic()
+        request = self.device_manager.send_request_to_device(id, msg.get_raw(), priority=priority)
+        self.record_desired_state(class_obj, uuid_string, uuid, sent)
+        if request.status is not TX_STATUS.OK:  # Send Failed
+            self.wait_for_status.pop(id, None)
+            logger.info(
+                "Failed to send SET message to device:%s with uuid:%s: %s",
+                device["type"],
+                uuid,
+                request.status.name,
+                extra={"device": uuid},
+            )
+            return self.handle_failed_send(device, sent, request.status)
+
+        # Send Successfull
+        self.device_failures.pop(uuid_string, None)
+        set_results.labels(uuid_string, "ok").inc()
+        if self.wait_for_status_acks:
+            self.set_device_online(uuid)
+        for key, value in sent:
+            more_pending = self.remove_pending_parameter(uuid_string, key, value)
+        return 0 if more_pending else None
+
+    def handle_failed_send(self, device: dict, sent: list[tuple[str, str]], status: TX_STATUS) -> Optional[float]:
+        """
+        Counts the failed attempt for the sent parameters and drops the ones that exceeded their attempts or deadline.
+        Returns the delay until the next attempt, or None if nothing is pending anymore.
+        """
+        uuid = device["uuid"]
+        uuid_string = str(uuid)
+        if uuid_string in self.retry_policies:
+            policy = self.retry_policies[uuid_string]
+        elif device.get("battery_powered") and self.hold_battery_commands:
+            policy = self.battery_retry_policy
+        else:
+            policy = self.retry_policy
+        set_results.labels(uuid_string, "timeout" if status is TX_STATUS.TIMEOUT else "error").inc()
+        now = time.monotonic()
+        expired = []
+        with self.buffer_lock:
+            pending = self.parameter_buffer.get(uuid_string, {})
+            info = self.command_info.get(uuid_string, {})
+            for key, value in sent:
+                if pending.get(key) != value or (command := info.get(key)) is None:
+                    continue  # Replaced by a newer value in the meantime
+                # A timeout is a problem of the NRF24USB device, not of the command
+                if status is not TX_STATUS.TIMEOUT:
+                    command["attempts"] += 1
+                if policy.is_expired(command["attempts"], now - command["queued"]):
+                    expired.append(key)
+                    del pending[key]
+                    del info[key]
+                    self.stream_state.get(uuid_string, {}).pop(key, None)
+            more_pending = bool(pending)
+
+        if expired:
+            logger.error("Giving up SET of %s to device with uuid:%s", expired, uuid, extra={"device": uuid})
+            set_results.labels(uuid_string, "expired").inc(len(expired))
+            with self.buffer_lock:
+                waiting = self.confirmations.get(uuid_string, [])
+                failed = [c for c in waiting if c.parameter in expired]
+                for confirmation in failed:
+                    waiting.remove(confirmation)
+            for confirmation in failed:
+                confirmation.finish(False)
+            self.db_manager.update_device_offline_status(uuid, True)
+        if not more_pending:
+            self.device_failures.pop(uuid_string, None)
+            return None
+        set_retries.labels(uuid_string).inc()
+        if status is TX_STATUS.TIMEOUT:
+            return policy.timeout_delay
+        self.device_failures[uuid_string] = self.device_failures.get(uuid_string, 0) + 1
+        return policy.get_delay(self.device_failures[uuid_string])
+
+    def create_set_message(
+        self, class_obj, device: dict, uuid_string: str, items: list[tuple[str, str]]
+    ) -> Optional[tuple[MultiSetMessage, list[tuple[str, str]]]]:
+        """
+        Packs the given parameters into a SET message, as many as the firmware of the device accepts.
+        Returns the message together with the packed parameters, or None if no parameter could be packed.
+        """
+        multi_set = class_obj.supports_multi_set(device.get("version"))
+        set_message = MultiSetMessage()
+        sent = []
+        for key, value in items:
+            if (record := class_obj.create_set_message(key, value)) == None:
+                logger.error("set_status contains not supported parameter %s: %s", key, value)
+                self.remove_pending_parameter(uuid_string, key, value)
                 continue
+            if not set_message.add(record):
+                break
+            sent.append((key, value))
+            if not multi_set:
+                break
+        return (set_message, sent) if sent else None
+
+    def remove_pending_parameter(self, uuid_string: str, key: str, value: str) -> bool:
+        """
+        Removes a parameter from the parameter_buffer if its value has not changed in the meantime.
+        Returns whether there are further pending parameters for the device.
+        """
+        with self.buffer_lock:
+            pending = self.parameter_buffer.get(uuid_string, {})
+            if pending.get(key) == value:
+                pending.pop(key)
+                self.stream_state.get(uuid_string, {}).pop(key, None)
+                self.command_info.get(uuid_string, {}).pop(key, None)
+            return bool(pending)
+
+    def clear_pending_parameters(self, uuid_string: str):
+        """
+        Drops all pending parameters of a device
+        """
+        with self.buffer_lock:
+            self.parameter_buffer.pop(uuid_string, None)
+            self.stream_state.pop(uuid_string, None)
+            self.command_info.pop(uuid_string, None)
+            self.in_flight.pop(uuid_string, None)
 
-            msg = HostMessage(
-                uuid=self.db_manager.uuid,
-                msg_type=MSG_TYPES.SET,
-                data=set_message.get_raw(),
-            )
-            logger.debug(f"sending SET {key} {value} to device {uuid}")
-            res = self.device_manager.send_msg_to_device(id, msg.get_raw())
-            if res == None:  # Send Failed
-                logger.info(
-                    f"Failed to send SET message to device:{device['type']} with uuid:{device['uuid']}!"
-                )
-                if uuid_string not in self.failed_sends:
-                    self.failed_sends[uuid_string] = time.time()
-                elif time.time() - self.failed_sends[uuid_string] > 2:
-                    logger.error(
-                        f"Timeout for SET message to device:{device['type']} with uuid:{device['uuid']}!"
-                    )
-                    del self.failed_sends[uuid_string]
-                    self.db_manager.update_device_offline_status(uuid, True)
-                    self.parameter_buffer.pop(uuid_string)
-                return  # Skip Device
-            elif type(res) == list:  # Send Successfull
-                if uuid_string in self.failed_sends:
-                    del self.failed_sends[uuid_string]
-                if self.wait_for_status_acks:
-                    self.wait_for_status.add(id)
-                    self.db_manager.update_device_offline_status(uuid, False)
-                keys_updated.append((key, value))
-            time.sleep(0.1)  # Wait for message to process
-
-
-        # Remove unsupported parameters
-        for k in keys_unsupported:
-            # Only remove if values have not changed:
-            if dict_copy.get(k) == self.parameter_buffer[uuid_string].get(k):
-                self.parameter_buffer[uuid_string].pop(k)
-
-        # Remove successfully send parameters
-        # Only remove if values have not changed:
-        for key, value in keys_updated:
-            if value == self.parameter_buffer[uuid_string].get(key):
-                self.parameter_buffer[uuid_string].pop(key)
-                
-
-    def wait_for_status_update(self, key: str, uuid_string : str, id: int) -> bool:
-            print(f"wait for status from id", id)
-            if id not in self.wait_for_status:
-                return True
-            return False
+    def forget_device(self, uuid: list[int]):
+        """
+        Removes a device from the DB and drops everything that is tracked for it: pending commands,
+        confirmations, connection health, liveness, bindings, rules and the state of the forget_handlers.
+        A device that is paired again under the same uuid or ID starts fresh.
+        """
+        uuid_string = str(uuid)
+        device = self.db_manager.search_device_in_db(uuid)
+        self.db_manager.remove_device_from_db(uuid)
+
+        self.clear_pending_parameters(uuid_string)
+        with self.buffer_lock:
+            waiting = self.confirmations.pop(uuid_string, [])
+            for key in [key for key in self.last_stream_update if key[0] == uuid_string]:
+                del self.last_stream_update[key]
+        for confirmation in waiting:
+            confirmation.finish(False)
+        for tracked in (
+            self.connection_health, self.reported_health, self.health_updates,
+            self.device_failures, self.retry_policies, self.awake_until,
+        ):
+            tracked.pop(uuid_string, None)
+        self.needs_reconcile.discard(uuid_string)
+        if device is not None:
+            for tracked in (self.wait_for_status, self.last_send, self.last_stream_send):
+                tracked.pop(device["id"], None)
+
+        self.liveness.forget(uuid)
+        self.bindings.load()
+        self.rules.load()
+        for handler in self.forget_handlers:
+            handler(uuid)
+
+    def track_liveness(self):
+        """
+        Marks devices offline that missed their status interval
+        """
+        self.liveness.run()
 
-    def update_all_devices(self):
+    def pair_devices(self):
         """
-        Send any pending status changes in set_status to the devices.
+        Answers the INIT messages of new devices
         """
-        while not self.shutdown_flag.is_set():
-            for device in self.db_manager.get_all_devices():
-                self.update_device(device)
-            time.sleep(0.2)  # Wait till next update
-
-            # for entry in keys_updated:
-            #     (id, uuid_string, key, value) = entry
-            #     device = self.db_manager.search_device_in_db_by_id(id)
-            #     if device is None:
-            #         continue
-            #     # Only remove if values have not changed:
-            #     if value == self.parameter_buffer[uuid_string].get(key):
-            #         print("wait for status from id", id)
-            #         if id not in self.wait_for_status:
-            #             del self.parameter_buffer[uuid_string][key]
-            #             keys_updated.remove(entry)
-            #             break
-            #     if id in self.wait_for_status:
-            #         logger.warning(f"did not receive status update in time from device {device.get('name')} {uuid_string}")
-
-        logger.info("Stopped update_all_devices")
+        self.pairing.run()
+
+    def run_schedules(self):
+        """
+        Runs the scheduled commands when they are due
+        """
+        self.schedules.run()
+
+    def send_pending_commands(self):
+        """
+        Send any pending status changes in the parameter_buffer to the devices.
+        Devices are woken up by set_device_param and processed one parameter at a time, so sends to different devices interleave.
+        send_workers devices are processed at the same time, so the radio does not wait while the next device is prepared.
+        """
+        workers = [
+            Thread(target=self.scheduler.run, args=(self.update_device,), name=f"send_worker_{i}")
+            for i in range(1, self.send_workers)
+        ]
+        for worker in workers:
+            worker.start()
+        self.scheduler.run(self.update_device)
+        for worker in workers:
+            worker.join()
+        logger.info("Stopped send_pending_commands")
 
     def get_device_param(self, uuid, parameter):
         """
         Get a parameter for the device
         """
-        logger.debug(f"get {uuid} parameter: {parameter}")
+        logger.debug("get %s parameter: %s", uuid, parameter)
         if (device := self.db_manager.search_device_in_db(uuid)) is None:
-            logger.error(f"Device with uuid:{uuid} not in DB!")
+            logger.error("Device with uuid:%s not in DB!", uuid, extra={"device": uuid})
             return None
         if (
             class_obj := self.device_manager.get_supported_device(device["type"])
         ) is None:
-            logger.warning(f"{device['type']} not supported")
+            logger.warning("%s not supported", device["type"])
             return None
         if (status := device.get("status")) is None:
-            logger.error(f"Device with uuid:{uuid} does not have a status!")
+            logger.error("Device with uuid:%s does not have a status!", uuid, extra={"device": uuid})
             return None
         return class_obj.get_param(parameter, status)
 
-    def set_device_param(self, uuid: list[int], parameter: str, new_val: str) -> bool:
+    def set_device_param(
+        self,
+        uuid: list[int],
+        parameter: str,
+        new_val: str,
+        stream: bool = False,
+        confirmation: Optional[SetConfirmation] = None,
+        record_desired: bool = True,
+        device: Optional[dict] = None,
+        priority: Optional[TX_PRIORITY] = None,
+    ) -> bool:
         """
-        Set the a parameter for the device
+        Set the a parameter for the device.
+        With stream the value is an intermediate value of a continuous change, it is sent without waiting
+        for an ack and only the final value of the stream is confirmed by the device.
+        A confirmation is finished once an OK status of the device reports the value, see wait_for_confirmation.
+        Without record_desired the caller stores the desired value itself, e.g. for many devices at once.
+        A caller that just read the device from the DB can pass it to save the lookup.
+        The SET is sent with the given priority, INTERACTIVE by default (BACKGROUND for configuration parameters).
         """
-        logger.info(f"set {uuid} parameter: {parameter} to new_val: {new_val}")
-        if (device := self.db_manager.search_device_in_db(uuid)) is None:
-            logger.error(f"Device with uuid:{uuid} not in DB!")
+        logger.log(
+            logging.DEBUG if stream else logging.INFO, "set %s parameter: %s to new_val: %s", uuid, parameter, new_val
+        )
+        if device is None and (device := self.db_manager.search_device_in_db(uuid)) is None:
+            logger.error("Device with uuid:%s not in DB!", uuid, extra={"device": uuid})
             return False
         if (
             class_obj := self.device_manager.get_supported_device(device["type"])
         ) is None:
-            logger.warning(f"{device['type']} not supported")
+            logger.warning("%s not supported", device["type"])
             return False
         if parameter not in class_obj.settable_parameters:
-            logger.warning(f"Setting parameter {parameter} not supported")
+            logger.warning("Setting parameter %s not supported", parameter)
+            return False
+        if stream and parameter not in class_obj.streamable_parameters:
+            logger.warning("Streaming parameter %s not supported", parameter)
+            return False
+        if stream and confirmation is not None:
+            logger.warning("Streamed values are not confirmed")
             return False
 
+        # Last writer wins: a pending update of the same parameter or of a parameter that
+        # targets the same value on the device (e.g. cct and rgb) is replaced
+        set_updates.inc()
+        target = class_obj.get_target(parameter)
         uuid_string = str(uuid)
-        if uuid_string not in self.parameter_buffer:
-            self.parameter_buffer[uuid_string] = {}
-        self.parameter_buffer[uuid_string][parameter] = new_val
+        with self.buffer_lock:
+            pending = self.parameter_buffer.setdefault(uuid_string, {})
+            stream_state = self.stream_state.setdefault(uuid_string, {})
+            info = self.command_info.setdefault(uuid_string, {})
+            # The device already reports the value and nothing else is on the way to it
+            suppress = (
+                not stream
+                and not device.get("offline")
+                and device["id"] not in self.wait_for_status
+                and not any(class_obj.get_target(key) == target for key in pending)
+                and not any(class_obj.get_target(key) == target for key in self.in_flight.get(uuid_string, {}))
+                and class_obj.matches_status(parameter, new_val, device.get("status"))
+            )
+            for key in [key for key in pending if class_obj.get_target(key) == target]:
+                del pending[key]
+                stream_state.pop(key, None)
+                info.pop(key, None)
+                if not suppress:
+                    set_updates_coalesced.inc()
+            if not suppress:
+                pending[parameter] = new_val
+                info[parameter] = {"queued": time.monotonic(), "attempts": 0, "desired": not record_desired, "priority": priority}
+                if confirmation is not None:
+                    self.confirmations.setdefault(uuid_string, []).append(confirmation)
+            if stream:
+                # Slow streams are committed later, so the commit does not fall between two stream values
+                now = time.monotonic()
+                interval = now - self.last_stream_update.get((uuid_string, target), 0)
+                commit_delay = max(self.stream_commit_delay, 2 * interval if interval < 5 else 0)
+                self.last_stream_update[(uuid_string, target)] = now
+                stream_state[parameter] = {"sent": False, "commit": now + commit_delay}
+        if suppress:
+            set_updates_suppressed.inc()
+            logger.debug("device with uuid:%s already reports %s: %s", uuid, parameter, new_val)
+            if record_desired:
+                self.update_desired_state(class_obj, uuid, parameter, new_val)
+            if confirmation is not None:
+                confirmation.finish(True)
+            return True
+        self.scheduler.schedule(uuid)
         return True
 
-    def get_event(self):
-        return self.event_queue.get() if not self.event_queue.empty() else None
+    def wait_for_confirmation(self, uuid: list[int], confirmation: SetConfirmation, timeout: float) -> Optional[bool]:
+        """
+        Waits up to timeout seconds until the device confirmed the value of a set_device_param call.
+        Returns True if confirmed, False if the command was given up, or None on timeout.
+        """
+        if not confirmation.event.wait(timeout):
+            with self.buffer_lock:
+                waiting = self.confirmations.get(str(uuid), [])
+                if confirmation in waiting:
+                    waiting.remove(confirmation)
+        return confirmation.confirmed
+
+    def record_desired_state(self, class_obj, uuid_string: str, uuid: list[int], sent: list[tuple[str, str]]):
+        """
+        Stores the values of the first SET message of every command as desired values.
+        This happens after the message was sent, so writing the DB does not delay the commands.
+        """
+        with self.buffer_lock:
+            pending = self.parameter_buffer.get(uuid_string, {})
+            info = self.command_info.get(uuid_string, {})
+            new = []
+            for key, value in sent:
+                # A newer value set during the send is recorded when it is sent
+                if pending.get(key) != value:
+                    continue
+                if (command := info.get(key)) is not None and not command.get("desired"):
+                    command["desired"] = True
+                    new.append((key, value))
+        for key, value in new:
+            self.update_desired_state(class_obj, uuid, key, value)
+
+    def update_desired_state(self, class_obj, uuid: list[int], parameter: str, new_val: str):
+        """
+        Stores new_val as the desired value of parameter
+        """
+        self.db_manager.update_desired_state(uuid, lambda state: class_obj.merge_desired(state, parameter, new_val))
@@ -0,0 +1,79 @@
+from typing import Optional
+
+
+class ConnectionHealth:
+    """
+    Tracks the share of messages received from a device by their msg_num.
+
+    The last window_size msg_nums are kept as a bitmap (bit i stands for latest_msg_num - i) together with
+    the number of set bits, so every message is handled in constant time. msg_num counts modulo 256:
+    a msg_num up to 127 ahead of the latest one is new, one within the window behind it arrived late,
+    anything else means the device started counting anew.
+    Alongside the window an exponentially decayed health covers the long term, every msg_num counts
+    with the weight alpha.
+    """
+
+    def __init__(self, window_size: int = 20, alpha: float = 0.01):
+        self.window_size = window_size
+        self.alpha = alpha
+        self.mask = (1 << window_size) - 1
+        self.bitmap = 0
+        self.received = 0
+        self.filled = 0  # Number of msg_nums the window covers, up to window_size
+        self.last: Optional[int] = None
+        self.longterm = 1.0
+
+    def reset(self):
+        """
+        Start anew with the next message, e.g. after the device rebooted
+        """
+        self.bitmap = 0
+        self.received = 0
+        self.filled = 0
+        self.last = None
+
+    def update(self, msg_num: int) -> bool:
+        """
+        Records a received msg_num. Returns False if it was already recorded.
+        """
+        if self.last is None:
+            self.bitmap, self.received, self.filled, self.last = 1, 1, 1, msg_num
+            return True
+        delta = (msg_num - self.last) % 256
+        if delta == 0:
+            return False
+
+        if delta < 128:
+            # New message, the msg_nums in between were lost
+            if delta >= self.window_size:
+                self.bitmap, self.received = 1, 1
+            else:
+                dropped = (self.bitmap >> (self.window_size - delta)).bit_count()
+                self.bitmap = ((self.bitmap << delta) & self.mask) | 1
+                self.received += 1 - dropped
+            self.filled = min(self.window_size, self.filled + delta)
+            self.last = msg_num
+            decay = (1 - self.alpha) ** delta
+            self.longterm = self.longterm * decay + self.alpha
+            return True
+
+        age = 256 - delta
+        if age >= self.filled:
+            # Too far behind to be a late message, the device counts from the beginning
+            self.reset()
+            return self.update(msg_num)
+        bit = 1 << age
+        if self.bitmap & bit:
+            return False
+        # Late message, it was counted as lost
+        self.bitmap |= bit
+        self.received += 1
+        self.longterm = min(1.0, self.longterm + self.alpha * (1 - self.alpha) ** age)
+        return True
+
+    @property
+    def health(self) -> float:
+        """
+        Share of the msg_nums in the window that were received
+        """
+        return self.received / self.filled if self.filled else 1.0
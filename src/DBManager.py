@@ -1,14 +1,21 @@
 from tinydb import TinyDB, Query
 from tinydb.table import Document, Table
 import random
+import time
 from threading import Lock
-from typing import Optional
+from typing import Callable, Optional
 
 from src.Logger import setup_logger
-import queue
+from src.Metrics import metrics
+from src.Tracing import tracer, MessageTrace
+from src.IdAllocator import IdAllocator
+from src.EventBus import event_bus
 
 logger = setup_logger()
 
+db_update_duration = metrics.histogram("nrf_db_update_seconds", "Time needed to update a device in the DB")
+db_writes = metrics.counter("nrf_db_writes_total", "Device updates written to the DB")
+
 
 class DBManager:
     def __init__(self):
@@ -21,15 +28,28 @@ class DBManager:
         # Initialize the devices_table attribute by calling the initialize_devices_table method
         self.devices_table = self.initialize_devices_table()
 
-        # Initialize the uuid attribute by calling the initialize_uuid method
-        self.uuid = self.initialize_uuid()
+        # Desired parameter values of the devices, as set through the API
+        self.desired_table = self.db.table("desired")
+
+        # Actions triggered by the events of remotes, see BindingManager
+        self.bindings_table = self.db.table("bindings")
 
-        # Queque to notify the mqttManager about changed parameters
-        self.changed_devices_queue = queue.Queue()
+        # Automations triggered by events and status fields, see RulesEngine
+        self.rules_table = self.db.table("rules")
 
-        # Make sure all devices get published to mqtt on startup
-        for device in self.get_all_devices():
-            self.changed_devices_queue.put((device["uuid"], device))
+        # Named sets of devices and the captured states of devices, see SceneManager
+        self.groups_table = self.db.table("groups")
+        self.scenes_table = self.db.table("scenes")
+
+        # Commands that run at set times and the time of their last run, see ScheduleManager
+        self.schedules_table = self.db.table("schedules")
+        self.schedule_runs_table = self.db.table("schedule_runs")
+
+        # Radio IDs of the devices, new devices get theirs reserved during pairing
+        self.id_allocator = IdAllocator(device["id"] for device in self.devices_table.all())
+
+        # Initialize the uuid attribute by calling the initialize_uuid method
+        self.uuid = self.initialize_uuid()
 
     def initialize_devices_table(self) -> Table:
         """
@@ -69,14 +89,17 @@ class DBManager:
 
     def get_free_id(self) -> Optional[int]:
         """
-        Search through all device IDs in the devices table to find an unused ID.
-        Returns the smallest unused ID.
+        Reserves the smallest ID that is neither used by a device nor reserved.
+        The ID stays reserved until the device is added or release_id is called.
         If no unused ID is found, it returns None.
         """
-        with self.db_lock:
-            all_ids = set(device["id"] for device in self.devices_table.all())
-        new_id = next((i for i in range(1, 255) if i not in all_ids), None)
-        return new_id
+        return self.id_allocator.reserve()
+
+    def release_id(self, device_id: int):
+        """
+        Frees an ID that was reserved by get_free_id for a device that was not added
+        """
+        self.id_allocator.release(device_id)
 
     def set_http_password(self, pw):
         "Sets the http_password. If an entry in the database already exists it gets updated."
@@ -98,7 +121,7 @@ class DBManager:
         with self.db_lock:
             search_result = self.db.search(Q.http_password.exists())
             if not search_result:
-                logger.warn(f"No HTTP password set!")
+                logger.warning("No HTTP password set!")
                 return False
             else:
                 return search_result[0]["http_password"] == pw
@@ -150,21 +173,25 @@ class DBManager:
         try:
             with self.db_lock:
                 self.devices_table.insert(device_dict)
+            self.id_allocator.mark_used(device_dict["id"])
 
-            self.changed_devices_queue.put((device_dict["uuid"], device_dict))
+            event_bus.publish("state", device_dict["uuid"], device_dict)
             logger.info(f"Device {device_dict['type']} added!")
         except Exception as e:
             logger.error(f"Unexpected error while adding device to DB: {e}")
 
-    def update_device_in_db(self, device_dict: dict):
+    def update_device_in_db(self, device_dict: dict, trace: Optional[MessageTrace] = None):
         """
-        Updates a device's information in the database.
+        Updates a device's information in the database, device_dict may only contain some of the fields.
+        If the update contains changes, they are published on the event_bus together with the trace.
         """
         Q = Query()
         uuid = device_dict["uuid"]
+        start_time = time.perf_counter()
         try:
             device = self.search_device_in_db(uuid)
-            if not device or device == device_dict:
+            if not device or all(device.get(key) == value for key, value in device_dict.items()):
+                tracer.finish(trace, "db")
                 return
             
             # Extract changes
@@ -180,15 +207,22 @@ class DBManager:
                     else:
                         changes[key] = value
 
-            if changes != {}:
-                self.changed_devices_queue.put((uuid, changes))
-
             # Update DB
             with self.db_lock:
                 self.devices_table.update(device_dict, Q.uuid == uuid)
+            db_writes.inc()
+            db_update_duration.observe(time.perf_counter() - start_time)
+
+            if changes != {}:
+                if trace is not None:
+                    trace.mark("db")
+                event_bus.publish("state", uuid, changes, trace)
+            else:
+                tracer.finish(trace, "db")
             
         except Exception as e:
             logger.error(f"Unexpected error while updating device in DB: {e}")
+            tracer.finish(trace, "db")
 
     def remove_device_from_db(self, device_uuid: list[int]):
         """
@@ -198,16 +232,23 @@ class DBManager:
         Q = Query()
         try:
             with self.db_lock:
+                removed = self.devices_table.search(Q.uuid == device_uuid)
                 self.devices_table.remove(Q.uuid == device_uuid)
+                self.desired_table.remove(Q.uuid == device_uuid)
+                self.bindings_table.remove((Q.remote == device_uuid) | (Q.target == device_uuid))
+                self.rules_table.remove(Q.trigger.uuid == device_uuid)
+            for device in removed:
+                self.id_allocator.release(device["id"])
         except Exception as e:
             logger.error(f"Unexpected error while removing device in DB: {e}")
 
-    def update_device_offline_status(self, device_uuid: list[int], status: bool):
+    def update_device_offline_status(self, device_uuid: list[int], status: bool) -> bool:
         """
         Set a Device's online status.
 
         :param device_uuid: The UUID of the device.
         :param status: The offline status to set (True for offline, False for online).
+        :return: Whether the device had the opposite status before.
         """
         try:
             # Find the device with the given UUID
@@ -219,11 +260,221 @@ class DBManager:
                     logger.info(f"Set Offline Status of Device with uuid {device_uuid} to {status}")
                     device["offline"] = status
                     self.update_device_in_db(device)
+                    return current_status is not None
             else:
                 logger.error(f"Device with uuid {device_uuid} not found in DB")
         except Exception as e:
             logger.error(f"Unexpected error for device in DB: {e}, {type(e).__name__}")
+        return False
+
+    def get_desired_state(self, device_uuid: list[int]) -> dict:
+        """
+        Returns the desired parameter values of a device by parameter
+        """
+        Q = Query()
+        try:
+            with self.db_lock:
+                result = self.desired_table.search(Q.uuid == device_uuid)
+            return dict(result[0]["state"]) if result else {}
+        except Exception as e:
+            logger.error(f"Error occurred while reading desired state: {e}")
+            return {}
 
+    def update_desired_state(self, device_uuid: list[int], update: Callable[[dict], None]):
+        """
+        Changes the desired state of a device. update is called with the current state and modifies it in place.
+        """
+        Q = Query()
+        try:
+            with self.db_lock:
+                result = self.desired_table.search(Q.uuid == device_uuid)
+                state = dict(result[0]["state"]) if result else {}
+                update(state)
+                self.desired_table.upsert({"uuid": device_uuid, "state": state}, Q.uuid == device_uuid)
+        except Exception as e:
+            logger.error(f"Unexpected error while updating desired state: {e}")
+
+    def update_desired_states(self, updates: dict[str, tuple[list[int], Callable[[dict], None]]]):
+        """
+        Changes the desired states of several devices with a single write. updates contains the uuid and the
+        update function (see update_desired_state) by uuid_string.
+        """
+        Q = Query()
+        try:
+            with self.db_lock:
+                states = {str(doc["uuid"]): dict(doc["state"]) for doc in self.desired_table.all()}
+                docs = []
+                for uuid_string, (uuid, update) in updates.items():
+                    state = states.get(uuid_string, {})
+                    update(state)
+                    docs.append({"uuid": uuid, "state": state})
+                self.desired_table.remove(Q.uuid.one_of([uuid for uuid, _ in updates.values()]))
+                self.desired_table.insert_multiple(docs)
+        except Exception as e:
+            logger.error(f"Unexpected error while updating desired states: {e}")
+
+    def get_bindings(self) -> list[dict]:
+        """
+        Returns all bindings, every binding contains its id
+        """
+        with self.db_lock:
+            return [dict(binding, id=binding.doc_id) for binding in self.bindings_table.all()]
+
+    def add_binding(self, binding: dict) -> Optional[int]:
+        """
+        Stores a binding and returns its id
+        """
+        try:
+            with self.db_lock:
+                return self.bindings_table.insert(binding)
+        except Exception as e:
+            logger.error(f"Unexpected error while adding binding to DB: {e}")
+            return None
+
+    def remove_binding(self, binding_id: int) -> bool:
+        """
+        Removes a binding, returns False if it did not exist
+        """
+        with self.db_lock:
+            if not self.bindings_table.contains(doc_id=binding_id):
+                return False
+            self.bindings_table.remove(doc_ids=[binding_id])
+        return True
+
+    def get_rules(self) -> list[dict]:
+        """
+        Returns all rules, every rule contains its id
+        """
+        with self.db_lock:
+            return [dict(rule, id=rule.doc_id) for rule in self.rules_table.all()]
+
+    def add_rule(self, rule: dict) -> Optional[int]:
+        """
+        Stores a rule and returns its id
+        """
+        try:
+            with self.db_lock:
+                return self.rules_table.insert(rule)
+        except Exception as e:
+            logger.error(f"Unexpected error while adding rule to DB: {e}")
+            return None
+
+    def remove_rule(self, rule_id: int) -> bool:
+        """
+        Removes a rule, returns False if it did not exist
+        """
+        with self.db_lock:
+            if not self.rules_table.contains(doc_id=rule_id):
+                return False
+            self.rules_table.remove(doc_ids=[rule_id])
+        return True
+
+    def get_schedules(self) -> list[dict]:
+        """
+        Returns all schedules, every schedule contains its id
+        """
+        with self.db_lock:
+            return [dict(schedule, id=schedule.doc_id) for schedule in self.schedules_table.all()]
+
+    def add_schedule(self, schedule: dict) -> Optional[int]:
+        """
+        Stores a schedule and returns its id
+        """
+        try:
+            with self.db_lock:
+                return self.schedules_table.insert(schedule)
+        except Exception as e:
+            logger.error(f"Unexpected error while adding schedule to DB: {e}")
+            return None
+
+    def remove_schedule(self, schedule_id: int) -> bool:
+        """
+        Removes a schedule, returns False if it did not exist
+        """
+        with self.db_lock:
+            if not self.schedules_table.contains(doc_id=schedule_id):
+                return False
+            self.schedules_table.remove(doc_ids=[schedule_id])
+        return True
+
+    def get_schedule_runs(self) -> dict[str, float]:
+        """
+        Returns the time of the last run of the schedules by id
+        """
+        with self.db_lock:
+            result = self.schedule_runs_table.all()
+        return dict(result[0]["runs"]) if result else {}
+
+    def save_schedule_runs(self, runs: dict[str, float]):
+        """
+        Stores the time of the last run of schedules by id. The runs of all schedules are kept in a single
+        document, so they are written at once. Runs of removed schedules are dropped.
+        """
+        try:
+            with self.db_lock:
+                result = self.schedule_runs_table.all()
+                stored = dict(result[0]["runs"]) if result else {}
+                stored.update(runs)
+                existing = {str(schedule.doc_id) for schedule in self.schedules_table.all()}
+                stored = {key: value for key, value in stored.items() if key in existing}
+                if result:
+                    self.schedule_runs_table.update({"runs": stored}, doc_ids=[result[0].doc_id])
+                else:
+                    self.schedule_runs_table.insert({"runs": stored})
+        except Exception as e:
+            logger.error(f"Unexpected error while saving schedule runs: {e}")
+
+    def get_groups(self) -> list[dict]:
+        with self.db_lock:
+            return [dict(group) for group in self.groups_table.all()]
+
+    def get_group(self, name: str) -> Optional[dict]:
+        with self.db_lock:
+            result = self.groups_table.search(Query().name == name)
+        return dict(result[0]) if result else None
+
+    def save_group(self, group: dict):
+        """
+        Stores a group, a group with the same name is replaced
+        """
+        try:
+            with self.db_lock:
+                self.groups_table.upsert(group, Query().name == group["name"])
+        except Exception as e:
+            logger.error(f"Unexpected error while saving group: {e}")
+
+    def remove_group(self, name: str) -> bool:
+        """
+        Removes a group, returns False if it did not exist
+        """
+        with self.db_lock:
+            return bool(self.groups_table.remove(Query().name == name))
+
+    def get_scenes(self) -> list[dict]:
+        with self.db_lock:
+            return [dict(scene) for scene in self.scenes_table.all()]
+
+    def get_scene(self, name: str) -> Optional[dict]:
+        with self.db_lock:
+            result = self.scenes_table.search(Query().name == name)
+        return dict(result[0]) if result else None
+
+    def save_scene(self, scene: dict):
+        """
+        Stores a scene, a scene with the same name is replaced
+        """
+        try:
+            with self.db_lock:
+                self.scenes_table.upsert(scene, Query().name == scene["name"])
+        except Exception as e:
+            logger.error(f"Unexpected error while saving scene: {e}")
+
+    def remove_scene(self, name: str) -> bool:
+        """
+        Removes a scene, returns False if it did not exist
+        """
+        with self.db_lock:
+            return bool(self.scenes_table.remove(Query().name == name))
 
     def update_device_name(self, device_uuid: list[int], new_name: str):
         """
@@ -239,9 +490,9 @@ class DBManager:
         except Exception as e:
             logger.error(f"Unexpected error for device in DB: {e}")
 
-    def update_connection_health(self, device_uuid: list[int], health: float):
+    def update_connection_health(self, device_uuid: list[int], health: float, longterm: Optional[float] = None):
         """
-        Change the connection_health of a Device using the given UUID
+        Change the connection_health (and the long term connection_health_longterm) of a Device using the given UUID
         """
         # logger.info(f"Changing connection_health of Device with uuid {device_uuid} to {health}")
         try:
@@ -249,9 +500,8 @@ class DBManager:
             device = self.search_device_in_db(device_uuid)
             if device:
                 device["connection_health"] = round(health, 2)
+                if longterm is not None:
+                    device["connection_health_longterm"] = round(longterm, 2)
                 self.update_device_in_db(device)
         except Exception as e:
             logger.error(f"Unexpected error for device in DB: {e}")
-
-    def get_changes(self) -> Optional[tuple[str,Document]]:
-        return self.changed_devices_queue.get() if not self.changed_devices_queue.empty() else None
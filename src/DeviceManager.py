@@ -1,19 +1,21 @@
-from nrf24USB import NRF24Device
+from nrf24USB import NRF24Device, TxRequest, TX_PRIORITY, TX_STATUS
 from nrf24Smart import DeviceMessage, HostMessage, MSG_TYPES, supported_devices, DeviceStatus
-import time
 from typing import Type, Optional
 from src.DBManager import DBManager
-from threading import Lock
 from src.Logger import setup_logger
+from src.Metrics import metrics
 import os
+import time
 
 logger = setup_logger()
 
+send_duration = metrics.histogram(
+    "nrf_send_msg_duration_seconds", "Round trip time of acknowledged messages sent to devices"
+)
+send_failures = metrics.counter("nrf_send_msg_failures_total", "Messages to devices that were not acknowledged")
+
 class DeviceManager:
     def __init__(self, db_manager: DBManager, device_port = None, nrf_channel = 101):
-        # Initialize the lock
-        self.comm_lock = Lock()
-
         # Reference to the DBManager instance to handle DB operations
         self.db_manager = db_manager
 
@@ -30,6 +32,45 @@ class DeviceManager:
         self.device = NRF24Device(device_port, channel=nrf_channel, address=0)
         if self.device.error:
             raise ConnectionError("Error with the NRF24USB device")
+        self.register_metrics()
+
+    def register_metrics(self):
+        """
+        Export the statistics the NRF24Device and its PacketReader keep on their own
+        """
+        device = self.device
+        reader = device.reader
+        metrics.counter("nrf_frames_received_total", "Frames received from the NRF24USB device").set_function(
+            lambda: reader.frames_received
+        )
+        metrics.counter("nrf_frames_decoded_total", "Frames successfully decoded").set_function(
+            lambda: reader.frames_decoded
+        )
+        metrics.counter("nrf_frames_invalid_total", "Frames that could not be decoded").set_function(
+            lambda: reader.frames_invalid
+        )
+        metrics.counter("nrf_msgs_sent_total", "Messages sent to devices").set_function(lambda: device.msgs_sent)
+        metrics.counter("nrf_ack_timeouts_total", "Sent messages without a response from the NRF24USB device").set_function(
+            lambda: device.ack_timeouts
+        )
+        metrics.counter("nrf_send_errors_total", "Sent messages the NRF24USB device reported as failed").set_function(
+            lambda: device.send_errors
+        )
+        metrics.gauge("nrf_msg_queue_depth", "Received messages waiting to be processed").set_function(
+            device.msg_queue.qsize
+        )
+        tx_queue_depth = metrics.gauge("nrf_tx_queue_depth", "Messages waiting to be written", ("priority",))
+        tx_sent = metrics.counter("nrf_tx_sent_total", "Messages taken from the TX queue", ("priority",))
+        tx_wait = metrics.gauge(
+            "nrf_tx_wait_seconds_max", "Longest time a message waited in the TX queue", ("priority",)
+        )
+        tx_queue = device.tx_queue
+        for priority in TX_PRIORITY:
+            lane = tx_queue.lanes[priority]
+            name = priority.name.lower()
+            tx_queue_depth.labels(name).set_function(lambda lane=lane: len(lane.queue))
+            tx_sent.labels(name).set_function(lambda lane=lane: lane.sent)
+            tx_wait.labels(name).set_function(lambda lane=lane: lane.max_wait)
 
 
     def start(self):
@@ -47,58 +88,87 @@ class DeviceManager:
     def get_supported_device(cls, device_type: str) -> Optional[Type[DeviceStatus]]:
         # Check if the class exists in the supported_devices list
         if not any(hasattr(cls, "__name__") and cls.__name__ == device_type for cls in supported_devices):
-            logger.error(f"Device type {device_type} not supported!")
+            logger.error("Device type %s not supported!", device_type, extra={"device": device_type})
             return None
         # Get the class object by name
         return next((cls for cls in supported_devices if cls.__name__ == device_type))
 
-    def send_msg_to_device(self, device_id: int, raw_msg: list[int], require_ack = True):
+    def send_msg_to_device(
+        self, device_id: int, raw_msg: list[int], require_ack = True, priority: TX_PRIORITY = TX_PRIORITY.INTERACTIVE
+    ):
         """
         Sends a message to a device given its device ID and the raw message data.
+        The message is queued for the write loop of the NRF24Device, receiving is not blocked while waiting for the ack.
+        Returns the response on success or None otherwise.
         """
-        with self.comm_lock:
-            return self.device.send_msg(device_id, raw_msg, require_ack)
+        request = self.send_request_to_device(device_id, raw_msg, require_ack, priority)
+        if request.status is TX_STATUS.OK:
+            return request.response
+        if request.status is TX_STATUS.SENT:
+            return []
+        return None
+
+    def send_msg_to_device_async(
+        self, device_id: int, raw_msg: list[int], require_ack = True, priority: TX_PRIORITY = TX_PRIORITY.INTERACTIVE
+    ) -> TxRequest:
+        """
+        Queues a message for a device and returns immediately, the TxRequest tells the result once it was written.
+        """
+        return self.device.send_msg_async(device_id, raw_msg, require_ack, priority)
 
-    def init_new_device(self, msg: DeviceMessage):
+    def send_request_to_device(
+        self, device_id: int, raw_msg: list[int], require_ack = True, priority: TX_PRIORITY = TX_PRIORITY.INTERACTIVE
+    ) -> TxRequest:
+        """
+        Like send_msg_to_device, but returns the finished TxRequest so the caller can tell
+        a missing acknowledgement of the device (ERROR) from a NRF24USB device that did not respond (TIMEOUT).
+        """
+        start_time = time.perf_counter()
+        request = self.device.wait_for_result(self.device.send_msg_async(device_id, raw_msg, require_ack, priority))
+        if request.status in (TX_STATUS.ERROR, TX_STATUS.TIMEOUT):
+            send_failures.inc()
+        elif require_ack:
+            send_duration.observe(time.perf_counter() - start_time)
+        return request
+
+    def check_new_device(self, msg: DeviceMessage) -> Optional[str]:
         """
-        Given a DeviceMessage, it initializes a new device.
-        The device type is checked, if a device with the UUID exists and gets a new ID, and the new device is added to the DB.
+        Given the INIT DeviceMessage of a new device, checks that its type and firmware version are supported
+        and that no device with its UUID exists. Returns the device type, or None if it can not be initialized.
         """
         device_type = bytes(msg.DATA).decode(errors="ignore")
-        logger.info(f"New Device: {device_type} {msg}")
+        logger.info("New Device: %s %s", device_type, msg)
 
         # Check if the class exists in the supported_devices list
         if (device_class := self.get_supported_device(device_type)) == None:
-            logger.warning(f"New Device {device_type} not in supported_devices list!")
-            return
+            logger.warning("New Device %s not in supported_devices list!", device_type)
+            return None
 
         # Check if device firmware version is supported
         if msg.FIRMWARE_VERSION not in device_class.supported_versions:
-            logger.warning(f"New Device {device_type} has unsupported version {msg.FIRMWARE_VERSION}")
-            return
+            logger.warning("New Device %s has unsupported version %s", device_type, msg.FIRMWARE_VERSION)
+            return None
 
         # Check if a device with the UUID exists
         result = self.db_manager.search_device_in_db(msg.UUID)
         if result:
-            logger.warn(f"Device with uuid:{msg.UUID} already in DB!")
-            return
-
-        # Get smallest free id between 1 and 254:
-        new_id = self.db_manager.get_free_id()
-        if new_id is None:
-            logger.error("No free ID available")
-            return
-        logger.info(f"New device ID:{new_id}")
-
-        # Send new ID to device
-        time.sleep(0.5)
-        to_send_msg = HostMessage(uuid=self.db_manager.uuid, msg_type=MSG_TYPES.INIT, data=[new_id])
-        logger.info(f"Sending new ID to {msg.ID} with data: {to_send_msg.get_raw()}")
-        if self.send_msg_to_device(msg.ID, to_send_msg.get_raw()) == None:
-            logger.error(f"Failed to initialize device {device_type}")
-            return
-
-        # Add new Device
+            logger.warning("Device with uuid:%s already in DB!", msg.UUID, extra={"device": msg.UUID})
+            return None
+        return device_type
+
+    def send_new_id(self, msg: DeviceMessage, new_id: int) -> bool:
+        """
+        Answers the INIT message of a new device with its new ID. Returns whether the device acknowledged it.
+        """
+        # The UUID of the device lets other new devices that listen at the same time ignore the answer
+        to_send_msg = HostMessage(uuid=self.db_manager.uuid, msg_type=MSG_TYPES.INIT, data=[new_id] + list(msg.UUID))
+        logger.info("Sending new ID to %s with data: %s", msg.ID, to_send_msg.get_raw())
+        return self.send_msg_to_device(msg.ID, to_send_msg.get_raw(), priority=TX_PRIORITY.BACKGROUND) is not None
+
+    def add_new_device(self, msg: DeviceMessage, device_type: str, new_id: int):
+        """
+        Adds a device that acknowledged its new ID to the DB
+        """
         self.db_manager.add_device_to_db(
             {
                 "uuid": msg.UUID,
@@ -113,10 +183,9 @@ class DeviceManager:
             }
         )
 
-    def get_device_message(self):
+    def get_device_message(self, timeout: float = 0) -> Optional[tuple[list[int], float]]:
         """
-        Get a device message from the NRF24Device.
-        The method returns None if no message is available.
+        Get a device message from the NRF24Device together with its time.monotonic() arrival time.
+        Waits up to timeout seconds for a message. The method returns None if no message is available.
         """
-        with self.comm_lock:
-            return self.device.get_message()
+        return self.device.get_timed_message(timeout)
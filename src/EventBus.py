@@ -0,0 +1,206 @@
+import time
+from collections import deque
+from threading import Condition, Lock
+from typing import Callable, Iterable, Optional
+
+from src.Logger import setup_logger
+from src.Metrics import metrics
+from src.Tracing import tracer, MessageTrace
+
+logger = setup_logger()
+
+bus_published = metrics.counter("nrf_bus_published_total", "Events published on the event bus", ("topic",))
+bus_delivered = metrics.counter("nrf_bus_delivered_total", "Events handed to the subscribers", ("subscriber",))
+bus_dropped = metrics.counter(
+    "nrf_bus_dropped_total", "Events a subscriber lost because its buffer was full", ("subscriber",)
+)
+bus_buffered = metrics.gauge(
+    "nrf_bus_buffered_events", "Events waiting in the buffers of the subscribers", ("subscriber",)
+)
+bus_subscribers = metrics.gauge("nrf_bus_subscribers", "Subscribers of the event bus")
+
+OVERFLOW_POLICIES = ("drop_oldest", "drop_newest", "close")
+
+
+class BusEvent:
+    """
+    An event on the EventBus. The topic is "state" for changed fields of a device (data is a dict with the
+    changes) or "remote" for the events of remotes (data is the name of the event, e.g. "toggle").
+    trace is the MessageTrace of the received message that caused the event, if it was traced.
+    """
+
+    __slots__ = ("topic", "uuid", "data", "time", "trace")
+
+    def __init__(self, topic: str, uuid: list[int], data, trace: Optional[MessageTrace] = None):
+        self.topic = topic
+        self.uuid = uuid
+        self.data = data
+        self.time = time.time()
+        self.trace = trace
+
+    def to_dict(self) -> dict:
+        return {"topic": self.topic, "uuid": self.uuid, "data": self.data, "time": self.time}
+
+
+class Subscription:
+    """
+    A subscriber of the EventBus, created with EventBus.subscribe.
+
+    The events that match topics, uuid and events (None matches everything) are passed to the callback on
+    the publishing thread, the callback has to return quickly. Without a callback they are buffered until
+    they are fetched with get. A full buffer applies the overflow policy: "drop_oldest" and "drop_newest"
+    drop an event, "close" ends the subscription, e.g. for a client that does not keep up.
+
+    A traced subscriber takes over the traces of its events and has to end them with tracer.finish once it
+    handled an event, the traces of the events it drops end as "dropped". At most one subscriber of an
+    event may be traced.
+    """
+
+    def __init__(
+        self,
+        bus: "EventBus",
+        name: str,
+        callback: Optional[Callable[[BusEvent], None]],
+        topics: Optional[Iterable[str]],
+        uuid: Optional[list[int]],
+        events: Optional[Iterable[str]],
+        maxsize: int,
+        overflow: str,
+        traced: bool,
+    ):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy {overflow}")
+        self.bus = bus
+        self.name = name
+        self.callback = callback
+        self.topics = set(topics) if topics is not None else None
+        self.uuid = uuid
+        self.events = set(events) if events is not None else None
+        self.maxsize = maxsize
+        self.overflow = overflow
+        self.traced = traced
+        self.buffer = deque()
+        self.condition = Condition()
+        self.closed = False
+        self.delivered = bus_delivered.labels(name)
+        self.dropped = bus_dropped.labels(name)
+
+    def matches(self, event: BusEvent) -> bool:
+        if self.topics is not None and event.topic not in self.topics:
+            return False
+        if self.uuid is not None and event.uuid != self.uuid:
+            return False
+        if self.events is not None and (event.topic != "remote" or event.data not in self.events):
+            return False
+        return True
+
+    def drop(self, event: BusEvent):
+        self.dropped.inc()
+        if self.traced:
+            tracer.finish(event.trace, "dropped")
+
+    def deliver(self, event: BusEvent):
+        if self.callback is not None:
+            try:
+                self.callback(event)
+            except Exception as e:
+                logger.exception(e)
+            self.delivered.inc()
+            return
+
+        with self.condition:
+            if self.closed:
+                if self.traced:
+                    tracer.finish(event.trace, "dropped")
+                return
+            if len(self.buffer) >= self.maxsize:
+                if self.overflow == "drop_newest":
+                    self.drop(event)
+                    return
+                if self.overflow == "close":
+                    logger.warning("Subscriber %s did not keep up and was closed", self.name)
+                    self.drop(event)
+                    self.closed = True
+                    self.condition.notify_all()
+                    return
+                self.drop(self.buffer.popleft())
+            self.buffer.append(event)
+            self.condition.notify()
+        self.delivered.inc()
+
+    def get(self, timeout: Optional[float] = None) -> Optional[BusEvent]:
+        """
+        Waits up to timeout seconds for the next event. Returns None on timeout or once the subscription is closed.
+        """
+        with self.condition:
+            if not self.buffer and not self.closed:
+                self.condition.wait(timeout)
+            return self.buffer.popleft() if self.buffer else None
+
+    def qsize(self) -> int:
+        return len(self.buffer)
+
+    def close(self):
+        self.bus.unsubscribe(self)
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+
+class EventBus:
+    """
+    Publishes the state changes of devices and the events of remotes to any number of subscribers.
+    The list of subscriptions is replaced on every change, so publish does not need a lock.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.subscriptions: tuple[Subscription, ...] = ()
+        bus_subscribers.set_function(lambda: len(self.subscriptions))
+
+    def subscribe(
+        self,
+        name: str,
+        callback: Optional[Callable[[BusEvent], None]] = None,
+        topics: Optional[Iterable[str]] = None,
+        uuid: Optional[list[int]] = None,
+        events: Optional[Iterable[str]] = None,
+        maxsize: int = 1000,
+        overflow: str = "drop_oldest",
+        traced: bool = False,
+    ) -> Subscription:
+        """
+        Subscribes to the events matching topics, uuid and events, see Subscription
+        """
+        subscription = Subscription(self, name, callback, topics, uuid, events, maxsize, overflow, traced)
+        with self.lock:
+            self.subscriptions += (subscription,)
+        bus_buffered.labels(name).set_function(lambda: self.get_buffered(name))
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        with self.lock:
+            self.subscriptions = tuple(s for s in self.subscriptions if s is not subscription)
+
+    def get_buffered(self, name: str) -> int:
+        return sum(s.qsize() for s in self.subscriptions if s.name == name)
+
+    def publish(self, topic: str, uuid: list[int], data, trace: Optional[MessageTrace] = None):
+        """
+        Hands an event to all matching subscribers. The trace of the message that caused it is handed on to
+        the traced subscriber, without one it ends here.
+        """
+        if trace is not None:
+            trace.mark("publish")
+        event = BusEvent(topic, uuid, data, trace)
+        handed_on = False
+        for subscription in self.subscriptions:
+            if subscription.matches(event):
+                handed_on |= subscription.traced
+                subscription.deliver(event)
+        bus_published.labels(topic).inc()
+        if not handed_on:
+            tracer.finish(trace)
+
+
+event_bus = EventBus()
@@ -0,0 +1,41 @@
+from threading import Lock
+from typing import Iterable, Optional
+
+
+class IdAllocator:
+    """
+    Hands out the radio IDs of devices. Bit i of the bitmap is set if ID i is in use or reserved,
+    the smallest free ID is found with bit operations instead of scanning all devices.
+    ID 0 is the server and 255 the ID of devices that were not initialized yet, neither is handed out.
+    """
+
+    def __init__(self, used: Iterable[int] = (), first: int = 1, last: int = 254):
+        self.lock = Lock()
+        self.mask = ((1 << (last + 1)) - 1) & ~((1 << first) - 1)
+        self.bitmap = 0
+        for device_id in used:
+            self.mark_used(device_id)
+
+    def reserve(self) -> Optional[int]:
+        """
+        Reserves the smallest free ID and returns it, or None if all IDs are taken
+        """
+        with self.lock:
+            free = ~self.bitmap & self.mask
+            if not free:
+                return None
+            lowest = free & -free
+            self.bitmap |= lowest
+            return lowest.bit_length() - 1
+
+    def mark_used(self, device_id: int):
+        with self.lock:
+            self.bitmap |= (1 << device_id) & self.mask
+
+    def release(self, device_id: int):
+        with self.lock:
+            self.bitmap &= ~(1 << device_id)
+
+    def num_free(self) -> int:
+        with self.lock:
+            return (~self.bitmap & self.mask).bit_count()
@@ -0,0 +1,114 @@
+import heapq
+import time
+from threading import Condition, Event
+from typing import Optional
+
+from src.DBManager import DBManager
+from src.Logger import setup_logger
+from src.Metrics import metrics
+
+logger = setup_logger()
+
+liveness_transitions = metrics.counter(
+    "nrf_liveness_transitions_total", "Devices that went offline or came back detected by their status interval", ("state",)
+)
+
+
+class LivenessTracker:
+    """
+    Marks devices offline that did not send a message for longer than their status_interval allows.
+
+    Every message moves the deadline of its device to missed_intervals status intervals plus grace seconds
+    from now. The deadlines are kept in a heap, replaced deadlines stay in it and are skipped when they
+    come up, so a message costs O(log n) and nothing scans all devices. A device whose deadline passed is
+    marked offline once and not tracked anymore until it is heard again.
+    """
+
+    def __init__(self, db_manager: DBManager, shutdown_flag: Event, missed_intervals: float = 3, grace: float = 2.0):
+        self.db_manager = db_manager
+        self.shutdown_flag = shutdown_flag
+        self.missed_intervals = missed_intervals
+        self.grace = grace
+        self.heap = []
+        self.deadlines = {}
+        self.status_intervals = {}
+        self.num_scheduled = 0
+        self.condition = Condition()
+        metrics.gauge("nrf_liveness_tracked_devices", "Online devices with a liveness deadline").set_function(
+            lambda: len(self.deadlines)
+        )
+
+        # Devices that are online in the DB have to report within their interval after a restart
+        for device in self.db_manager.get_all_devices():
+            if not device.get("offline"):
+                self.seen(device["uuid"], device.get("status_interval"))
+
+    def seen(self, uuid: list[int], status_interval: Optional[int] = None):
+        """
+        Called for every message of a device. Without status_interval the last known one is used,
+        a device that does not send its status periodically (interval 0) is not tracked.
+        """
+        uuid_string = str(uuid)
+        with self.condition:
+            if status_interval is None:
+                status_interval = self.status_intervals.get(uuid_string)
+            else:
+                self.status_intervals[uuid_string] = status_interval
+            if not status_interval:
+                self.deadlines.pop(uuid_string, None)
+                return
+            deadline = time.monotonic() + self.missed_intervals * status_interval + self.grace
+            earliest = not self.heap or deadline < self.heap[0][0]
+            self.deadlines[uuid_string] = deadline
+            self.num_scheduled += 1
+            heapq.heappush(self.heap, (deadline, self.num_scheduled, uuid_string, uuid))
+            if earliest:
+                self.condition.notify()
+
+    def forget(self, uuid: list[int]):
+        """
+        Stops tracking a device, e.g. after it was removed
+        """
+        with self.condition:
+            self.deadlines.pop(str(uuid), None)
+            self.status_intervals.pop(str(uuid), None)
+
+    def get_expired(self, timeout: float) -> Optional[list[int]]:
+        """
+        Waits up to timeout seconds for a device to miss its deadline and returns its uuid.
+        """
+        end = time.monotonic() + timeout
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                # Skip deadlines that were moved by a newer message
+                while self.heap and self.deadlines.get(self.heap[0][2]) != self.heap[0][0]:
+                    heapq.heappop(self.heap)
+                if self.heap and self.heap[0][0] <= now:
+                    _, _, uuid_string, uuid = heapq.heappop(self.heap)
+                    del self.deadlines[uuid_string]
+                    return uuid
+                if now >= end:
+                    return None
+                wait = end - now
+                if self.heap:
+                    wait = min(wait, self.heap[0][0] - now)
+                self.condition.wait(wait)
+
+    def run(self):
+        """
+        Marks the devices that missed their deadline offline until the shutdown_flag is set.
+        """
+        while not self.shutdown_flag.is_set():
+            uuid = self.get_expired(timeout=0.5)
+            if uuid is None:
+                continue
+            if self.db_manager.update_device_offline_status(uuid, True):
+                logger.warning("Device with uuid:%s missed its status interval", uuid, extra={"device": uuid})
+                liveness_transitions.labels("offline").inc()
+            # A message that arrived while the DB was written already marked the device online again
+            with self.condition:
+                heard_again = str(uuid) in self.deadlines
+            if heard_again:
+                self.db_manager.update_device_offline_status(uuid, False)
+        logger.info("Stopped liveness tracking")
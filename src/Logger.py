@@ -1,19 +1,24 @@
 import logging
-from logging.handlers import QueueHandler
+from logging.handlers import QueueHandler, QueueListener
+from collections import deque
 import colorlog
+import threading
+import atexit
 import json
 import queue
+import time
+from typing import Optional
 
+from src.Metrics import metrics
 
-class RotatingQueue(queue.Queue):
-    def put(self, item, block=True, timeout=None):
-        # If the queue is full, remove the oldest item
-        if self.full():
-            self.get_nowait()
-        super(RotatingQueue, self).put(item, block, timeout)
 
+# Ring of the latest pre-serialised JSON log entries for the web UI
+log_ring = deque(maxlen=5000)
 
-log_queue = RotatingQueue(5000)
+# Queue between the logging threads and the QueueListener
+log_record_queue = queue.SimpleQueue()
+log_listener = None
+rate_limit_filter = None
 
 
 # Create a custom JSON Formatter
@@ -27,7 +32,7 @@ class JsonFormatter(logging.Formatter):
             # Add other fields as needed
         }
         return json.dumps(log_entry)
-    
+
 
 # Create a custom filter function for ignoring flask logs
 class IgnoreFlaskLogs(logging.Filter):
@@ -35,7 +40,144 @@ class IgnoreFlaskLogs(logging.Filter):
         return not ('flask' in record.name or 'werkzeug' in record.name)
 
 
+class RateLimitFilter(logging.Filter):
+    """
+    Suppresses repeated log messages.
+    Messages are grouped by logger, message template and device. The device is taken from
+    extra={"device": ...} if the call provides it, otherwise all arguments are part of the key.
+    The dropped messages are counted per logger, the templates would give the metric a label value
+    for every message that is formatted before the call.
+    The first message of a group is let through, repeats within window seconds are counted and
+    dropped. The counts are logged as a summary by a timer summary_interval seconds after the previous
+    summary, so they are also reported when the repeats stopped. stop_logger logs the remaining counts.
+    """
+
+    def __init__(self, window: float = 60.0, summary_interval: float = 60.0, min_level: int = logging.WARNING):
+        super().__init__()
+        self.window = window
+        self.summary_interval = summary_interval
+        self.min_level = min_level
+        self.last_emitted = {}
+        self.suppressed = {}
+        self.last_summary = time.monotonic()
+        # Pending while there are suppressed messages
+        self.timer: Optional[threading.Timer] = None
+        self.lock = threading.Lock()
+        self.in_summary = threading.local()
+        self.suppressed_total = metrics.counter(
+            "nrf_log_suppressed_total", "Repeated log messages dropped by the RateLimitFilter", ("logger",)
+        )
+
+    def filter(self, record):
+        if record.levelno < self.min_level or getattr(self.in_summary, "active", False):
+            return True
+
+        device = getattr(record, "device", None)
+        if device is not None:
+            device = str(device)
+        elif record.args:
+            device = repr(record.args)
+        key = (record.name, record.msg, device)
+        now = time.monotonic()
+        with self.lock:
+            last = self.last_emitted.get(key)
+            emit = last is None or now - last > self.window
+            if emit:
+                self.last_emitted[key] = now
+            else:
+                self.suppressed[key] = self.suppressed.get(key, 0) + 1
+                if self.timer is None:
+                    delay = max(0.0, self.last_summary + self.summary_interval - now)
+                    self.timer = threading.Timer(delay, self.flush)
+                    self.timer.daemon = True
+                    self.timer.start()
+            if self.timer is None and now - self.last_summary > self.summary_interval:
+                # Nothing to report, only forget about expired groups
+                self.create_summary(now)
+
+        if not emit:
+            self.suppressed_total.labels(record.name).inc()
+        return emit
+
+    def flush(self):
+        """
+        Logs the summary of the suppressed messages, if there are any
+        """
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            summary = self.create_summary(time.monotonic())
+        if summary:
+            self.in_summary.active = True
+            try:
+                logging.getLogger("").warning("%s", summary)
+            finally:
+                self.in_summary.active = False
+
+    def create_summary(self, now: float) -> str:
+        """
+        Returns the summary of the suppressed messages and forgets about expired groups.
+        Must be called while holding the lock.
+        """
+        parts = []
+        for (_, template, device), count in sorted(self.suppressed.items(), key=lambda item: -item[1]):
+            parts.append(f"{count}x '{template}'" + (f" ({device})" if device is not None else ""))
+        elapsed = now - self.last_summary
+        self.suppressed = {}
+        self.last_emitted = {k: t for k, t in self.last_emitted.items() if now - t <= self.window}
+        self.last_summary = now
+        if not parts:
+            return ""
+        return f"Suppressed repeated log messages in the last {round(elapsed)}s: " + ", ".join(parts)
+
+
+class DeferredQueueHandler(QueueHandler):
+    """
+    QueueHandler that hands the record over unformatted.
+    The default QueueHandler formats the message in the logging thread, this one leaves
+    all formatting to the QueueListener thread. Arguments passed to the logger must
+    therefore not be changed after the call.
+    """
+
+    def prepare(self, record):
+        return record
+
+
+class RingHandler(logging.Handler):
+    """
+    Stores the formatted entries as strings in the log_ring
+    """
+
+    def emit(self, record):
+        try:
+            log_ring.append(self.format(record))
+        except Exception:
+            self.handleError(record)
+
+
+def get_logs() -> list[str]:
+    """
+    Returns the JSON entries of the log_ring, oldest first
+    """
+    return list(log_ring)
+
+
+def stop_logger():
+    """
+    Logs the summary of the suppressed messages and stops the QueueListener after all queued records
+    have been handled
+    """
+    global log_listener
+    if rate_limit_filter is not None:
+        rate_limit_filter.flush()
+    if log_listener is not None:
+        log_listener.stop()
+        log_listener = None
+
+
 def setup_logger():
+    global log_listener, rate_limit_filter
     logger = logging.getLogger("")  # Use a fixed name for the logger
 
     # if the logger has handlers, just return it
@@ -45,19 +187,23 @@ def setup_logger():
     logger.setLevel(logging.INFO)
 
     # Create a file handler
-    file_handler = logging.FileHandler("nrf_smart.log", mode="w")
+    file_handler = logging.FileHandler("nrf_smart.log", mode="w", delay=True)
     file_handler.setLevel(logging.INFO)
-    file_handler.addFilter(IgnoreFlaskLogs())
 
     # Create a console handler
     console_handler = logging.StreamHandler(None)
     console_handler.setLevel(logging.INFO)
-    console_handler.addFilter(IgnoreFlaskLogs())
 
-    # Create queue handler
-    queue_handler = QueueHandler(log_queue)
-    queue_handler.setLevel(logging.WARNING)
+    # Create ring handler
+    ring_handler = RingHandler()
+    ring_handler.setLevel(logging.WARNING)
+
+    # Create the handler that is called from the logging threads.
+    # Flask logs and repeated messages are dropped here so they never reach the queue.
+    queue_handler = DeferredQueueHandler(log_record_queue)
     queue_handler.addFilter(IgnoreFlaskLogs())
+    rate_limit_filter = RateLimitFilter()
+    queue_handler.addFilter(rate_limit_filter)
 
     # Define log colors
     log_colors = {
@@ -87,11 +233,16 @@ def setup_logger():
     # Set the formatter for the handlers
     file_handler.setFormatter(file_formatter)
     console_handler.setFormatter(console_formatter)
-    queue_handler.setFormatter(json_formatter)
+    ring_handler.setFormatter(json_formatter)
+
+    # Formatting and I/O happen on the thread of the QueueListener
+    handlers = [console_handler, ring_handler]
+    #handlers.append(file_handler)
+    log_listener = QueueListener(log_record_queue, *handlers, respect_handler_level=True)
+    log_listener.start()
+    atexit.register(stop_logger)
 
-    # Add the handlers to the logger
-    #logger.addHandler(file_handler)
-    logger.addHandler(console_handler)
+    # Add the handler to the logger
     logger.addHandler(queue_handler)
 
     return logger
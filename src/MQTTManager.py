@@ -1,18 +1,26 @@
 import paho.mqtt.client as mqtt
 from src.DBManager import DBManager
-from src.CommunicationManager import CommunicationManager
+from src.CommunicationManager import CommunicationManager, SetConfirmation
+from src.TransitionManager import TransitionManager
+from src.SceneManager import SceneManager
 from src.DeviceManager import DeviceManager
 from src.Logger import setup_logger
-from threading import Event
-import time
+from src.Metrics import metrics
+from src.EventBus import event_bus
+from src.Tracing import tracer
+from threading import Event, Thread
 import re
 import json
 
 logger = setup_logger()
 root_topic = "smart-home-nrf"
-topic_pattern = r"smart-home-nrf/devices/(0x[a-fA-F0-9]+)/set/(\w+)"
+topic_pattern = r"smart-home-nrf/devices/(0x[a-fA-F0-9]+)/(set|stream|transition|confirm)/(\w+)"
+scene_topic_pattern = r"smart-home-nrf/(scenes|groups)/(\w+)/(apply|capture|set)$"
+light_topic_pattern = r"smart-home-nrf/devices/(0x[a-fA-F0-9]+)/light/set$"
+light_state_keys = ("power", "brightness", "cct_mired")
 hs_discovery_topic = "homeassistant"
 sensor_types = "temperature, humidity, battery"
+mqtt_publishes = metrics.counter("nrf_mqtt_publishes_total", "Messages published to the MQTT broker")
 
 
 def get_unit_by_parameter(parameter: str) -> str:
@@ -26,6 +34,11 @@ def get_unit_by_parameter(parameter: str) -> str:
         return ""
 
 
+def from_hexstr(uuid_str: str) -> list[int]:
+    uuid_str = uuid_str[2:]  # Remove the '0x' prefix
+    return [int(uuid_str[i : i + 2], 16) for i in range(0, len(uuid_str), 2)]
+
+
 def to_hexstr(uuid) -> str:
     return "0x" + "".join([f"{x:02x}" for x in uuid])
 
@@ -75,23 +88,25 @@ def create_discovery_payload(class_obj, device, parameter_type, parameter) -> st
             "device": mqtt_device,
         }
     elif parameter_type == "light":
+        # The JSON schema passes the transition time of Home Assistant on to the commands
         payload = {
             "name": device.get("name"),
+            "schema": "json",
+            "brightness": True,
             "brightness_scale": 255,
-            "brightness_state_topic": f"{root_topic}/devices/{uuid_str}/status/brightness",
-            "brightness_command_topic": f"{root_topic}/devices/{uuid_str}/set/brightness",
-            "state_topic": f"{root_topic}/devices/{uuid_str}/status/power",
-            "payload_on": 1,
-            "payload_off": 0,
-            "command_topic": f"{root_topic}/devices/{uuid_str}/set/power",
+            "supported_color_modes": ["brightness"],
+            "transition": True,
+            "state_topic": f"{root_topic}/devices/{uuid_str}/light/state",
+            "command_topic": f"{root_topic}/devices/{uuid_str}/light/set",
             "unique_id": f"{parameter_type}-{uuid_str}",
             "device_class": parameter_type,
             "device": mqtt_device,
         }
         #Get Number of channels from db
         if device["status"].get("num_channels") == 2:
-            payload["color_temp_state_topic"] = f"{root_topic}/devices/{uuid_str}/status/cct_mired"
-            payload["color_temp_command_topic"] = f"{root_topic}/devices/{uuid_str}/set/cct_mired"
+            payload["supported_color_modes"] = ["color_temp"]
+            payload["min_mireds"] = 1_000_000 // class_obj.max_cct
+            payload["max_mireds"] = 1_000_000 // class_obj.min_cct
 
 
     return json.dumps(payload) if payload != {} else ""
@@ -102,6 +117,7 @@ class MQTTManager:
         self,
         db_manager: DBManager,
         comm_manager: CommunicationManager,
+        transition_manager: TransitionManager,
         shutdown_flag : Event,
         broker_address="localhost",
         port=1883,
@@ -110,6 +126,8 @@ class MQTTManager:
     ):
         self.db_manager = db_manager
         self.comm_manager = comm_manager
+        self.transition_manager = transition_manager
+        self.scene_manager = SceneManager(comm_manager, transition_manager)
         self.shutdown_flag = shutdown_flag
         self.client = mqtt.Client()
         if username and password:
@@ -138,17 +156,49 @@ class MQTTManager:
                     self.client.publish(discovery_topic, discovery_payload, retain=True)
 
     def on_message(self, client, userdata, msg):
-        logger.info(f"MQTT message: {msg.topic} {msg.payload}")
+        logger.info("MQTT message: %s %s", msg.topic, msg.payload)
+        if match := re.match(scene_topic_pattern, msg.topic):
+            self.on_scene_message(match.group(1), match.group(2), match.group(3), msg.payload)
+            return
+        if match := re.match(light_topic_pattern, msg.topic):
+            self.on_light_message(from_hexstr(match.group(1)), msg.payload)
+            return
         match = re.match(topic_pattern, msg.topic)
         if match:
-            uuid_str = match.group(1)[2:]  # Remove the '0x' prefix
-            uuid = [int(uuid_str[i : i + 2], 16) for i in range(0, len(uuid_str), 2)]  # Convert to list of integers
-            parameter = match.group(2)
+            uuid = from_hexstr(match.group(1))
+            mode = match.group(2)
+            parameter = match.group(3)
             device = self.db_manager.search_device_in_db(uuid)
             if device == None:
                 return
             new_val = msg.payload
 
+            # Transitions are sent as JSON {"value": ..., "transition": <seconds>}
+            if mode == "transition":
+                try:
+                    payload = json.loads(new_val)
+                    self.transition_manager.start_transition(
+                        uuid, parameter, str(payload["value"]), float(payload.get("transition", 0))
+                    )
+                except (ValueError, TypeError, KeyError):
+                    logger.warning("Invalid transition payload %s", new_val)
+                return
+
+            # Confirmed SETs are sent as JSON {"value": ..., "wait": <ms>}, the result is published to confirmed/<parameter>
+            if mode == "confirm":
+                try:
+                    payload = json.loads(new_val)
+                    value, wait = str(payload["value"]), float(payload.get("wait", 2000)) / 1000
+                except (ValueError, TypeError, KeyError):
+                    logger.warning("Invalid confirm payload %s", new_val)
+                    return
+                self.transition_manager.cancel_transition(uuid, parameter)
+                confirmation = SetConfirmation(parameter, value)
+                if self.comm_manager.set_device_param(uuid, parameter, value, confirmation=confirmation):
+                    # Waiting here would block the network loop of the client
+                    Thread(target=self.publish_confirmation, args=(uuid, confirmation, wait), daemon=True).start()
+                return
+
             if isinstance(new_val, bytes):
                 if new_val.lower() == b"on":
                     new_val = 1
@@ -160,50 +210,158 @@ class MQTTManager:
                     except ValueError:
                         pass
 
-            self.comm_manager.set_device_param(uuid, parameter, str(new_val))
+            stream = mode == "stream"
+            if not stream:
+                self.transition_manager.cancel_transition(uuid, parameter)
+            self.comm_manager.set_device_param(uuid, parameter, str(new_val), stream)
+
+    def on_light_message(self, uuid: list[int], payload: bytes):
+        """
+        Handles the commands of the Home Assistant JSON light schema, e.g. {"state": "ON", "brightness": 128,
+        "transition": 2}. With a transition time brightness and color temperature are changed by the
+        TransitionManager, power is always switched right away.
+        """
+        try:
+            command = json.loads(payload)
+            transition = float(command.get("transition", 0))
+        except (ValueError, TypeError, AttributeError):
+            logger.warning("Invalid light payload %s", payload)
+            return
+        if self.db_manager.search_device_in_db(uuid) is None:
+            return
+
+        values = {}
+        if "brightness" in command:
+            values["brightness"] = command["brightness"]
+        if "color_temp" in command:
+            values["cct_mired"] = command["color_temp"]
+        for parameter, value in values.items():
+            if transition > 0 and self.transition_manager.start_transition(uuid, parameter, str(value), transition):
+                continue
+            self.transition_manager.cancel_transition(uuid, parameter)
+            self.comm_manager.set_device_param(uuid, parameter, str(value))
+        if command.get("state") in ("ON", "OFF"):
+            self.comm_manager.set_device_param(uuid, "power", "1" if command["state"] == "ON" else "0")
+
+    def on_scene_message(self, kind: str, name: str, command: str, payload: bytes):
+        """
+        groups/<name>/set takes a JSON list of device uuids (e.g. ["0x0a141e01"]).
+        scenes/<name>/capture captures the devices of the group named in the payload, scenes/<name>/apply
+        restores a scene and publishes the report to scenes/<name>/result once the devices confirmed it.
+        """
+        if kind == "groups" and command == "set":
+            try:
+                members = [from_hexstr(str(member)) for member in json.loads(payload)]
+            except (ValueError, TypeError):
+                logger.warning("Invalid group payload %s", payload)
+                return
+            self.scene_manager.save_group(name, members)
+        elif kind == "scenes" and command == "capture":
+            group = payload.decode(errors="ignore") if isinstance(payload, bytes) else str(payload)
+            if (members := self.scene_manager.get_members(group)) is None:
+                logger.warning("Group %s not found", group)
+                return
+            self.scene_manager.capture_scene(name, members)
+        elif kind == "scenes" and command == "apply":
+            # Waiting for the confirmations here would block the network loop of the client
+            Thread(target=self.publish_scene_report, args=(name,), daemon=True).start()
+
+    def publish_scene_report(self, name: str):
+        """
+        Restores a scene and publishes the report
+        """
+        if (report := self.scene_manager.apply_scene(name)) is None:
+            logger.warning("Scene %s not found", name)
+            return
+        self.client.publish(f"{root_topic}/scenes/{name}/result", json.dumps(report))
+        mqtt_publishes.inc()
+
+    def publish_confirmation(self, uuid: list[int], confirmation: SetConfirmation, wait: float):
+        """
+        Waits for the confirmation of a SET and publishes the result
+        """
+        confirmed = self.comm_manager.wait_for_confirmation(uuid, confirmation, wait)
+        result = {
+            "value": confirmation.value,
+            "confirmed": bool(confirmed),
+            "timeout": confirmed is None,
+            "latency_ms": round(1000 * confirmation.latency, 1) if confirmed else None,
+        }
+        self.client.publish(f"{root_topic}/devices/{to_hexstr(uuid)}/confirmed/{confirmation.parameter}", json.dumps(result))
+        mqtt_publishes.inc()
 
     def publish(self, topic: str, value):
         # logger.info(f"publish: {topic} {value}")
         self.client.publish(topic, value, retain=True)
+        mqtt_publishes.inc()
+
+    def publish_changes(self, uuid: list[int], change: dict):
+        """
+        Publishes the changed fields of a device, every status parameter gets its own topic
+        """
+        for key, value in change.items():
+            if key == "uuid":
+                continue
+            if isinstance(value, dict):
+                for sub_key, sub_value in value.items():
+                    # Rules for specific status keys:
+                    if sub_key == "humidity" and isinstance(sub_value, float):
+                        sub_value = round(sub_value)
+
+                    topic = f"{root_topic}/devices/{to_hexstr(uuid)}/{key}/{sub_key}"
+                    self.publish(topic, str(sub_value) if isinstance(sub_value, list) else sub_value)
+            else:
+                self.publish(f"{root_topic}/devices/{to_hexstr(uuid)}/{key}", value)
+        if any(key in change.get("status", {}) for key in light_state_keys):
+            self.publish_light_state(uuid)
+
+    def publish_light_state(self, uuid: list[int]):
+        """
+        Publishes the state of a light in the Home Assistant JSON light schema
+        """
+        if (device := self.db_manager.search_device_in_db(uuid)) is None:
+            return
+        class_obj = DeviceManager.get_supported_device(device["type"])
+        if class_obj is None or not any(kind == "light" for kind, _ in class_obj.mqtt_discovery_paramters):
+            return
+        status = device.get("status", {})
+        state = {"state": "ON" if status.get("power") else "OFF", "brightness": status.get("brightness")}
+        if status.get("num_channels") == 2:
+            state["color_mode"] = "color_temp"
+            state["color_temp"] = status.get("cct_mired")
+        else:
+            state["color_mode"] = "brightness"
+        self.publish(f"{root_topic}/devices/{to_hexstr(uuid)}/light/state", json.dumps(state))
 
     def run(self):
         self.client.loop_start()
         self.client.subscribe(f"{root_topic}/devices/+/set/#")
-        while not self.shutdown_flag.is_set():
-            # Handle all status changes
-            while db_change := self.db_manager.get_changes():
-                try:
-                    uuid, change = db_change
-                except ValueError as e:
-                    logger.error(f"Unexpected content in queque: {db_change}")
-                    return
-                for key, value in change.items():
-                    if key == "uuid":
-                        continue
-                    if isinstance(value, dict):
-                        for sub_key, sub_value in value.items():
-                            # Rules for specific status keys:
-                            if sub_key == "humidity" and isinstance(sub_value, float):
-                                sub_value = round(sub_value)
-
-                            topic = f"{root_topic}/devices/{to_hexstr(uuid)}/{key}/{sub_key}"
-                            self.publish(topic, str(sub_value) if isinstance(sub_value, list) else sub_value)
-                    else:
-                        self.publish(f"{root_topic}/devices/{to_hexstr(uuid)}/{key}", value)
-
-            # Handle all events
-            while entry := self.comm_manager.get_event():
-                try:
-                    uuid, event = entry
-                except ValueError as e:
-                    logger.error(f"Unexpected content in queque: {entry}")
-                    return
-                # logger.info(f"event from {uuid}: {event}")
-                topic = f"{root_topic}/devices/{to_hexstr(uuid)}/action"
-                self.client.publish(topic, event)
+        self.client.subscribe(f"{root_topic}/devices/+/stream/#")
+        self.client.subscribe(f"{root_topic}/devices/+/transition/#")
+        self.client.subscribe(f"{root_topic}/devices/+/confirm/#")
+        self.client.subscribe(f"{root_topic}/devices/+/light/set")
+        self.client.subscribe(f"{root_topic}/groups/+/set")
+        self.client.subscribe(f"{root_topic}/scenes/+/capture")
+        self.client.subscribe(f"{root_topic}/scenes/+/apply")
+        # Subscribe before all devices are published, so no change in between is lost
+        subscription = event_bus.subscribe("mqtt", topics=("state", "remote"), maxsize=10000, traced=True)
+        for device in self.db_manager.get_all_devices():
+            self.publish_changes(device["uuid"], device)
 
-            time.sleep(0.1)
+        while not self.shutdown_flag.is_set():
+            if (event := subscription.get(timeout=0.5)) is None:
+                continue
+            if event.topic == "state":
+                self.publish_changes(event.uuid, event.data)
+                tracer.finish(event.trace, "mqtt")
+            else:
+                # logger.info(f"event from {event.uuid}: {event.data}")
+                topic = f"{root_topic}/devices/{to_hexstr(event.uuid)}/action"
+                self.client.publish(topic, event.data)
+                mqtt_publishes.inc()
+                tracer.finish(event.trace, "mqtt")
 
+        subscription.close()
         logger.info("MQTTManager stopped")
         self.stop()
 
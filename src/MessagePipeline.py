@@ -0,0 +1,136 @@
+import queue
+import time
+from threading import Event, Lock, Thread
+from typing import Callable, Hashable, Optional
+
+from src.Logger import setup_logger
+from src.Metrics import metrics
+
+logger = setup_logger()
+
+stage_depth = metrics.gauge("nrf_pipeline_queue_depth", "Items waiting in the queue of a pipeline stage", ("stage",))
+stage_dropped = metrics.counter(
+    "nrf_pipeline_dropped_total", "Items dropped because the queue of a pipeline stage was full", ("stage",)
+)
+stage_coalesced = metrics.counter(
+    "nrf_pipeline_coalesced_total", "Items merged into a queued item with the same key", ("stage",)
+)
+stage_processed = metrics.counter("nrf_pipeline_processed_total", "Items handled by a pipeline stage", ("stage",))
+stage_time = metrics.histogram("nrf_pipeline_stage_seconds", "Time a pipeline stage spent handling an item", ("stage",))
+
+
+class PipelineStage:
+    """
+    A stage of the message pipeline: num_workers threads that call handler(*item) for the items put into
+    their bounded queue. Items with the same key always go to the same worker, so they are handled in the
+    order they were put, items with different keys are handled in parallel.
+
+    If drop_when_full is set, put never blocks and drops the item when the queue is full. Otherwise put
+    waits for space, so a slow stage slows down the stage in front of it instead of dropping anything.
+
+    With merge, an item whose key is still queued is merged into the queued item with merge(queued, item)
+    instead of being queued again. The queue then holds at most one item per key and a slow stage handles
+    the latest state of every key instead of falling behind on outdated ones.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        handler: Callable,
+        shutdown_flag: Event,
+        num_workers: int = 1,
+        maxsize: int = 256,
+        drop_when_full: bool = False,
+        merge: Optional[Callable[[tuple, tuple], tuple]] = None,
+    ):
+        self.name = name
+        self.handler = handler
+        self.shutdown_flag = shutdown_flag
+        self.drop_when_full = drop_when_full
+        self.queues = [queue.Queue(maxsize) for _ in range(num_workers)]
+        # With merge the queues hold the keys, their items wait here until a worker takes them
+        self.merge = merge
+        self.pending: list[dict] = [{} for _ in range(num_workers)]
+        self.pending_lock = Lock()
+        self.dropped = stage_dropped.labels(name)
+        self.coalesced = stage_coalesced.labels(name)
+        self.processed = stage_processed.labels(name)
+        self.duration = stage_time.labels(name)
+        stage_depth.labels(name).set_function(self.qsize)
+
+    def qsize(self) -> int:
+        return sum(q.qsize() for q in self.queues)
+
+    def put(self, item: tuple, key: Optional[Hashable] = None) -> bool:
+        """
+        Queues an item for the worker of its key. Returns False if the item was dropped.
+        """
+        index = hash(key) % len(self.queues) if key is not None else 0
+        q = self.queues[index]
+        if self.merge is not None:
+            if key is None:
+                raise ValueError(f"Items of the stage {self.name} need a key")
+            pending = self.pending[index]
+            with self.pending_lock:
+                if key in pending:
+                    pending[key] = self.merge(pending[key], item)
+                    self.coalesced.inc()
+                    return True
+                pending[key] = item
+            item = key
+
+        if self.drop_when_full:
+            try:
+                q.put_nowait(item)
+                return True
+            except queue.Full:
+                self.dropped.inc()
+                self.take(index, item)
+                return False
+
+        while not self.shutdown_flag.is_set():
+            try:
+                q.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        self.take(index, item)
+        return False
+
+    def take(self, index: int, entry) -> Optional[tuple]:
+        """
+        Returns the item for an entry of the queue of a worker, with merge the entry is the key of the item
+        """
+        if self.merge is None:
+            return entry
+        with self.pending_lock:
+            return self.pending[index].pop(entry, None)
+
+    def start(self) -> list[Thread]:
+        """
+        Starts the workers, they stop once the shutdown_flag is set
+        """
+        threads = []
+        for i in range(len(self.queues)):
+            thread = Thread(target=self.work, args=(i,), name=f"{self.name}-{i}")
+            thread.start()
+            threads.append(thread)
+        return threads
+
+    def work(self, index: int):
+        q = self.queues[index]
+        while not self.shutdown_flag.is_set():
+            try:
+                item = q.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            if (item := self.take(index, item)) is None:
+                continue
+            start = time.perf_counter()
+            try:
+                self.handler(*item)
+            except Exception as e:
+                logger.exception(e)
+            self.duration.observe(time.perf_counter() - start)
+            self.processed.inc()
+        logger.info("Stopped pipeline stage %s", self.name)
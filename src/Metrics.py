@@ -0,0 +1,296 @@
+import bisect
+import time
+from threading import Lock
+from typing import Callable, Optional
+
+
+def _escape_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labelnames: tuple, labelvalues: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape_label(value)}"' for name, value in zip(labelnames, labelvalues)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+class Metric:
+    """
+    Base class for all metrics. A metric without labels stores its value directly,
+    a metric with labels keeps one child per label combination.
+    """
+
+    type_name = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.children = {}
+        self.children_lock = Lock()
+
+    def new_child(self):
+        raise NotImplementedError()
+
+    def labels(self, *labelvalues):
+        """
+        Returns the child for the given label values, creating it on first use.
+        Hot paths should keep a reference to the child instead of calling this for every update.
+        """
+        key = tuple(str(v) for v in labelvalues)
+        child = self.children.get(key)
+        if child is None:
+            with self.children_lock:
+                child = self.children.setdefault(key, self.new_child())
+        return child
+
+    def remove(self, *labelvalues):
+        with self.children_lock:
+            self.children.pop(tuple(str(v) for v in labelvalues), None)
+
+    def samples(self) -> list[tuple[str, tuple, float]]:
+        raise NotImplementedError()
+
+    def collect(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"]
+        for suffix, labelvalues, extra, value in self.samples():
+            labels = _format_labels(self.labelnames, labelvalues, extra)
+            lines.append(f"{self.name}{suffix}{labels} {_format_value(value)}")
+        return lines
+
+
+class _CounterValue:
+    __slots__ = ("value", "function")
+
+    def __init__(self):
+        self.value = 0
+        self.function: Optional[Callable[[], float]] = None
+
+    def inc(self, amount: float = 1):
+        # Not guarded by a lock: an occasional lost increment under heavy contention is
+        # acceptable for statistics and keeps the message path cheap
+        self.value += amount
+
+    def set_function(self, function: Callable[[], float]):
+        """
+        Export a count that is already kept elsewhere, e.g. as a plain attribute of a class
+        outside of this application.
+        """
+        self.function = function
+
+    def get(self) -> float:
+        if self.function is not None:
+            try:
+                return self.function()
+            except Exception:
+                return float("nan")
+        return self.value
+
+
+class Counter(Metric):
+    type_name = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        super().__init__(name, documentation, labelnames)
+        self.value = _CounterValue()
+
+    def new_child(self):
+        return _CounterValue()
+
+    def inc(self, amount: float = 1):
+        self.value.inc(amount)
+
+    def set_function(self, function: Callable[[], float]):
+        self.value.set_function(function)
+
+    def get(self) -> float:
+        return self.value.get()
+
+    def samples(self):
+        if not self.labelnames:
+            return [("", (), "", self.value.get())]
+        return [("", key, "", child.get()) for key, child in list(self.children.items())]
+
+
+class _GaugeValue:
+    __slots__ = ("value", "function")
+
+    def __init__(self):
+        self.value = 0
+        self.function: Optional[Callable[[], float]] = None
+
+    def set(self, value: float):
+        self.value = value
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+    def dec(self, amount: float = 1):
+        self.value -= amount
+
+    def set_function(self, function: Callable[[], float]):
+        """
+        Let the gauge be computed when it is exported instead of updating it on every change.
+        """
+        self.function = function
+
+    def get(self) -> float:
+        if self.function is not None:
+            try:
+                return self.function()
+            except Exception:
+                return float("nan")
+        return self.value
+
+
+class Gauge(Metric):
+    type_name = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        super().__init__(name, documentation, labelnames)
+        self.value = _GaugeValue()
+
+    def new_child(self):
+        return _GaugeValue()
+
+    def set(self, value: float):
+        self.value.set(value)
+
+    def inc(self, amount: float = 1):
+        self.value.inc(amount)
+
+    def dec(self, amount: float = 1):
+        self.value.dec(amount)
+
+    def set_function(self, function: Callable[[], float]):
+        self.value.set_function(function)
+
+    def get(self) -> float:
+        return self.value.get()
+
+    def samples(self):
+        if not self.labelnames:
+            return [("", (), "", self.value.get())]
+        return [("", key, "", child.get()) for key, child in list(self.children.items())]
+
+
+class _HistogramValue:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def time(self):
+        return _Timer(self)
+
+
+class _Timer:
+    """
+    Context manager observing the elapsed time of the with block
+    """
+
+    __slots__ = ("histogram", "start")
+
+    def __init__(self, histogram: _HistogramValue):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+
+class Histogram(Metric):
+    type_name = "histogram"
+    default_buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: Optional[tuple] = None):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) if buckets else self.default_buckets
+        self.value = _HistogramValue(self.buckets)
+
+    def new_child(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value: float):
+        self.value.observe(value)
+
+    def time(self):
+        return self.value.time()
+
+    def samples(self):
+        children = [((), self.value)] if not self.labelnames else list(self.children.items())
+        samples = []
+        for key, child in children:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), child.counts):
+                cumulative += count
+                samples.append(("_bucket", key, f'le="{_format_value(bound)}"', cumulative))
+            samples.append(("_sum", key, "", child.sum))
+            samples.append(("_count", key, "", child.count))
+        return samples
+
+
+class MetricsRegistry:
+    """
+    Holds all metrics of the application and renders them in the Prometheus text format.
+    Metrics are created once at import time of the module using them, asking for an existing name returns the same metric.
+    """
+
+    def __init__(self):
+        self.metrics: dict[str, Metric] = {}
+        self.lock = Lock()
+
+    def _get_or_create(self, metric_class, name: str, *args, **kwargs):
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = metric_class(name, *args, **kwargs)
+                self.metrics[name] = metric
+            elif not isinstance(metric, metric_class):
+                raise ValueError(f"Metric {name} already registered as {metric.type_name}")
+            return metric
+
+    def counter(self, name: str, documentation: str, labelnames: tuple = ()) -> Counter:
+        return self._get_or_create(Counter, name, documentation, labelnames)
+
+    def gauge(self, name: str, documentation: str, labelnames: tuple = ()) -> Gauge:
+        return self._get_or_create(Gauge, name, documentation, labelnames)
+
+    def histogram(
+        self, name: str, documentation: str, labelnames: tuple = (), buckets: Optional[tuple] = None
+    ) -> Histogram:
+        return self._get_or_create(Histogram, name, documentation, labelnames, buckets)
+
+    def render(self) -> str:
+        """
+        Returns all metrics in the Prometheus text exposition format
+        """
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.collect())
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
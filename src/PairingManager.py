@@ -0,0 +1,223 @@
+import heapq
+import time
+from threading import Condition, Event
+from typing import Optional
+
+from nrf24Smart import DeviceMessage
+from src.DeviceManager import DeviceManager
+from src.Logger import setup_logger
+from src.Metrics import metrics
+from src.RetryPolicy import RetryPolicy
+
+logger = setup_logger()
+
+pairing_results = metrics.counter("nrf_pairing_total", "Finished pairings of new devices", ("result",))
+pairing_attempts = metrics.counter("nrf_pairing_attempts_total", "INIT answers sent to new devices")
+pairing_deferred = metrics.counter(
+    "nrf_pairing_deferred_total", "INIT answers held back because another new device was listening at the same time"
+)
+pairing_duration = metrics.histogram(
+    "nrf_pairing_duration_seconds", "Time from the first INIT message of a device until it was added"
+)
+
+
+class PairingJob:
+    __slots__ = ("msg", "device_type", "new_id", "first_init", "last_init", "attempts", "due")
+
+    def __init__(self, msg: DeviceMessage, device_type: str, new_id: int):
+        self.msg = msg
+        self.device_type = device_type
+        self.new_id = new_id
+        self.first_init = time.monotonic()
+        self.last_init = self.first_init
+        self.attempts = 0
+        self.due: Optional[float] = None
+
+
+class PairingManager:
+    """
+    Pairs new devices on its own thread, so the listener is not blocked while a device is initialized.
+
+    The INIT message of a new device is answered with its new ID, the ID is reserved in the DBManager
+    as soon as the INIT arrives, so devices pairing at the same time never get the same ID.
+    All new devices listen on the same radio ID for listen_window seconds after their INIT message. The
+    answer names the UUID of the device it is meant for and the firmware ignores answers for other devices.
+    Firmware that does not check the UUID takes any answer, set addressed_answers to False for it: an answer
+    is then only sent while no other new device is listening, so these devices have to be switched on one
+    after another.
+    A failed answer is retried with the retry_policy, a device that sends INIT again did not get its answer
+    and is answered again. Devices are paired in the order their INIT arrived.
+    """
+
+    def __init__(self, device_manager: DeviceManager, shutdown_flag: Event):
+        self.device_manager = device_manager
+        self.db_manager = device_manager.db_manager
+        self.shutdown_flag = shutdown_flag
+        # Time between the INIT message and the answer, the device needs to switch to receiving
+        self.init_delay = 0.5
+        # How long a new device waits for the answer to its INIT message (see connectToServer in the firmware)
+        self.listen_window = 2.0
+        self.addressed_answers = True
+        self.retry_policy = RetryPolicy(base_delay=0.1, max_delay=1.0, max_attempts=5, deadline=60.0)
+        self.jobs = {}
+        self.heap = []
+        self.num_scheduled = 0
+        self.condition = Condition()
+        self.session: Optional[dict] = None
+        metrics.gauge("nrf_pairing_pending", "New devices waiting to be paired").set_function(lambda: len(self.jobs))
+
+    def submit(self, msg: DeviceMessage):
+        """
+        Called by the listener for every INIT message, returns immediately
+        """
+        uuid_string = str(msg.UUID)
+        now = time.monotonic()
+        with self.condition:
+            job = self.jobs.get(uuid_string)
+            if job is not None:
+                # The device did not get the answer and listens again
+                job.msg = msg
+                job.last_init = now
+                self.schedule(job, now + self.init_delay)
+                return
+
+        if (device_type := self.device_manager.check_new_device(msg)) is None:
+            return
+        if (new_id := self.db_manager.get_free_id()) is None:
+            logger.error("No free ID available")
+            return
+        logger.info(f"New device ID:{new_id}")
+        with self.condition:
+            job = self.jobs[uuid_string] = PairingJob(msg, device_type, new_id)
+            self.schedule(job, now + self.init_delay)
+
+    def schedule(self, job: PairingJob, due: float):
+        job.due = due
+        self.num_scheduled += 1
+        heapq.heappush(self.heap, (due, self.num_scheduled, job))
+        self.condition.notify()
+
+    def get_next(self, timeout: float) -> Optional[PairingJob]:
+        """
+        Waits up to timeout seconds for the next job that can be answered.
+        """
+        end = time.monotonic() + timeout
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                # Skip entries of finished jobs and of jobs that were scheduled again
+                while self.heap and self.heap[0][2].due != self.heap[0][0]:
+                    heapq.heappop(self.heap)
+                if self.heap and self.heap[0][0] <= now:
+                    _, _, job = heapq.heappop(self.heap)
+                    job.due = None
+                    if now - job.first_init >= self.retry_policy.deadline:
+                        logger.error(f"Giving up pairing of device with uuid:{job.msg.UUID}")
+                        self.db_manager.release_id(job.new_id)
+                        self.finish(job, "failed")
+                        continue
+                    if now - job.last_init >= self.listen_window:
+                        # Not listening anymore, submit schedules it again with its next INIT message
+                        self.schedule(job, job.first_init + self.retry_policy.deadline)
+                        continue
+                    listening = [
+                        other for other in self.jobs.values()
+                        if other is not job and now - other.last_init < self.listen_window
+                    ]
+                    if self.addressed_answers or not listening:
+                        return job
+                    # Answer once the other devices stopped listening
+                    pairing_deferred.inc()
+                    if self.session is not None:
+                        self.session["deferred"] += 1
+                    self.schedule(job, max(other.last_init for other in listening) + self.listen_window)
+                    continue
+                if now >= end:
+                    return None
+                wait = end - now
+                if self.heap:
+                    wait = min(wait, self.heap[0][0] - now)
+                self.condition.wait(wait)
+
+    def run(self):
+        """
+        Answers INIT messages until the shutdown_flag is set
+        """
+        while not self.shutdown_flag.is_set():
+            if (job := self.get_next(timeout=0.5)) is not None:
+                self.pair(job)
+        logger.info("Stopped pairing")
+
+    def pair(self, job: PairingJob):
+        """
+        Sends the new ID to the device of the job and adds it on success
+        """
+        job.attempts += 1
+        pairing_attempts.inc()
+        if self.session is not None:
+            self.session["attempts"] += 1
+        if self.device_manager.send_new_id(job.msg, job.new_id):
+            self.device_manager.add_new_device(job.msg, job.device_type, job.new_id)
+            self.finish(job, "paired")
+            return
+
+        logger.error(f"Failed to initialize device {job.device_type}")
+        if self.retry_policy.is_expired(job.attempts, time.monotonic() - job.first_init):
+            self.db_manager.release_id(job.new_id)
+            self.finish(job, "failed")
+            return
+        with self.condition:
+            if job.due is None:
+                self.schedule(job, time.monotonic() + self.retry_policy.get_delay(job.attempts))
+
+    def finish(self, job: PairingJob, result: str):
+        with self.condition:
+            self.jobs.pop(str(job.msg.UUID), None)
+            job.due = None
+        duration = time.monotonic() - job.first_init
+        pairing_results.labels(result).inc()
+        if result == "paired":
+            pairing_duration.observe(duration)
+        session = self.session
+        if session is not None:
+            session[result] += 1
+            if result == "paired":
+                session["durations"].append(duration)
+
+    def start_provisioning(self):
+        """
+        Starts a provisioning session, get_stats reports the devices paired since then
+        """
+        logger.info("Provisioning session started")
+        self.session = {"start": time.monotonic(), "paired": 0, "failed": 0, "attempts": 0, "deferred": 0, "durations": []}
+
+    def stop_provisioning(self) -> Optional[dict]:
+        """
+        Ends the provisioning session and returns its stats
+        """
+        stats = self.get_stats()
+        self.session = None
+        if stats is not None:
+            logger.info("Provisioning session finished: %s", stats)
+        return stats
+
+    def get_stats(self) -> Optional[dict]:
+        """
+        Returns the stats of the running provisioning session, or None if there is none
+        """
+        session = self.session
+        if session is None:
+            return None
+        elapsed = time.monotonic() - session["start"]
+        durations = session["durations"]
+        return {
+            "elapsed": round(elapsed, 1),
+            "paired": session["paired"],
+            "failed": session["failed"],
+            "pending": len(self.jobs),
+            "attempts": session["attempts"],
+            "deferred": session["deferred"],
+            "devices_per_minute": round(60 * session["paired"] / elapsed, 1) if elapsed > 0 else 0.0,
+            "mean_duration": round(sum(durations) / len(durations), 2) if durations else None,
+            "max_duration": round(max(durations), 2) if durations else None,
+        }
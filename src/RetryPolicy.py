@@ -0,0 +1,43 @@
+import random
+
+
+class RetryPolicy:
+    """
+    Decides when a failed SET message is retried and when a pending command is given up.
+
+    A device that did not acknowledge (the dongle reported ERROR) is retried with exponential backoff and
+    jitter, so a device out of range does not keep the radio busy and devices that failed at the same time
+    do not retry in lockstep. An ack timeout means the dongle itself did not answer, it is retried after a
+    short fixed delay and does not count as an attempt of the command.
+    """
+
+    def __init__(
+        self,
+        base_delay: float = 0.05,
+        max_delay: float = 5.0,
+        multiplier: float = 2.0,
+        jitter: float = 0.5,
+        max_attempts: int = 10,
+        deadline: float = 30.0,
+        timeout_delay: float = 0.1,
+    ):
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.multiplier = multiplier
+        self.jitter = jitter
+        self.max_attempts = max_attempts  # Attempts per command before it is dropped
+        self.deadline = deadline  # Seconds a command stays pending before it is dropped
+        self.timeout_delay = timeout_delay
+
+    def get_delay(self, failures: int) -> float:
+        """
+        Returns the delay before the next attempt after the given number of consecutive failures
+        """
+        delay = min(self.max_delay, self.base_delay * self.multiplier ** max(0, failures - 1))
+        return delay * (1 - self.jitter * random.random())
+
+    def is_expired(self, attempts: int, age: float) -> bool:
+        """
+        Returns whether a command that failed attempts times and is pending since age seconds is given up
+        """
+        return attempts >= self.max_attempts or age >= self.deadline
@@ -0,0 +1,217 @@
+import operator
+import time
+from threading import Lock
+from typing import Any, Callable, Optional
+
+from src.Logger import setup_logger
+from src.Metrics import metrics
+
+logger = setup_logger()
+
+rules_evaluated = metrics.counter("nrf_rules_evaluated_total", "Rule conditions evaluated for status updates and events")
+rules_fired = metrics.counter("nrf_rules_fired_total", "Rules whose actions were run")
+rules_throttled = metrics.counter("nrf_rules_throttled_total", "Rule runs skipped because of the interval of the rule")
+
+OPERATORS = {
+    ">": operator.gt,
+    ">=": operator.ge,
+    "<": operator.lt,
+    "<=": operator.le,
+    "==": operator.eq,
+    "!=": operator.ne,
+}
+
+
+def compile_condition(op: str, value: Any) -> Callable[[Any], bool]:
+    """
+    Returns a function that compares a status value with value, a missing or incomparable value never matches
+    """
+    if (compare := OPERATORS.get(op)) is None:
+        raise ValueError(f"Unknown operator {op}")
+
+    def condition(reported) -> bool:
+        if reported is None:
+            return False
+        try:
+            return compare(reported, value)
+        except TypeError:
+            return False
+
+    return condition
+
+
+class Rule:
+    """
+    A compiled rule. key is the (uuid_string, kind, name) it is indexed by, kind is "event" or "field".
+    state is the last result of the condition (or the last value of a field rule without condition).
+    """
+
+    __slots__ = ("id", "name", "key", "condition", "actions", "interval", "last_run", "state")
+
+    def __init__(self, rule_id: int, rule: dict):
+        trigger = rule.get("trigger") or {}
+        uuid = trigger.get("uuid")
+        if not isinstance(uuid, list) or len(uuid) != 4 or not all(isinstance(x, int) for x in uuid):
+            raise ValueError("The trigger needs the uuid of a device")
+        if "event" in trigger:
+            self.key = (str(uuid), "event", trigger["event"])
+            self.condition = None
+        elif "field" in trigger:
+            self.key = (str(uuid), "field", trigger["field"])
+            self.condition = compile_condition(trigger["op"], trigger.get("value")) if "op" in trigger else None
+        else:
+            raise ValueError("The trigger needs an event or a field")
+
+        self.actions = []
+        for action in rule.get("actions") or []:
+            if not isinstance(action.get("uuid"), list) or "parameter" not in action:
+                raise ValueError("An action needs the uuid of a device and a parameter")
+            if ("value" in action) == ("step" in action):
+                raise ValueError("An action needs either a value or a step")
+            self.actions.append(action)
+        if not self.actions:
+            raise ValueError("A rule needs at least one action")
+
+        self.id = rule_id
+        self.name = rule.get("name", "")
+        self.interval = float(rule.get("interval", 0))
+        self.last_run = 0.0
+        self.state = None
+
+
+class RulesEngine:
+    """
+    Runs simple automations on the hub: a rule is triggered by an event of a remote (e.g. "hold_up")
+    or by a status field of a device (e.g. humidity > 70) and sets parameters of devices through
+    set_device_param. A field rule with a condition runs when the condition becomes true, without
+    condition whenever the value changed. A rule runs at most once every interval seconds.
+
+    Actions either set a value or step a parameter (e.g. brightness_percent +10) within min and max.
+    Steps build on the last value a rule set for step_memory seconds, as the status of the device lags behind.
+
+    The rules are stored in the DB and compiled once when they are loaded. They are indexed by device and
+    field or event, so a status update or event only evaluates the rules of its device and fields.
+    """
+
+    def __init__(self, comm_manager):
+        self.comm_manager = comm_manager
+        self.db_manager = comm_manager.db_manager
+        self.lock = Lock()
+        self.index = {}
+        # Indexed status fields by uuid_string
+        self.fields = {}
+        self.step_memory = 2.0
+        self.last_values = {}
+        metrics.gauge("nrf_rules", "Loaded automation rules").set_function(
+            lambda: sum(len(rules) for rules in self.index.values())
+        )
+        self.load()
+
+    def load(self):
+        """
+        Compiles the rules from the DB and rebuilds the index. Rules keep their state across reloads.
+        """
+        previous = {rule.id: rule for rules in self.index.values() for rule in rules}
+        index, fields = {}, {}
+        for stored in self.db_manager.get_rules():
+            try:
+                rule = Rule(stored["id"], stored)
+            except (ValueError, KeyError, TypeError) as e:
+                logger.error("Invalid rule %s: %s", stored.get("id"), e)
+                continue
+            if (old := previous.get(rule.id)) is not None:
+                rule.state, rule.last_run = old.state, old.last_run
+            index.setdefault(rule.key, []).append(rule)
+            uuid_string, kind, name = rule.key
+            if kind == "field":
+                fields.setdefault(uuid_string, set()).add(name)
+        with self.lock:
+            self.index, self.fields = index, fields
+
+    def add_rule(self, rule: dict) -> Optional[int]:
+        """
+        Checks and stores a rule, returns its id or None if it is invalid
+        """
+        try:
+            Rule(0, rule)
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            logger.warning("Invalid rule: %s", e)
+            return None
+        if (rule_id := self.db_manager.add_rule(rule)) is not None:
+            self.load()
+        return rule_id
+
+    def remove_rule(self, rule_id: int) -> bool:
+        if not self.db_manager.remove_rule(rule_id):
+            return False
+        self.load()
+        return True
+
+    def on_event(self, uuid: list[int], event: str) -> int:
+        """
+        Runs the rules triggered by an event of a remote. Returns the number of rules that ran.
+        """
+        fired = 0
+        for rule in self.index.get((str(uuid), "event", event), ()):
+            rules_evaluated.inc()
+            fired += self.run(rule)
+        return fired
+
+    def on_status(self, uuid: list[int], status: dict) -> int:
+        """
+        Evaluates the rules of the fields of a reported status. Returns the number of rules that ran.
+        """
+        uuid_string = str(uuid)
+        if (fields := self.fields.get(uuid_string)) is None:
+            return 0
+        fired = 0
+        index = self.index
+        for field in fields:
+            value = status.get(field)
+            for rule in index.get((uuid_string, "field", field), ()):
+                rules_evaluated.inc()
+                if rule.condition is None:
+                    changed = rule.state is not None and value != rule.state
+                    rule.state = value
+                    if changed:
+                        fired += self.run(rule)
+                    continue
+                matched = rule.condition(value)
+                became_true = matched and not rule.state
+                rule.state = matched
+                if became_true:
+                    fired += self.run(rule)
+        return fired
+
+    def run(self, rule: Rule) -> bool:
+        now = time.monotonic()
+        if rule.interval and now - rule.last_run < rule.interval:
+            rules_throttled.inc()
+            return False
+        rule.last_run = now
+        rules_fired.inc()
+        logger.debug("Run rule %s %s", rule.id, rule.name)
+        for action in rule.actions:
+            if (value := self.get_action_value(action, now)) is None:
+                continue
+            self.comm_manager.set_device_param(action["uuid"], action["parameter"], value)
+        return True
+
+    def get_action_value(self, action: dict, now: float) -> Optional[str]:
+        if "value" in action:
+            return str(action["value"])
+
+        key = (str(action["uuid"]), action["parameter"])
+        last = self.last_values.get(key)
+        if last is not None and now - last[1] < self.step_memory:
+            current = last[0]
+        elif (current := self.comm_manager.get_device_param(action["uuid"], action["parameter"])) is None:
+            return None
+        try:
+            value = float(current) + float(action["step"])
+        except (TypeError, ValueError):
+            logger.warning("Can not step %s of device %s", action["parameter"], action["uuid"])
+            return None
+        value = max(action.get("min", 0), min(value, action.get("max", 255)))
+        self.last_values[key] = (value, now)
+        return str(round(value))
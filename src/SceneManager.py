@@ -0,0 +1,173 @@
+import time
+from typing import Optional
+
+from src.CommunicationManager import CommunicationManager, SetConfirmation
+from src.TransitionManager import TransitionManager
+from src.Logger import setup_logger
+from src.Metrics import metrics
+
+logger = setup_logger()
+
+scene_applies = metrics.counter("nrf_scene_applies_total", "Restored scenes", ("result",))
+scene_parameters = metrics.counter(
+    "nrf_scene_parameters_total", "Parameters of restored scenes, sent or already reported by the device", ("result",)
+)
+scene_apply_duration = metrics.histogram(
+    "nrf_scene_apply_seconds", "Time from restoring a scene until all devices confirmed it"
+)
+
+
+class SceneManager:
+    """
+    Groups are named lists of devices, scenes are the captured scene_parameters of a set of devices that
+    can be restored in one call.
+
+    A restore only sends the parameters whose value differs from the reported status of the device. They are
+    queued for all devices at once, so the send workers of the CommunicationManager pipeline them across
+    devices and every device gets a single SET message. The desired states of all devices are written to the
+    DB in one go instead of once per parameter on the send path.
+    """
+
+    def __init__(self, comm_manager: CommunicationManager, transition_manager: TransitionManager):
+        self.comm_manager = comm_manager
+        self.transition_manager = transition_manager
+        self.db_manager = comm_manager.db_manager
+        self.device_manager = comm_manager.device_manager
+        # Time a restore waits for the devices to confirm their parameters
+        self.confirm_timeout = 5.0
+
+    def save_group(self, name: str, members: list[list[int]]) -> bool:
+        """
+        Stores a group, returns False if a member is not in the DB
+        """
+        for uuid in members:
+            if self.db_manager.search_device_in_db(uuid) is None:
+                logger.warning("Group member with uuid:%s not in DB!", uuid)
+                return False
+        self.db_manager.save_group({"name": name, "members": members})
+        return True
+
+    def get_members(self, group: str) -> Optional[list[list[int]]]:
+        if (stored := self.db_manager.get_group(group)) is None:
+            return None
+        return stored["members"]
+
+    def capture_scene(self, name: str, members: list[list[int]]) -> Optional[dict]:
+        """
+        Stores the current status of the devices as a scene and returns it.
+        Devices without scene_parameters or without a status are left out, returns None if none is left.
+        """
+        devices = {str(device["uuid"]): device for device in self.db_manager.get_all_devices()}
+        captured = []
+        for uuid in members:
+            if (device := devices.get(str(uuid))) is None:
+                logger.warning("Device with uuid:%s not in DB!", uuid)
+                continue
+            class_obj = self.device_manager.get_supported_device(device["type"])
+            if class_obj is None or not class_obj.scene_parameters:
+                logger.warning("Device of type %s can not be part of a scene", device["type"])
+                continue
+            if (status := device.get("status")) is None:
+                logger.warning("Device with uuid:%s does not have a status!", uuid)
+                continue
+            state = {}
+            for parameter in class_obj.scene_parameters:
+                if (value := class_obj.get_param(parameter, status)) is not None:
+                    state[parameter] = str(value)
+            captured.append({"uuid": uuid, "state": state})
+        if not captured:
+            return None
+        scene = {"name": name, "devices": captured}
+        self.db_manager.save_scene(scene)
+        return scene
+
+    def get_changes(self, scene: dict) -> list[tuple[dict, object, dict, dict]]:
+        """
+        Returns the device, class_obj, state and the parameters that differ from the reported status
+        for every device of the scene that is still in the DB
+        """
+        devices = {str(device["uuid"]): device for device in self.db_manager.get_all_devices()}
+        changes = []
+        for entry in scene["devices"]:
+            uuid, state = entry["uuid"], entry["state"]
+            if (device := devices.get(str(uuid))) is None:
+                logger.warning("Scene device with uuid:%s not in DB!", uuid)
+                continue
+            if (class_obj := self.device_manager.get_supported_device(device["type"])) is None:
+                continue
+            status = device.get("status") if not device.get("offline") else None
+            changed = {
+                parameter: value
+                for parameter, value in state.items()
+                if not class_obj.matches_status(parameter, value, status)
+            }
+            changes.append((device, class_obj, state, changed))
+        return changes
+
+    def apply_scene(self, name: str, timeout: Optional[float] = None) -> Optional[dict]:
+        """
+        Restores a scene and waits up to timeout seconds (confirm_timeout by default) until all devices
+        confirmed their changed parameters. Returns a report of the restore or None if the scene does not exist.
+        """
+        if (scene := self.db_manager.get_scene(name)) is None:
+            return None
+        timeout = self.confirm_timeout if timeout is None else timeout
+        start = time.monotonic()
+        changes = self.get_changes(scene)
+
+        confirmations = []
+        for device, class_obj, state, changed in changes:
+            uuid = device["uuid"]
+            self.transition_manager.cancel_device_transitions(uuid)
+            for parameter, value in changed.items():
+                confirmation = SetConfirmation(parameter, value)
+                if self.comm_manager.set_device_param(
+                    uuid, parameter, value, confirmation=confirmation, record_desired=False, device=device
+                ):
+                    confirmations.append((uuid, confirmation))
+        queued = time.monotonic()
+
+        # The scene is the desired state, also for the parameters that already match
+        def merge(class_obj, state: dict):
+            def update(desired: dict):
+                for parameter, value in state.items():
+                    class_obj.merge_desired(desired, parameter, value)
+            return update
+
+        self.db_manager.update_desired_states(
+            {str(device["uuid"]): (device["uuid"], merge(class_obj, state)) for device, class_obj, state, _ in changes}
+        )
+
+        deadline = start + timeout
+        confirmed = failed = 0
+        for uuid, confirmation in confirmations:
+            result = self.comm_manager.wait_for_confirmation(uuid, confirmation, max(0.0, deadline - time.monotonic()))
+            if result:
+                confirmed += 1
+            elif result is False:
+                failed += 1
+        wall_time = time.monotonic() - start
+
+        num_parameters = sum(len(state) for _, _, state, _ in changes)
+        scene_parameters.labels("sent").inc(len(confirmations))
+        scene_parameters.labels("unchanged").inc(num_parameters - len(confirmations))
+        complete = confirmed == len(confirmations)
+        scene_applies.labels("confirmed" if complete else "incomplete").inc()
+        if complete:
+            scene_apply_duration.observe(wall_time)
+        logger.info(
+            "Restored scene %s: %s of %s parameters sent, %s confirmed in %.1f ms",
+            name, len(confirmations), num_parameters, confirmed, 1000 * wall_time,
+        )
+        return {
+            "scene": name,
+            "devices": len(changes),
+            "changed_devices": sum(1 for *_, changed in changes if changed),
+            "parameters": num_parameters,
+            "sent": len(confirmations),
+            "confirmed": confirmed,
+            "failed": failed,
+            "timeout": len(confirmations) - confirmed - failed,
+            "queue_ms": round(1000 * (queued - start), 1),
+            "wall_time_ms": round(1000 * wall_time, 1),
+        }
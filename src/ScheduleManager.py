@@ -0,0 +1,341 @@
+import heapq
+import math
+from bisect import bisect_left
+import time
+from datetime import datetime, timedelta
+from threading import Condition, Event
+from typing import Optional
+
+from nrf24USB import TX_PRIORITY
+from src.Logger import setup_logger
+from src.Metrics import metrics
+
+logger = setup_logger()
+
+schedule_runs = metrics.counter("nrf_schedule_runs_total", "Runs of scheduled jobs", ("trigger",))
+schedule_skipped = metrics.counter(
+    "nrf_schedule_skipped_total", "Runs of scheduled jobs missed while the hub was down and not caught up"
+)
+schedule_lag = metrics.histogram("nrf_schedule_lag_seconds", "Time from the due time of a job until it ran")
+
+# Lowest and highest value of the fields minute, hour, day of month, month and day of week
+CRON_FIELDS = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+class CronExpression:
+    """
+    A cron expression with the fields minute, hour, day of month, month and day of week (0 and 7 are Sunday).
+    A field is *, a number, a range (8-18), a list (0,30) or has a step (*/10, 8-18/2).
+    Like cron a day matches either the day of month or the day of week if both are restricted.
+    """
+
+    __slots__ = ("minutes", "hours", "days", "months", "weekdays", "any_day", "any_weekday")
+
+    def __init__(self, expression: str):
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError(f"Cron expression {expression} needs 5 fields")
+        minutes, hours, days, months, weekdays = (
+            self.parse_field(field, low, high) for field, (low, high) in zip(fields, CRON_FIELDS)
+        )
+        self.minutes = minutes
+        self.hours = hours
+        self.days = set(days)
+        self.months = set(months)
+        self.weekdays = {weekday % 7 for weekday in weekdays}
+        self.any_day = fields[2] == "*"
+        self.any_weekday = fields[4] == "*"
+        self.next_time(time.time())  # Raises for expressions that never match, e.g. 30 February
+
+    @staticmethod
+    def parse_field(field: str, low: int, high: int) -> list[int]:
+        values = set()
+        for part in field.split(","):
+            step = 1
+            if "/" in part:
+                part, step_str = part.split("/", 1)
+                if (step := int(step_str)) < 1:
+                    raise ValueError(f"Invalid step in {field}")
+            if part == "*":
+                start, end = low, high
+            elif "-" in part:
+                start, end = (int(value) for value in part.split("-", 1))
+            else:
+                start = int(part)
+                end = high if step > 1 else start
+            if not low <= start <= end <= high:
+                raise ValueError(f"{field} is out of range {low}-{high}")
+            values.update(range(start, end + 1, step))
+        return sorted(values)
+
+    def matches_day(self, day: datetime) -> bool:
+        day_matches = day.day in self.days
+        weekday_matches = (day.weekday() + 1) % 7 in self.weekdays
+        if self.any_day and self.any_weekday:
+            return True
+        if self.any_day:
+            return weekday_matches
+        if self.any_weekday:
+            return day_matches
+        return day_matches or weekday_matches
+
+    def next_time(self, after: float) -> float:
+        """
+        Returns the first matching minute after the timestamp after, in local time
+        """
+        start = datetime.fromtimestamp(after).replace(second=0, microsecond=0) + timedelta(minutes=1)
+        day = datetime(start.year, start.month, start.day)
+        for _ in range(5 * 366):
+            if day.month in self.months and self.matches_day(day):
+                first_day = day.date() == start.date()
+                for hour in self.hours[bisect_left(self.hours, start.hour) if first_day else 0 :]:
+                    minutes = self.minutes
+                    if first_day and hour == start.hour:
+                        minutes = minutes[bisect_left(minutes, start.minute) :]
+                    if minutes:
+                        return day.replace(hour=hour, minute=minutes[0]).timestamp()
+            day += timedelta(days=1)
+        raise ValueError("Cron expression never matches")
+
+
+def parse_time(value) -> float:
+    """
+    Returns the timestamp of a local time in the TIME_FORMAT or of a timestamp
+    """
+    if isinstance(value, (int, float)):
+        return float(value)
+    return time.mktime(time.strptime(str(value), TIME_FORMAT))
+
+
+class Job:
+    """
+    A scheduled job: its actions run at the times of a cron expression (trigger {"cron": "0 23 * * *"}),
+    every given seconds counted from its creation ({"every": 600}) or once ({"at": "2024-01-01 23:00:00"}).
+    """
+
+    __slots__ = ("id", "name", "cron", "every", "at", "actions", "catch_up", "created", "next_run", "last_run")
+
+    def __init__(self, job_id: int, schedule: dict):
+        trigger = schedule.get("trigger") or {}
+        self.cron = self.every = self.at = None
+        if "cron" in trigger:
+            self.cron = CronExpression(str(trigger["cron"]))
+        elif "every" in trigger:
+            if (every := float(trigger["every"])) <= 0:
+                raise ValueError("The interval has to be positive")
+            self.every = every
+        elif "at" in trigger:
+            self.at = parse_time(trigger["at"])
+        else:
+            raise ValueError("The trigger needs cron, every or at")
+
+        self.actions = []
+        for action in schedule.get("actions") or []:
+            if not isinstance(action.get("uuid"), list) or "parameter" not in action or "value" not in action:
+                raise ValueError("An action needs the uuid of a device, a parameter and a value")
+            self.actions.append(action)
+        if not self.actions:
+            raise ValueError("A schedule needs at least one action")
+
+        self.id = job_id
+        self.name = schedule.get("name", "")
+        self.catch_up = bool(schedule.get("catch_up", True))
+        self.created = float(schedule.get("created", time.time()))
+        self.next_run: Optional[float] = None
+        self.last_run: Optional[float] = None
+
+    @property
+    def trigger(self) -> str:
+        return "cron" if self.cron is not None else "every" if self.every is not None else "at"
+
+    def get_next_run(self, after: float) -> Optional[float]:
+        """
+        Returns the first run after the timestamp after, or None if the job does not run again
+        """
+        if self.cron is not None:
+            return self.cron.next_time(after)
+        if self.every is not None:
+            return self.created + self.every * (math.floor((after - self.created) / self.every) + 1)
+        return self.at if self.at > after else None
+
+
+class ScheduleManager:
+    """
+    Runs the actions of scheduled jobs, e.g. power off at 23:00 or set the status_interval every 10 minutes.
+
+    The jobs are kept in a heap ordered by their next run, so adding a job is O(log n) and the loop only
+    looks at the top of the heap. Removed or rescheduled jobs leave their old entry in the heap, it is
+    skipped when it comes up. Actions are set through set_device_param with the priority of automations.
+
+    The jobs are stored in the DB. Their last runs are collected and written together every persist_interval
+    seconds. After a restart a job that missed runs while the hub was down runs once if catch_up is set,
+    otherwise it continues with its next run.
+    """
+
+    def __init__(self, comm_manager, shutdown_flag: Event):
+        self.comm_manager = comm_manager
+        self.db_manager = comm_manager.db_manager
+        self.shutdown_flag = shutdown_flag
+        self.condition = Condition()
+        self.jobs: dict[int, Job] = {}
+        self.heap: list[tuple[float, int]] = []
+        self.priority = TX_PRIORITY.AUTOMATION
+
+        # Last runs not written to the DB yet by job id
+        self.runs = {}
+        self.persist_interval = 10.0
+        self.last_persist = time.monotonic()
+
+        metrics.gauge("nrf_schedules", "Scheduled jobs").set_function(lambda: len(self.jobs))
+        self.load()
+
+    def load(self, now: Optional[float] = None):
+        """
+        Reads the jobs from the DB and schedules their next runs, missed runs are caught up at now
+        """
+        now = time.time() if now is None else now
+        last_runs = self.db_manager.get_schedule_runs()
+        jobs, heap = {}, []
+        for stored in self.db_manager.get_schedules():
+            try:
+                job = Job(stored["id"], stored)
+            except (ValueError, KeyError, TypeError) as e:
+                logger.error("Invalid schedule %s: %s", stored.get("id"), e)
+                continue
+            job.last_run = last_runs.get(str(job.id))
+            job.next_run = self.get_first_run(job, now)
+            jobs[job.id] = job
+            if job.next_run is not None:
+                heap.append((job.next_run, job.id))
+        heapq.heapify(heap)
+        with self.condition:
+            self.jobs, self.heap = jobs, heap
+            self.condition.notify()
+
+    def get_first_run(self, job: Job, now: float) -> Optional[float]:
+        next_run = job.get_next_run(job.last_run if job.last_run is not None else job.created)
+        if next_run is None or next_run >= now:
+            return next_run
+        if job.catch_up:
+            missed = time.strftime(TIME_FORMAT, time.localtime(next_run))
+            logger.info("Catch up schedule %s %s missed at %s", job.id, job.name, missed)
+            return now
+        schedule_skipped.inc()
+        return job.get_next_run(now)
+
+    def add_schedule(self, schedule: dict) -> Optional[int]:
+        """
+        Checks and stores a schedule, returns its id or None if it is invalid or never runs
+        """
+        schedule = dict(schedule, created=time.time())
+        try:
+            job = Job(0, schedule)
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            logger.warning("Invalid schedule: %s", e)
+            return None
+        if (next_run := job.get_next_run(job.created)) is None:
+            logger.warning("Schedule at %s is in the past", schedule["trigger"]["at"])
+            return None
+        if (job_id := self.db_manager.add_schedule(schedule)) is None:
+            return None
+        job.id = job_id
+        with self.condition:
+            self.jobs[job_id] = job
+            self.push(job, next_run)
+        return job_id
+
+    def remove_schedule(self, job_id: int) -> bool:
+        if not self.db_manager.remove_schedule(job_id):
+            return False
+        with self.condition:
+            self.jobs.pop(job_id, None)
+            self.runs.pop(job_id, None)
+        return True
+
+    def get_schedules(self) -> list[dict]:
+        """
+        Returns the stored schedules with their last and next run
+        """
+        schedules = self.db_manager.get_schedules()
+        for schedule in schedules:
+            job = self.jobs.get(schedule["id"])
+            schedule["last_run"] = job.last_run if job is not None else None
+            schedule["next_run"] = job.next_run if job is not None else None
+        return schedules
+
+    def push(self, job: Job, next_run: Optional[float]):
+        """
+        Schedules the next run of a job, must be called with the condition held
+        """
+        job.next_run = next_run
+        if next_run is None:
+            return
+        heapq.heappush(self.heap, (next_run, job.id))
+        if self.heap[0][1] == job.id:
+            self.condition.notify()
+
+    def get_due(self, now: float) -> list[tuple[Job, float]]:
+        """
+        Takes the jobs that are due at now from the heap
+        """
+        due = []
+        with self.condition:
+            while self.heap and self.heap[0][0] <= now:
+                next_run, job_id = heapq.heappop(self.heap)
+                job = self.jobs.get(job_id)
+                # Removed or rescheduled in the meantime
+                if job is None or job.next_run != next_run:
+                    continue
+                due.append((job, next_run))
+        return due
+
+    def run_pending(self, now: Optional[float] = None) -> int:
+        """
+        Runs the jobs that are due at now and schedules their next runs. Returns the number of jobs that ran.
+        """
+        now = time.time() if now is None else now
+        due = self.get_due(now)
+        for job, due_time in due:
+            schedule_lag.observe(max(0.0, now - due_time))
+            schedule_runs.labels(job.trigger).inc()
+            logger.debug("Run schedule %s %s", job.id, job.name)
+            for action in job.actions:
+                self.comm_manager.set_device_param(
+                    action["uuid"], action["parameter"], str(action["value"]), priority=self.priority
+                )
+            with self.condition:
+                job.last_run = now
+                if self.jobs.get(job.id) is job:
+                    self.runs[job.id] = now
+                    # Runs that were missed in the meantime are not repeated
+                    self.push(job, job.get_next_run(max(now, due_time)))
+        return len(due)
+
+    def persist_runs(self):
+        """
+        Writes the last runs collected since the previous call to the DB
+        """
+        with self.condition:
+            runs, self.runs = self.runs, {}
+        self.last_persist = time.monotonic()
+        if runs:
+            self.db_manager.save_schedule_runs({str(job_id): last_run for job_id, last_run in runs.items()})
+
+    def run(self):
+        """
+        Runs the jobs when they are due until the shutdown_flag is set.
+        The loop wakes up at least every 0.5 seconds, so a changed wall clock is noticed.
+        """
+        while not self.shutdown_flag.is_set():
+            with self.condition:
+                wait = 0.5
+                if self.heap:
+                    wait = min(wait, self.heap[0][0] - time.time())
+                if wait > 0:
+                    self.condition.wait(wait)
+            self.run_pending()
+            if time.monotonic() - self.last_persist >= self.persist_interval:
+                self.persist_runs()
+        self.persist_runs()
+        logger.info("Stopped ScheduleManager")
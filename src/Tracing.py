@@ -0,0 +1,99 @@
+import time
+from collections import deque
+from threading import Lock
+from typing import Optional
+
+from src.Metrics import metrics
+
+stage_duration = metrics.histogram(
+    "nrf_trace_stage_seconds", "Time a received message spent in each processing stage", ("stage",)
+)
+total_duration = metrics.histogram(
+    "nrf_trace_total_seconds", "Time from receiving a message on the serial port until the end of its processing"
+)
+
+
+class MessageTrace:
+    """
+    Follows a single received message through the processing stages.
+    All times are time.monotonic() values, starting with the arrival time in NRF24Device.read_loop.
+    """
+
+    __slots__ = ("rx_time", "stages", "uuid", "msg_type")
+
+    def __init__(self, rx_time: float):
+        self.rx_time = rx_time
+        self.stages: list[tuple[str, float]] = []
+        self.uuid: Optional[list[int]] = None
+        self.msg_type: Optional[int] = None
+
+    def mark(self, stage: str):
+        """
+        Records the end of a processing stage
+        """
+        now = time.monotonic()
+        last = self.stages[-1][1] if self.stages else self.rx_time
+        self.stages.append((stage, now))
+        stage_duration.labels(stage).observe(now - last)
+
+    def to_dict(self) -> dict:
+        last = self.rx_time
+        stages = []
+        for stage, t in self.stages:
+            stages.append({"stage": stage, "duration_ms": round(1000 * (t - last), 3)})
+            last = t
+        return {
+            "uuid": self.uuid,
+            "msg_type": self.msg_type,
+            "total_ms": round(1000 * (last - self.rx_time), 3),
+            "stages": stages,
+        }
+
+
+class Tracer:
+    """
+    Creates the MessageTraces and keeps a sample of the finished ones.
+    Every trace updates the per stage histograms, only every sample_every-th trace is stored.
+    """
+
+    def __init__(self, sample_every: int = 10, max_samples: int = 200):
+        self.sample_every = sample_every
+        self.samples = deque(maxlen=max_samples)
+        self.num_finished = 0
+        self.lock = Lock()
+
+    def start(self, rx_time: Optional[float]) -> MessageTrace:
+        return MessageTrace(rx_time if rx_time is not None else time.monotonic())
+
+    def finish(self, trace: Optional[MessageTrace], stage: Optional[str] = None):
+        """
+        Ends a trace, optionally marking a last stage.
+        """
+        if trace is None:
+            return
+        if stage is not None:
+            trace.mark(stage)
+        end = trace.stages[-1][1] if trace.stages else trace.rx_time
+        total_duration.observe(end - trace.rx_time)
+        with self.lock:
+            self.num_finished += 1
+            if self.num_finished % self.sample_every == 0:
+                self.samples.append(trace)
+
+    def get_stage_stats(self) -> dict:
+        """
+        Returns count and mean duration in ms for every stage
+        """
+        stats = {}
+        for (stage,), child in list(stage_duration.children.items()):
+            mean = 1000 * child.sum / child.count if child.count else 0
+            stats[stage] = {"count": child.count, "mean_ms": round(mean, 3)}
+        return stats
+
+    def get_traces(self) -> list[dict]:
+        with self.lock:
+            samples = list(self.samples)
+        return [trace.to_dict() for trace in samples]
+
+
+tracer = Tracer()
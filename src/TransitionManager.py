@@ -0,0 +1,203 @@
+import time
+from collections import deque
+from threading import Condition, Event
+from typing import Optional
+from src.CommunicationManager import CommunicationManager
+from src.Logger import setup_logger
+from src.Metrics import metrics
+
+logger = setup_logger()
+
+transition_frames = metrics.counter("nrf_transition_frames_total", "Intermediate values sent by the transition engine")
+transition_frames_skipped = metrics.counter(
+    "nrf_transition_frames_skipped_total", "Transition steps dropped because the global frame budget was used up"
+)
+
+
+class Transition:
+    """
+    Interpolates a parameter of a device linearly from its start to its target value.
+    Values with several components (e.g. rgb) are interpolated per component.
+    """
+
+    def __init__(self, uuid: list[int], parameter: str, start: list[float], target: list[float], duration: float):
+        self.uuid = uuid
+        self.parameter = parameter
+        self.start = start
+        self.target = target
+        self.duration = duration
+        self.start_time = time.monotonic()
+        self.last_frame = 0.0
+        self.last_value = None
+
+    def get_value(self, now: float) -> str:
+        progress = min(1.0, (now - self.start_time) / self.duration) if self.duration > 0 else 1.0
+        return ",".join(str(round(s + (t - s) * progress)) for s, t in zip(self.start, self.target))
+
+    def is_finished(self, now: float) -> bool:
+        return now - self.start_time >= self.duration
+
+
+class TransitionManager:
+    """
+    Runs the transitions of all devices in a single timer loop.
+    Every tick the transitions that waited the longest get a frame until the global frame budget is used up,
+    so many simultaneous fades are slowed down instead of flooding the dongle. The acknowledged final values
+    and the commits of streamed values are counted against the budget as well.
+    The steps are sent as streamed values, which the CommunicationManager coalesces to the latest value per device.
+    """
+
+    def __init__(self, comm_manager: CommunicationManager, shutdown_flag: Event):
+        self.comm_manager = comm_manager
+        self.db_manager = comm_manager.db_manager
+        self.shutdown_flag = shutdown_flag
+
+        # Frames per second for a single transition and for all transitions together
+        self.frame_rate = 20.0
+        self.frame_budget = 60.0
+
+        # Active transitions by (uuid_string, target parameter)
+        self.transitions: dict[tuple[str, str], Transition] = {}
+        self.condition = Condition()
+        self.sent_frames = deque()
+        comm_manager.forget_handlers.append(self.cancel_device_transitions)
+
+        metrics.gauge("nrf_transitions_active", "Transitions currently running").set_function(
+            lambda: len(self.transitions)
+        )
+        metrics.gauge("nrf_transition_target_fps", "Frames per second a single transition aims for").set_function(
+            lambda: self.frame_rate
+        )
+        metrics.gauge(
+            "nrf_transition_achieved_fps", "Frames per second a transition got on average during the last second"
+        ).set_function(lambda: self.get_stats()["achieved_fps"])
+
+    def parse_value(self, value) -> Optional[list[float]]:
+        try:
+            return [float(x) for x in str(value).split(",")]
+        except ValueError:
+            return None
+
+    def start_transition(self, uuid: list[int], parameter: str, new_val: str, duration: float) -> bool:
+        """
+        Changes the parameter of a device to new_val over duration seconds
+        """
+        if (device := self.db_manager.search_device_in_db(uuid)) is None:
+            logger.error(f"Device with uuid:{uuid} not in DB!")
+            return False
+        if (class_obj := self.comm_manager.device_manager.get_supported_device(device["type"])) is None:
+            logger.warning(f"{device['type']} not supported")
+            return False
+        if parameter not in class_obj.streamable_parameters:
+            logger.warning(f"Transition for parameter {parameter} not supported")
+            return False
+        key = (str(uuid), class_obj.get_target(parameter))
+
+        with self.condition:
+            # A running transition of the same parameter continues from its current value
+            running = self.transitions.pop(key, None)
+            if running is not None and running.parameter == parameter:
+                current = running.get_value(time.monotonic())
+            else:
+                current = self.comm_manager.get_device_param(uuid, parameter)
+            start = self.parse_value(current) if current is not None else None
+            target = self.parse_value(new_val)
+            if target is None:
+                return False
+            if duration <= 0 or start is None or len(start) != len(target):
+                return self.comm_manager.set_device_param(uuid, parameter, str(new_val))
+
+            logger.info("transition %s parameter: %s to %s in %ss", uuid, parameter, new_val, duration)
+            self.transitions[key] = Transition(uuid, parameter, start, target, duration)
+            self.condition.notify()
+        return True
+
+    def cancel_transition(self, uuid: list[int], parameter: str):
+        """
+        Stops a running transition of the parameter, e.g. because a new value was set directly
+        """
+        if (device := self.db_manager.search_device_in_db(uuid)) is None:
+            return
+        if (class_obj := self.comm_manager.device_manager.get_supported_device(device["type"])) is None:
+            return
+        with self.condition:
+            self.transitions.pop((str(uuid), class_obj.get_target(parameter)), None)
+
+    def cancel_device_transitions(self, uuid: list[int]):
+        """
+        Stops all running transitions of a device
+        """
+        uuid_string = str(uuid)
+        with self.condition:
+            for key in [key for key in self.transitions if key[0] == uuid_string]:
+                del self.transitions[key]
+
+    def get_stats(self) -> dict:
+        now = time.monotonic()
+        with self.condition:
+            while self.sent_frames and self.sent_frames[0] < now - 1:
+                self.sent_frames.popleft()
+            active = len(self.transitions)
+            frames = len(self.sent_frames)
+        return {
+            "active": active,
+            "target_fps": self.frame_rate,
+            "achieved_fps": round(frames / active, 1) if active else 0.0,
+            "frame_budget": self.frame_budget,
+        }
+
+    def run(self):
+        """
+        Sends the steps of all running transitions until the shutdown_flag is set
+        """
+        credit = 0.0
+        commits = self.comm_manager.stream_commits
+        next_tick = time.monotonic()
+        while not self.shutdown_flag.is_set():
+            with self.condition:
+                if not self.transitions:
+                    self.condition.wait(0.5)
+                    next_tick = time.monotonic()
+                    continue
+                now = time.monotonic()
+                if now < next_tick:
+                    self.condition.wait(next_tick - now)
+                    continue
+                next_tick = max(next_tick + 1 / self.frame_rate, now)
+
+                # Unused budget of a tick is not carried over. The commits sent since the last tick are
+                # paid back from the budget, so they can delay the next steps.
+                budget_per_tick = self.frame_budget / self.frame_rate
+                credit = min(credit + budget_per_tick, budget_per_tick)
+                sent_commits = self.comm_manager.stream_commits
+                credit -= sent_commits - commits
+                commits = sent_commits
+                steps = []
+                ordered = sorted(self.transitions.items(), key=lambda item: item[1].last_frame)
+                # The acknowledged final values go first, many transitions that end together are finished
+                # over the next ticks
+                for key, transition in ordered:
+                    if transition.is_finished(now) and credit >= 1:
+                        credit -= 1
+                        del self.transitions[key]
+                        steps.append((transition, transition.get_value(now), False))
+                for key, transition in ordered:
+                    if transition.is_finished(now):
+                        continue
+                    value = transition.get_value(now)
+                    if value == transition.last_value:
+                        continue
+                    if credit < 1:
+                        transition_frames_skipped.inc()
+                        continue
+                    credit -= 1
+                    transition.last_frame = now
+                    transition.last_value = value
+                    self.sent_frames.append(now)
+                    steps.append((transition, value, True))
+
+            for transition, value, stream in steps:
+                if stream:
+                    transition_frames.inc()
+                self.comm_manager.set_device_param(transition.uuid, transition.parameter, value, stream)
+        logger.info("Stopped TransitionManager")
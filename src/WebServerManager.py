@@ -3,17 +3,27 @@ from flask_cors import CORS
 from flask_httpauth import HTTPBasicAuth
 from threading import Thread, Event
 from src.DBManager import DBManager
-from src.CommunicationManager import CommunicationManager
+from src.CommunicationManager import CommunicationManager, SetConfirmation
+from src.TransitionManager import TransitionManager
+from src.SceneManager import SceneManager
 import json
-import time
 import gzip
-from src.Logger import setup_logger, log_queue
+from src.Logger import setup_logger, get_logs
+from src.Metrics import metrics
+from src.Tracing import tracer
+from src.EventBus import event_bus
 
 logger = setup_logger()
 
 
 class WebServerManager:
-    def __init__(self, db_manager: DBManager, comm_manager: CommunicationManager, restart_flag: Event):
+    def __init__(
+        self,
+        db_manager: DBManager,
+        comm_manager: CommunicationManager,
+        transition_manager: TransitionManager,
+        restart_flag: Event,
+    ):
         # Initialize Flask app
         self.app = Flask(__name__)
         self.app.config["TEMPLATES_AUTO_RELOAD"] = True
@@ -33,7 +43,11 @@ class WebServerManager:
         self.db_manager = db_manager
         self.restart_flag = restart_flag
         self.comm_manager = comm_manager
+        self.transition_manager = transition_manager
+        self.scene_manager = SceneManager(comm_manager, transition_manager)
         self.server = None
+        # Seconds without events after which the event stream sends a keepalive comment
+        self.keepalive_interval = 15.0
 
         # Define routes
         @self.auth.verify_password
@@ -60,39 +74,81 @@ class WebServerManager:
         @self.app.route("/stream")
         @self.auth.login_required
         def stream():
+            """
+            Server-sent events: first all devices, then the state changes ("state" events) and the events
+            of remotes ("remote" events) as they happen. ?uuid= and ?topic= only stream the events of a
+            device or topic.
+            """
+            uuid = None
+            if (device_uuid := request.args.get("uuid")) is not None and (uuid := self.parse_uuid(device_uuid)) is None:
+                return Response(status=400, response="Unable to parse UUID")
+            topics = request.args.getlist("topic") or None
+            # A client that does not keep up is disconnected instead of holding events for it
+            subscription = event_bus.subscribe("sse", topics=topics, uuid=uuid, maxsize=1000, overflow="close")
+
             def generate():
-                while True:
-                    try:
-                        devices = self.db_manager.get_all_devices()
-                        logger.info(f"Devices fetched: {devices}")
-                        yield f"data: {json.dumps(devices)}\n\n"
-                    except Exception as e:
-                        logger.error(f"An error occurred while fetching devices: {e}")
-                        yield f"data: {{'error': 'An error occurred while fetching devices.'}}\n\n"
-                    time.sleep(5)
+                try:
+                    devices = self.db_manager.get_all_devices()
+                    yield f"data: {json.dumps(devices)}\n\n"
+                    while not subscription.closed:
+                        if (event := subscription.get(timeout=self.keepalive_interval)) is None:
+                            yield ": keepalive\n\n"
+                            continue
+                        yield f"event: {event.topic}\ndata: {json.dumps(event.to_dict())}\n\n"
+                finally:
+                    subscription.close()
 
             logger.info("Received a request for /stream endpoint")
             return Response(generate(), mimetype="text/event-stream")
 
+        @self.app.route("/metrics", methods=["GET"])
+        @self.auth.login_required
+        def get_metrics():
+            """
+            Endpoint to get the internal metrics in the Prometheus text format.
+            """
+            return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+        @self.app.route("/traces", methods=["GET"])
+        @self.auth.login_required
+        def get_traces():
+            """
+            Endpoint to get the per stage latencies and a sample of traced messages.
+            """
+            return jsonify({"stages": tracer.get_stage_stats(), "traces": tracer.get_traces()}), 200
+
+        @self.app.route("/transitions", methods=["GET"])
+        @self.auth.login_required
+        def get_transitions():
+            """
+            Endpoint to get the number of running transitions and their target and achieved frame rates.
+            """
+            return jsonify(self.transition_manager.get_stats()), 200
+
+        @self.app.route("/provisioning", methods=["GET", "POST", "DELETE"])
+        @self.auth.login_required
+        def provisioning():
+            """
+            Endpoint to start (POST), query (GET) and finish (DELETE) a provisioning session.
+            The stats report how many new devices were paired since the session started.
+            """
+            pairing = self.comm_manager.pairing
+            if request.method == "POST":
+                pairing.start_provisioning()
+                return jsonify(pairing.get_stats()), 200
+            stats = pairing.stop_provisioning() if request.method == "DELETE" else pairing.get_stats()
+            if stats is None:
+                return jsonify({"error": "No provisioning session running"}), 404
+            return jsonify(stats), 200
+
         @self.app.route("/logs", methods=["GET"])
         @self.auth.login_required
         def get_logs():
             """
             Endpoint to get log Messages.
             """
-            log_list = []
-            temp = list(log_queue.queue)
-            
-            for record in temp:
-                # Assuming your JSON formatter returns a JSON string as the log message
-                log_entry_json = record.getMessage()  
-                
-                # Convert the JSON string to a Python dictionary
-                log_entry_dict = json.loads(log_entry_json)
-                
-                log_list.append(log_entry_dict)
-            
-            content = json.dumps(log_list)
+            # The entries are already serialised by the JsonFormatter
+            content = "[" + ",".join(get_logs()) + "]"
             compressed_content = gzip.compress(bytes(content, 'utf-8'))
 
             response = make_response(compressed_content)
@@ -103,6 +159,222 @@ class WebServerManager:
             return response
 
 
+        @self.app.route("/bindings", methods=["GET"])
+        @self.auth.login_required
+        def get_bindings():
+            """
+            Endpoint to get the bindings of remote events to actions.
+            """
+            return jsonify(self.db_manager.get_bindings()), 200
+
+        @self.app.route("/bindings", methods=["POST"])
+        @self.auth.login_required
+        def add_binding():
+            """
+            Endpoint to bind an event of a remote to an action (toggle, increase or decrease) on a device parameter.
+            Without a target the action goes to the device the remote is set to.
+            """
+            data = request.json
+            if data is None:
+                return Response(status=400, response="Empty request")
+            remote = self.parse_uuid(str(data.get("remote", "")))
+            target = self.parse_uuid(str(data["target"])) if data.get("target") is not None else None
+            if remote is None or (data.get("target") is not None and target is None):
+                return Response(status=400, response="Unable to parse UUID")
+            try:
+                step = int(data.get("step", 1))
+            except ValueError:
+                return Response(status=400, response="Invalid step")
+            binding_id = self.comm_manager.bindings.add_binding(
+                remote, str(data.get("event")), target, str(data.get("parameter")), str(data.get("action")), step
+            )
+            if binding_id is None:
+                return Response(status=400, response="Invalid binding")
+            return jsonify({"id": binding_id}), 201
+
+        @self.app.route("/bindings/<int:binding_id>", methods=["DELETE"])
+        @self.auth.login_required
+        def remove_binding(binding_id: int):
+            """
+            Endpoint to remove a binding.
+            """
+            if not self.comm_manager.bindings.remove_binding(binding_id):
+                return Response(status=404, response="Binding not found")
+            return Response()
+
+        @self.app.route("/rules", methods=["GET"])
+        @self.auth.login_required
+        def get_rules():
+            """
+            Endpoint to get the automation rules.
+            """
+            return jsonify(self.db_manager.get_rules()), 200
+
+        @self.app.route("/rules", methods=["POST"])
+        @self.auth.login_required
+        def add_rule():
+            """
+            Endpoint to add an automation rule. The trigger is an event of a remote or a status field of a device
+            compared with op and value, every action sets a value or steps a parameter of a device, e.g.
+            {"trigger": {"uuid": "1-2-3-4", "field": "humidity", "op": ">", "value": 70},
+             "actions": [{"uuid": "1-2-3-5", "parameter": "rgb", "value": "255,0,0"}]}
+            """
+            data = request.json
+            if not isinstance(data, dict):
+                return Response(status=400, response="Empty request")
+            try:
+                data["trigger"]["uuid"] = self.parse_uuid(str(data["trigger"]["uuid"]))
+                for action in data["actions"]:
+                    action["uuid"] = self.parse_uuid(str(action["uuid"]))
+            except (KeyError, TypeError):
+                return Response(status=400, response="Invalid rule")
+            if (rule_id := self.comm_manager.rules.add_rule(data)) is None:
+                return Response(status=400, response="Invalid rule")
+            return jsonify({"id": rule_id}), 201
+
+        @self.app.route("/rules/<int:rule_id>", methods=["DELETE"])
+        @self.auth.login_required
+        def remove_rule(rule_id: int):
+            """
+            Endpoint to remove an automation rule.
+            """
+            if not self.comm_manager.rules.remove_rule(rule_id):
+                return Response(status=404, response="Rule not found")
+            return Response()
+
+        @self.app.route("/schedules", methods=["GET"])
+        @self.auth.login_required
+        def get_schedules():
+            """
+            Endpoint to get the schedules with the time of their last and next run.
+            """
+            return jsonify(self.comm_manager.schedules.get_schedules()), 200
+
+        @self.app.route("/schedules", methods=["POST"])
+        @self.auth.login_required
+        def add_schedule():
+            """
+            Endpoint to add a schedule. The trigger is a cron expression, an interval in seconds or a single time,
+            e.g. {"trigger": {"cron": "0 23 * * *"}, "actions": [{"uuid": "1-2-3-4", "parameter": "power", "value": 0}]}
+            or {"trigger": {"at": "2024-12-24 18:00:00"}, ...}. With "catch_up": false runs missed while
+            the hub was down are skipped.
+            """
+            data = request.json
+            if not isinstance(data, dict):
+                return Response(status=400, response="Empty request")
+            try:
+                for action in data["actions"]:
+                    action["uuid"] = self.parse_uuid(str(action["uuid"]))
+            except (KeyError, TypeError):
+                return Response(status=400, response="Invalid schedule")
+            if (schedule_id := self.comm_manager.schedules.add_schedule(data)) is None:
+                return Response(status=400, response="Invalid schedule")
+            return jsonify({"id": schedule_id}), 201
+
+        @self.app.route("/schedules/<int:schedule_id>", methods=["DELETE"])
+        @self.auth.login_required
+        def remove_schedule(schedule_id: int):
+            """
+            Endpoint to remove a schedule.
+            """
+            if not self.comm_manager.schedules.remove_schedule(schedule_id):
+                return Response(status=404, response="Schedule not found")
+            return Response()
+
+        @self.app.route("/groups", methods=["GET"])
+        @self.auth.login_required
+        def get_groups():
+            """
+            Endpoint to get the groups of devices.
+            """
+            return jsonify(self.db_manager.get_groups()), 200
+
+        @self.app.route("/groups/<name>", methods=["PUT"])
+        @self.auth.login_required
+        def save_group(name: str):
+            """
+            Endpoint to create or replace a group, e.g. {"members": ["1-2-3-4", "1-2-3-5"]}.
+            """
+            data = request.json
+            if not isinstance(data, dict) or not isinstance(data.get("members"), list):
+                return Response(status=400, response="Empty request")
+            members = [self.parse_uuid(str(member)) for member in data["members"]]
+            if None in members:
+                return Response(status=400, response="Unable to parse UUID")
+            if not self.scene_manager.save_group(name, members):
+                return Response(status=400, response="Device not found")
+            return Response()
+
+        @self.app.route("/groups/<name>", methods=["DELETE"])
+        @self.auth.login_required
+        def remove_group(name: str):
+            """
+            Endpoint to remove a group.
+            """
+            if not self.db_manager.remove_group(name):
+                return Response(status=404, response="Group not found")
+            return Response()
+
+        @self.app.route("/scenes", methods=["GET"])
+        @self.auth.login_required
+        def get_scenes():
+            """
+            Endpoint to get the scenes.
+            """
+            return jsonify(self.db_manager.get_scenes()), 200
+
+        @self.app.route("/scenes/<name>", methods=["PUT"])
+        @self.auth.login_required
+        def capture_scene(name: str):
+            """
+            Endpoint to capture the current status of the devices of a group ({"group": "living_room"})
+            or of a list of devices ({"members": ["1-2-3-4"]}) as a scene.
+            """
+            data = request.json
+            if not isinstance(data, dict):
+                return Response(status=400, response="Empty request")
+            if "group" in data:
+                if (members := self.scene_manager.get_members(str(data["group"]))) is None:
+                    return Response(status=404, response="Group not found")
+            elif isinstance(data.get("members"), list):
+                members = [self.parse_uuid(str(member)) for member in data["members"]]
+                if None in members:
+                    return Response(status=400, response="Unable to parse UUID")
+            else:
+                return Response(status=400, response="Neither group nor members given")
+            if (scene := self.scene_manager.capture_scene(name, members)) is None:
+                return Response(status=400, response="No device with a status to capture")
+            return jsonify(scene), 200
+
+        @self.app.route("/scenes/<name>/apply", methods=["POST"])
+        @self.auth.login_required
+        def apply_scene(name: str):
+            """
+            Endpoint to restore a scene. Returns once all devices confirmed their changes, or after ?wait=<ms>,
+            with the number of sent and confirmed parameters and the wall time of the restore.
+            """
+            try:
+                wait = float(request.args["wait"]) / 1000 if "wait" in request.args else None
+            except ValueError:
+                return Response(status=400, response="Unable to parse wait")
+            if (report := self.scene_manager.apply_scene(name, wait)) is None:
+                return Response(status=404, response="Scene not found")
+            if report["failed"]:
+                return jsonify(report), 502  # A device did not acknowledge its SET
+            if report["timeout"]:
+                return jsonify(report), 504  # Not confirmed within wait
+            return jsonify(report), 200
+
+        @self.app.route("/scenes/<name>", methods=["DELETE"])
+        @self.auth.login_required
+        def remove_scene(name: str):
+            """
+            Endpoint to remove a scene.
+            """
+            if not self.db_manager.remove_scene(name):
+                return Response(status=404, response="Scene not found")
+            return Response()
+
         @self.app.route("/devices", methods=["GET"])
         @self.auth.login_required
         def get_devices():
@@ -137,7 +409,7 @@ class WebServerManager:
             uuid = self.parse_uuid(device_uuid)
             if uuid is None:
                 return Response(status=400, response="Unable to parse UUID")
-            self.db_manager.remove_device_from_db(uuid)
+            self.comm_manager.forget_device(uuid)
             return Response()
 
         @self.app.route("/devices/<device_uuid>", methods=["GET"])
@@ -180,12 +452,19 @@ class WebServerManager:
         @self.auth.login_required
         def set_device_param(device_uuid, parameter):
             """
-            Endpoint to set a single parameter of a specific device
+            Endpoint to set a single parameter of a specific device.
+            With "stream": true the value is an intermediate value of a continuous change (e.g. a dragged slider).
+            With "transition": <seconds> the parameter is faded to the value.
+            With ?wait=<ms> the request returns once an OK status of the device reports the value, or after wait ms.
             """
             data = request.json
             uuid = self.parse_uuid(device_uuid)
             if uuid is None or data is None:
                 return Response(status=400, response="Empty request or unable to parse UUID")
+            try:
+                wait = float(request.args.get("wait", 0)) / 1000
+            except ValueError:
+                return Response(status=400, response="Unable to parse wait")
             new_val = data.get("value")
             device = self.db_manager.search_device_in_db(uuid)
             if device == None:
@@ -193,9 +472,31 @@ class WebServerManager:
             status = device.get("status")
             if status == None:
                 return Response(status=400, response="Device does not have a status")
-            if not self.comm_manager.set_device_param(uuid, parameter, str(new_val)):
+            try:
+                transition = float(data.get("transition", 0))
+            except (TypeError, ValueError):
+                return Response(status=400, response="Unable to parse transition")
+            stream = bool(data.get("stream", False))
+            if wait > 0 and (transition > 0 or stream):
+                return Response(status=400, response="Only single values can be waited for")
+            if transition > 0:
+                if not self.transition_manager.start_transition(uuid, parameter, str(new_val), transition):
+                    return Response(status=400, response="Unable to parse request")
+                return Response()
+            if not stream:
+                self.transition_manager.cancel_transition(uuid, parameter)
+            confirmation = SetConfirmation(parameter, str(new_val)) if wait > 0 else None
+            if not self.comm_manager.set_device_param(uuid, parameter, str(new_val), stream, confirmation):
                 return Response(status=400, response="Unable to parse request")
-            return Response()
+            if confirmation is None:
+                return Response()
+            confirmed = self.comm_manager.wait_for_confirmation(uuid, confirmation, wait)
+            result = {"confirmed": bool(confirmed), "latency_ms": round(1000 * confirmation.latency, 1) if confirmed else None}
+            if confirmed is None:
+                return jsonify(result), 504  # Not confirmed within wait
+            if not confirmed:
+                return jsonify(result), 502  # The device did not acknowledge the SET
+            return jsonify(result), 200
 
     def parse_uuid(self, device_uuid):
         try:
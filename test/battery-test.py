@@ -0,0 +1,64 @@
+import os
+import sys
+import time
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from simulator import SimulatedDongle, SimulatedDevice
+from src.DBManager import DBManager
+from src.DeviceManager import DeviceManager
+from src.CommunicationManager import CommunicationManager
+
+# Rebinds the target of a simulated battery powered RotRemote that only listens for 0.3 s after each status.
+# Compares sending right away and retrying with holding the command until the remote wakes up.
+# Every command is issued while the remote sleeps. Reports the transmissions needed per delivered command.
+
+UUID = [10, 20, 30, 1]
+NUM_COMMANDS = 5
+
+os.chdir(tempfile.mkdtemp())
+db_manager = DBManager()
+dongle = SimulatedDongle()
+remote = SimulatedDevice(1, UUID, [0, 0, 0, 0, 0], 1, status_rate=1, battery=200, listen_time=0.3)
+dongle.add_device(remote)
+db_manager.add_device_to_db(
+    {"uuid": UUID, "id": 1, "version": 1, "battery_powered": True, "battery_level": 200,
+     "type": "RotRemote", "name": "remote", "status_interval": 1, "last_seen": ""}
+)
+device_manager = DeviceManager(db_manager, dongle)
+device_manager.start()
+shutdown_flag = threading.Event()
+comm_manager = CommunicationManager(device_manager, shutdown_flag)
+threads = [
+    threading.Thread(target=comm_manager.listen),
+    threading.Thread(target=comm_manager.send_pending_commands),
+]
+for thread in threads:
+    thread.start()
+time.sleep(0.5)
+
+for hold in (False, True):
+    comm_manager.hold_battery_commands = hold
+    first_sent = len(dongle.received)
+    first_received = len(remote.received)
+    start = time.monotonic()
+    for i in range(NUM_COMMANDS):
+        # The command is issued while the remote sleeps
+        while time.monotonic() - remote.last_send_time < 0.4:
+            time.sleep(0.01)
+        comm_manager.set_device_param(UUID, "target", f"{i + 2},1,2,3,4")
+        while comm_manager.parameter_buffer.get(str(UUID)) and time.monotonic() - start < 30:
+            time.sleep(0.01)
+    transmissions = len(dongle.received) - first_sent
+    delivered = len(remote.received) - first_received
+    print(
+        f"hold={hold}: {delivered}/{NUM_COMMANDS} delivered with {transmissions} transmissions"
+        f" in {time.monotonic() - start:.1f}s"
+    )
+
+shutdown_flag.set()
+for thread in threads:
+    thread.join()
+device_manager.stop()
@@ -0,0 +1,101 @@
+import os
+import sys
+import time
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from simulator import SimulatedDongle, SimulatedDevice
+from nrf24Smart import MultiSetMessage, CHANGE_TYPES
+from src.DBManager import DBManager
+from src.DeviceManager import DeviceManager
+from src.CommunicationManager import CommunicationManager
+from src.EventBus import event_bus
+
+# A simulated SensRemote is bound to a LedController3Ch: click_up toggles the power of the device the remote
+# is set to, click_down decreases the brightness of the LedController by 50.
+# Reports the time from the button press until the LedController received the SET and checks the resulting
+# status, the desired state and that the remote events were still published.
+
+REMOTE_UUID = [10, 20, 60, 1]
+LED_UUID = [10, 20, 60, 2]
+NUM_TOGGLES = 21
+
+os.chdir(tempfile.mkdtemp())
+db_manager = DBManager()
+dongle = SimulatedDongle()
+remote = SimulatedDevice(1, REMOTE_UUID, [0] * 13, 1, status_rate=0)
+led = SimulatedDevice(2, LED_UUID, [0, 255, 0, 0, 0, 3, 0, 0, 128, 63], 3, status_rate=1)
+received = []
+
+
+def apply_set(data: list[int]):
+    received.append(time.monotonic())
+    for record in MultiSetMessage.from_raw(data).set_messages:
+        value = led.status_data[record.varIndex]
+        if record.changeType is CHANGE_TYPES.TOGGLE:
+            value = 0 if value else 1
+        elif record.changeType is CHANGE_TYPES.INCREASE:
+            value = min(255, value + record.newValue[0])
+        elif record.changeType is CHANGE_TYPES.DECREASE:
+            value = max(0, value - record.newValue[0])
+        else:
+            value = record.newValue[0]
+        led.status_data[record.varIndex] = value
+
+
+led.set_handler = apply_set
+dongle.add_device(remote)
+dongle.add_device(led)
+for device_id, uuid, device_type, version in ((1, REMOTE_UUID, "SensRemote", 1), (2, LED_UUID, "LedController3Ch", 3)):
+    db_manager.add_device_to_db(
+        {"uuid": uuid, "id": device_id, "version": version, "battery_powered": False, "battery_level": 255,
+         "type": device_type, "name": device_type, "status_interval": 1, "last_seen": ""}
+    )
+device_manager = DeviceManager(db_manager, dongle)
+device_manager.start()
+shutdown_flag = threading.Event()
+comm_manager = CommunicationManager(device_manager, shutdown_flag)
+threads = [
+    threading.Thread(target=comm_manager.listen),
+    threading.Thread(target=comm_manager.send_pending_commands),
+]
+for thread in threads:
+    thread.start()
+
+assert comm_manager.bindings.add_binding(REMOTE_UUID, "click_up", None, "power", "toggle") is not None
+assert comm_manager.bindings.add_binding(REMOTE_UUID, "click_down", LED_UUID, "brightness", "decrease", 50) is not None
+assert comm_manager.bindings.add_binding(REMOTE_UUID, "click_down", LED_UUID, "rgb", "increase") is None
+events = event_bus.subscribe("test", topics=("remote",), uuid=REMOTE_UUID)
+time.sleep(0.5)
+
+latencies = []
+presses = [(0, 2)] * NUM_TOGGLES + [(0, 3)] * 2  # click_up, click_down
+for layer, value in presses:
+    start = time.monotonic()
+    num_received = len(received)
+    dongle.press(remote, LED_UUID, layer, value)
+    while len(received) == num_received and time.monotonic() - start < 1:
+        time.sleep(0.0005)
+    latencies.append(received[-1] - start if len(received) > num_received else None)
+    time.sleep(0.1)
+time.sleep(0.5)
+
+shutdown_flag.set()
+for thread in threads:
+    thread.join()
+device_manager.stop()
+
+delivered = sorted(latency for latency in latencies if latency is not None)
+published = []
+while (event := events.get(timeout=0)) is not None:
+    published.append(event.data)
+print(f"{len(delivered)} of {len(presses)} presses delivered, median {1000 * delivered[len(delivered) // 2]:.1f} ms,"
+      f" max {1000 * delivered[-1]:.1f} ms from the press to the SET")
+print(f"led status: power {led.status_data[0]} brightness {led.status_data[1]}, desired {db_manager.get_desired_state(LED_UUID)}")
+print(f"remote events published: {len(published)}")
+assert len(delivered) == len(presses)
+assert led.status_data[0] == NUM_TOGGLES % 2 and led.status_data[1] == 155
+assert db_manager.get_desired_state(LED_UUID) == {"power": "1", "brightness": "155"}
+assert published == ["click_up"] * NUM_TOGGLES + ["click_down"] * 2
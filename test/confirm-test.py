@@ -0,0 +1,124 @@
+import os
+import sys
+import time
+import json
+import base64
+import urllib.request
+import urllib.error
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from simulator import SimulatedDongle, SimulatedDevice
+from nrf24Smart import MultiSetMessage
+from src.DBManager import DBManager
+from src.DeviceManager import DeviceManager
+from src.CommunicationManager import CommunicationManager
+from src.TransitionManager import TransitionManager
+from src.RetryPolicy import RetryPolicy
+from src.WebServerManager import WebServerManager
+
+# Sets brightness values through PUT /devices/<uuid>/brightness?wait=<ms> and reports the measured
+# command to confirmation latency. A device that applies the SETs has to confirm every value,
+# a device that never answers has to fail once its command is given up.
+# Then both devices are deleted through DELETE /devices/<uuid>, which must drop their pending commands,
+# connection health and transitions.
+
+STATUS = [1, 255, 0, 255, 0, 2, 0, 0, 128, 63]
+LED = [10, 20, 30, 1]
+DEAD = [10, 20, 30, 2]
+NUM_SETS = 20
+PORT = 5055
+
+os.chdir(tempfile.mkdtemp())
+db_manager = DBManager()
+db_manager.set_http_password("test")
+dongle = SimulatedDongle()
+led = SimulatedDevice(1, LED, list(STATUS), 3, status_rate=1)
+
+
+def apply_set(data: list[int]):
+    for record in MultiSetMessage.from_raw(data).set_messages:
+        if record.varIndex != 5:
+            led.status_data[record.varIndex] = record.newValue[0]
+
+
+led.set_handler = apply_set
+dongle.add_device(led)
+dongle.add_device(SimulatedDevice(2, DEAD, list(STATUS), 3, status_rate=0, loss=1.0))
+for device_id, uuid in ((1, LED), (2, DEAD)):
+    db_manager.add_device_to_db(
+        {"uuid": uuid, "id": device_id, "version": 3, "battery_powered": False, "battery_level": 255,
+         "type": "LedController3Ch", "name": f"led{device_id}", "status_interval": 1, "last_seen": ""}
+    )
+    db_manager.update_device_in_db({**db_manager.search_device_in_db(uuid), "status": {"brightness": 255}})
+device_manager = DeviceManager(db_manager, dongle)
+device_manager.start()
+shutdown_flag = threading.Event()
+comm_manager = CommunicationManager(device_manager, shutdown_flag)
+comm_manager.retry_policy = RetryPolicy(deadline=1.0)
+transition_manager = TransitionManager(comm_manager, shutdown_flag)
+WebServerManager(db_manager, comm_manager, transition_manager, shutdown_flag).run(host="127.0.0.1", port=PORT)
+threads = [
+    threading.Thread(target=comm_manager.listen),
+    threading.Thread(target=comm_manager.send_pending_commands),
+]
+for thread in threads:
+    thread.start()
+time.sleep(0.5)
+
+
+def put(path: str, value) -> tuple[int, dict]:
+    request = urllib.request.Request(
+        f"http://127.0.0.1:{PORT}{path}",
+        data=json.dumps({"value": value}).encode(),
+        method="PUT",
+        headers={
+            "Authorization": "Basic " + base64.b64encode(b"user:test").decode(),
+            "Content-Type": "application/json",
+        },
+    )
+    try:
+        with urllib.request.urlopen(request) as response:
+            return response.status, json.loads(response.read())
+    except urllib.error.HTTPError as err:
+        return err.code, json.loads(err.read())
+
+
+latencies = []
+for i in range(NUM_SETS):
+    status, result = put("/devices/10-20-30-1/brightness?wait=1000", i)
+    assert status == 200 and result["confirmed"], result
+    assert led.status_data[1] == i
+    latencies.append(result["latency_ms"])
+print(f"confirmed {NUM_SETS} SETs: mean {sum(latencies) / len(latencies):.1f} ms, max {max(latencies):.1f} ms")
+
+status, result = put("/devices/10-20-30-1/brightness?wait=1000", NUM_SETS - 1)
+print(f"value already reported: {status} {result}")
+assert status == 200 and result["confirmed"]
+
+status, result = put("/devices/10-20-30-2/brightness?wait=3000", 1)
+print(f"device that does not answer: {status} {result}")
+assert status == 502
+
+assert comm_manager.set_device_param(DEAD, "brightness", "7")
+assert transition_manager.start_transition(LED, "brightness", "200", 5.0)
+assert str(LED) in comm_manager.connection_health
+for uuid in ("10-20-30-1", "10-20-30-2"):
+    request = urllib.request.Request(
+        f"http://127.0.0.1:{PORT}/devices/{uuid}",
+        method="DELETE",
+        headers={"Authorization": "Basic " + base64.b64encode(b"user:test").decode()},
+    )
+    with urllib.request.urlopen(request) as response:
+        assert response.status == 200
+assert not comm_manager.parameter_buffer.get(str(DEAD))
+assert str(LED) not in comm_manager.connection_health and not transition_manager.transitions
+assert not db_manager.get_all_devices()
+print("deleted devices: pending commands, health and transitions dropped")
+
+shutdown_flag.set()
+for thread in threads:
+    thread.join()
+device_manager.stop()
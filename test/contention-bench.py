@@ -0,0 +1,68 @@
+import os
+import sys
+import time
+import threading
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from nrf24USB import NRF24Device
+from simulator import SimulatedDongle, SimulatedDevice
+from nrf24Smart import HostMessage, MSG_TYPES, LedController3Ch
+
+# Sends SETs while 100 virtual devices stream their status through the simulated dongle.
+# Reports the SET round trip time and the time received frames wait before they are consumed.
+
+NUM_DEVICES = 100
+STATUS_RATE = 5.0  # Status messages per second and device
+NUM_SETS = 300
+
+dongle = SimulatedDongle(airtime=0.002)
+for i in range(NUM_DEVICES):
+    dongle.add_device(
+        SimulatedDevice(i + 1, [10, 20, 30, i], [1, 255, 0, 255, 0, 2, 0, 0, 128, 63], 2, STATUS_RATE)
+    )
+
+device = NRF24Device(dongle, channel=101, address=0)
+device.wait_for_init()
+
+rx_latencies = []
+stop = threading.Event()
+
+
+def consume():
+    while not stop.is_set():
+        if (msg := device.get_timed_message(timeout=0.1)) is not None:
+            rx_latencies.append(time.monotonic() - msg[1])
+
+
+consumer = threading.Thread(target=consume)
+consumer.start()
+time.sleep(1)
+
+set_msg = LedController3Ch.create_set_message("brightness", "128")
+raw_msg = HostMessage([1, 2, 3, 4], MSG_TYPES.SET, set_msg.get_raw()).get_raw()
+set_latencies = []
+start = time.monotonic()
+for i in range(NUM_SETS):
+    t = time.perf_counter()
+    res = device.send_msg(i % NUM_DEVICES + 1, raw_msg)
+    set_latencies.append(time.perf_counter() - t)
+    assert res is not None
+duration = time.monotonic() - start
+
+stop.set()
+consumer.join()
+device.stop_read_loop()
+
+
+def percentile(values, p):
+    return 1000 * sorted(values)[int(p * (len(values) - 1))]
+
+
+print(f"devices:            {NUM_DEVICES} at {STATUS_RATE}/s")
+print(f"frames received:    {len(rx_latencies)} ({device.reader.frames_invalid} invalid)")
+print(f"rx wait  p50/p99:   {percentile(rx_latencies, 0.5):.2f} / {percentile(rx_latencies, 0.99):.2f} ms")
+print(f"SETs sent:          {NUM_SETS} in {duration:.2f}s ({NUM_SETS / duration:.0f}/s)")
+print(f"SET rtt  p50/p99:   {percentile(set_latencies, 0.5):.2f} / {percentile(set_latencies, 0.99):.2f} ms")
+print(f"SET rtt  mean:      {1000 * statistics.mean(set_latencies):.2f} ms")
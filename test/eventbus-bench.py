@@ -0,0 +1,67 @@
+import os
+import sys
+import time
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.EventBus import EventBus
+
+# Publishes 20000 events to a synchronous subscriber, two buffered subscribers on their own threads (one of
+# them only for a single device) and a buffered subscriber that is too slow for the event rate.
+# Reports the cost of a publish, the delivery latency and checks that only the slow subscriber lost events.
+
+NUM_EVENTS = 20_000
+UUIDS = [[10, 20, 30, i] for i in range(10)]
+
+bus = EventBus()
+counted = {"toggle": 0}
+bus.subscribe("metrics", callback=lambda event: counted.__setitem__("toggle", counted["toggle"] + 1), topics=("remote",))
+subscriptions = {
+    "all": bus.subscribe("all", maxsize=NUM_EVENTS),
+    "device": bus.subscribe("device", uuid=UUIDS[0], maxsize=NUM_EVENTS),
+    "slow": bus.subscribe("slow", maxsize=100),
+}
+received = {name: [] for name in subscriptions}
+done = threading.Event()
+
+
+def consume(name: str, delay: float):
+    subscription = subscriptions[name]
+    while not done.is_set() or subscription.qsize():
+        if (event := subscription.get(timeout=0.1)) is not None:
+            received[name].append(time.time() - event.time)
+            if delay:
+                time.sleep(delay)
+
+
+threads = [threading.Thread(target=consume, args=(name, 0.001 if name == "slow" else 0)) for name in subscriptions]
+for thread in threads:
+    thread.start()
+
+publish_time = 0.0
+for i in range(NUM_EVENTS):
+    start = time.perf_counter()
+    if i % 2:
+        bus.publish("remote", UUIDS[i % len(UUIDS)], "toggle")
+    else:
+        bus.publish("state", UUIDS[i % len(UUIDS)], {"status": {"brightness": i % 256}})
+    publish_time += time.perf_counter() - start
+    if i % 100 == 0:
+        time.sleep(0.001)
+done.set()
+for thread in threads:
+    thread.join()
+
+print(f"publish: {1e6 * publish_time / NUM_EVENTS:.1f} us/event to {len(bus.subscriptions)} subscribers")
+for name, latencies in received.items():
+    latencies.sort()
+    print(
+        f"{name:7} {len(latencies):6} events, median latency {1000 * latencies[len(latencies) // 2]:.2f} ms,"
+        f" dropped {subscriptions[name].dropped.get():.0f}"
+    )
+print(f"metrics {counted['toggle']:6} remote events counted synchronously")
+assert counted["toggle"] == NUM_EVENTS // 2
+assert len(received["all"]) == NUM_EVENTS
+assert len(received["device"]) == NUM_EVENTS // len(UUIDS)
+assert len(received["slow"]) < NUM_EVENTS
@@ -0,0 +1,68 @@
+import os
+import sys
+import time
+import random
+from collections import deque
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.ConnectionHealth import ConnectionHealth
+
+# Feeds the msg_nums of a device with 10% loss (counting modulo 256) to the previous deque based
+# connection health and to ConnectionHealth. Reports the time per message, the DB writes and the
+# health after the msg_num wrapped around.
+
+NUM_MSGS = 100_000
+LOSS = 0.1
+WINDOW = 20
+THRESHOLD = 0.1
+
+random.seed(1)
+msg_nums = [n % 256 for n in range(NUM_MSGS) if random.random() >= LOSS]
+
+
+def calc_missing(lst) -> int:
+    return len(set(range(min(lst), max(lst) + 1)) - set(lst))
+
+
+def run_deque() -> tuple[float, int, list[float]]:
+    nums = deque(maxlen=WINDOW)
+    writes, healths = 0, []
+    start = time.perf_counter()
+    for msg_num in msg_nums:
+        if not nums:
+            nums.append(msg_num)
+        elif msg_num == 0 or msg_num < max(nums):
+            nums.clear()
+            nums.append(0)
+        elif msg_num not in nums:
+            nums.append(msg_num)
+        missing = calc_missing(nums)
+        healths.append(1 - missing / (len(nums) + missing))
+        writes += 1
+    return time.perf_counter() - start, writes, healths
+
+
+def run_bitmap() -> tuple[float, int, list[float]]:
+    tracker = ConnectionHealth(WINDOW)
+    reported = None
+    writes, healths = 0, []
+    start = time.perf_counter()
+    for msg_num in msg_nums:
+        tracker.update(msg_num)
+        health = tracker.health
+        if reported is None or abs(health - reported) >= THRESHOLD:
+            reported = health
+            writes += 1
+        healths.append(health)
+    return time.perf_counter() - start, writes, healths
+
+
+for name, run in (("deque", run_deque), ("bitmap", run_bitmap)):
+    duration, writes, healths = run()
+    # Mean health over the first messages after every wraparound
+    after_wrap = [healths[i] for i in range(1, len(msg_nums)) if msg_nums[i] < msg_nums[i - 1]]
+    print(
+        f"{name:7} {1e6 * duration / len(msg_nums):.2f} us/msg, {writes} DB writes,"
+        f" mean health {sum(healths) / len(healths):.3f}, right after wraparound {sum(after_wrap) / len(after_wrap):.3f}"
+    )
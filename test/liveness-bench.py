@@ -0,0 +1,50 @@
+import os
+import sys
+import time
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.DBManager import DBManager
+from src.LivenessTracker import LivenessTracker
+
+# Tracks 500 devices with a status interval of 1 s, all but 20 of them keep reporting.
+# Reports the cost of a message and checks that exactly the silent devices were marked offline.
+
+NUM_DEVICES = 500
+NUM_SILENT = 20
+DURATION = 4.0
+
+os.chdir(tempfile.mkdtemp())
+db_manager = DBManager()
+uuids = [[10, 20, i // 256, i % 256] for i in range(NUM_DEVICES)]
+db_manager.devices_table.insert_multiple(
+    {"uuid": uuid, "id": i + 1, "type": "LedController3Ch", "status_interval": 1, "offline": False}
+    for i, uuid in enumerate(uuids)
+)
+shutdown_flag = threading.Event()
+tracker = LivenessTracker(db_manager, shutdown_flag, missed_intervals=1, grace=0.5)
+thread = threading.Thread(target=tracker.run)
+thread.start()
+
+silent = uuids[:NUM_SILENT]
+calls, call_time = 0, 0.0
+start = time.monotonic()
+while time.monotonic() - start < DURATION:
+    for uuid in uuids[NUM_SILENT:]:
+        t = time.perf_counter()
+        tracker.seen(uuid, 1)
+        call_time += time.perf_counter() - t
+        calls += 1
+    time.sleep(0.5)
+
+# The silent devices were last seen when the tracker started
+time.sleep(0.2)
+offline = [uuid for uuid in uuids if db_manager.search_device_in_db(uuid).get("offline")]
+shutdown_flag.set()
+thread.join()
+
+print(f"{calls} messages, {1e6 * call_time / calls:.1f} us per message, heap size {len(tracker.heap)}")
+print(f"offline: {len(offline)} of {NUM_SILENT} silent devices, {len(tracker.deadlines)} devices tracked")
+assert sorted(offline) == sorted(silent)
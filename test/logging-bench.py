@@ -0,0 +1,82 @@
+import os
+import sys
+import time
+import logging
+import queue
+from logging.handlers import QueueHandler
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import colorlog
+from nrf24USB import PACKET_TYPES
+
+# Measures the cost of logging per received frame in the thread that receives the frame.
+# "before" replicates the former synchronous setup: console handler and a QueueHandler into a
+# RotatingQueue of LogRecords, eager f-strings. "after" uses src.Logger with lazy formatting and logs
+# the frames at DEBUG like PacketReader.read_packet, so no record is created at the default level.
+
+NUM_FRAMES = 20_000
+devnull = open(os.devnull, "w")
+pck = (PACKET_TYPES.MSG, [1, 10, 20, 30, 40, 5, 2, 0, 10, 7, 1, 255, 0, 255, 0, 2, 0, 0, 128, 63, 3, 68])
+
+
+class RotatingQueue(queue.Queue):
+    def put(self, item, block=True, timeout=None):
+        if self.full():
+            self.get_nowait()
+        super(RotatingQueue, self).put(item, block, timeout)
+
+
+def log_frames_before(logger):
+    for _ in range(NUM_FRAMES):
+        logger.info(pck)
+        logger.debug(f"Put packet in queque {pck[0]} {pck[1]}")
+
+
+def log_frames_after(logger):
+    for _ in range(NUM_FRAMES):
+        logger.debug("%s", pck)
+        logger.debug("Put packet in queque %s %s", pck[0], pck[1])
+
+
+def bench_before() -> float:
+    logger = logging.getLogger("bench_before")
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    console_handler = logging.StreamHandler(devnull)
+    console_handler.setFormatter(
+        colorlog.ColoredFormatter(
+            "%(log_color)s%(asctime)s %(levelname)s [%(threadName)s]%(filename)s:%(lineno)d - %(message)s"
+        )
+    )
+    queue_handler = QueueHandler(RotatingQueue(5000))
+    queue_handler.setLevel(logging.WARNING)
+    logger.addHandler(console_handler)
+    logger.addHandler(queue_handler)
+
+    start = time.perf_counter()
+    log_frames_before(logger)
+    return time.perf_counter() - start
+
+
+def bench_after() -> tuple[float, float]:
+    from src import Logger
+
+    logger = Logger.setup_logger()
+    # Let the console handler of the listener write to devnull
+    Logger.log_listener.handlers[0].setStream(devnull)
+
+    start = time.perf_counter()
+    log_frames_after(logger)
+    caller = time.perf_counter() - start
+    while not Logger.log_record_queue.empty():
+        time.sleep(0.001)
+    return caller, time.perf_counter() - start
+
+
+before = bench_before()
+after_caller, after_total = bench_after()
+print(f"frames:                 {NUM_FRAMES}")
+print(f"before (radio thread):  {1e6 * before / NUM_FRAMES:.2f} us/frame")
+print(f"after  (radio thread):  {1e6 * after_caller / NUM_FRAMES:.2f} us/frame")
+print(f"after  (incl. drain):   {1e6 * after_total / NUM_FRAMES:.2f} us/frame")
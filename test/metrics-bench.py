@@ -0,0 +1,67 @@
+import os
+import sys
+import time
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.DBManager import DBManager
+from src.DeviceManager import DeviceManager
+from src.CommunicationManager import CommunicationManager, listen_duration, connection_health_gauge
+from src.DBManager import db_writes, db_update_duration
+
+# Measures the overhead of the metrics instrumentation on the message path.
+# The full processing of a status message (decode, validation, health, DB update) is timed, then the
+# metric updates done for a single message are timed on their own and compared to it.
+
+NUM_FRAMES = 2000
+UUID = [10, 20, 30, 40]
+
+
+class StubDeviceManager:
+    get_supported_device = staticmethod(DeviceManager.get_supported_device)
+
+    def __init__(self, db_manager):
+        self.db_manager = db_manager
+
+
+def create_frame(msg_num: int) -> list[int]:
+    msg = [1] + UUID + [5, 2, 0, 10, msg_num % 256, 1, msg_num % 256, 0, 255, 0, 2, 0, 0, 128, 63]
+    checksum = sum(msg)
+    return msg + [checksum >> 8 & 0xFF, checksum & 0xFF]
+
+
+def instrumentation(health):
+    # The metric updates of one received status message
+    with listen_duration.time():
+        health.set(1.0)
+        start = time.perf_counter()
+        db_writes.inc()
+        db_update_duration.observe(time.perf_counter() - start)
+
+
+os.chdir(tempfile.mkdtemp())
+db_manager = DBManager()
+db_manager.add_device_to_db(
+    {"uuid": UUID, "id": 1, "version": 2, "battery_powered": False, "battery_level": 255,
+     "type": "LedController3Ch", "name": "bench", "status_interval": 10, "last_seen": ""}
+)
+comm_manager = CommunicationManager(StubDeviceManager(db_manager), threading.Event())
+frames = [create_frame(i) for i in range(1, NUM_FRAMES + 1)]
+
+start = time.perf_counter()
+for frame in frames:
+    comm_manager.handle_device_message(frame)
+message_path = (time.perf_counter() - start) / NUM_FRAMES
+
+health = connection_health_gauge.labels(str(UUID))
+start = time.perf_counter()
+for _ in range(NUM_FRAMES):
+    instrumentation(health)
+metrics_cost = (time.perf_counter() - start) / NUM_FRAMES
+
+print(f"frames:          {NUM_FRAMES}")
+print(f"message path:    {1e6 * message_path:.1f} us/frame (instrumented)")
+print(f"metric updates:  {1e6 * metrics_cost:.1f} us/frame")
+print(f"overhead:        {100 * metrics_cost / (message_path - metrics_cost):.1f} %")
@@ -0,0 +1,137 @@
+import os
+import sys
+import time
+import json
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from simulator import SimulatedDongle, SimulatedDevice
+from nrf24Smart import MultiSetMessage
+import src.MQTTManager as MQTTManagerModule
+from src.DBManager import DBManager
+from src.DeviceManager import DeviceManager
+from src.CommunicationManager import CommunicationManager
+from src.TransitionManager import TransitionManager
+from src.MQTTManager import MQTTManager, create_discovery_payload
+from src.Tracing import tracer
+
+# Runs the MQTTManager against a client that records the publishes instead of connecting to a broker.
+# A status frame of a simulated LedController3Ch that changes its brightness has to be published to MQTT
+# and its trace has to end with the "mqtt" stage.
+# Then a Home Assistant JSON light command with a transition time has to fade the brightness of the device
+# with the TransitionManager instead of setting it at once.
+
+STATUS = [1, 255, 0, 255, 0, 2, 0, 0, 128, 63]
+LED = [10, 20, 30, 1]
+BRIGHTNESS_TOPIC = "smart-home-nrf/devices/0x0a141e01/status/brightness"
+LIGHT_TOPIC = "smart-home-nrf/devices/0x0a141e01/light"
+TRANSITION = 1.0
+
+
+class Message:
+    def __init__(self, topic: str, payload: bytes):
+        self.topic = topic
+        self.payload = payload
+
+
+class RecordingClient:
+    def __init__(self):
+        self.published: list[tuple[str, object]] = []
+        self.on_connect = None
+        self.on_message = None
+
+    def username_pw_set(self, username, password):
+        pass
+
+    def connect(self, host, port, keepalive):
+        pass
+
+    def loop_start(self):
+        pass
+
+    def loop_stop(self):
+        pass
+
+    def subscribe(self, topic):
+        pass
+
+    def publish(self, topic, payload=None, retain=False):
+        self.published.append((topic, payload))
+
+
+MQTTManagerModule.mqtt.Client = RecordingClient
+tracer.sample_every = 1
+
+os.chdir(tempfile.mkdtemp())
+db_manager = DBManager()
+dongle = SimulatedDongle()
+led = SimulatedDevice(1, LED, list(STATUS), 3, status_rate=10)
+received_brightness = []
+
+
+def apply_set(data: list[int]):
+    for record in MultiSetMessage.from_raw(data).set_messages:
+        if record.varIndex == 1:
+            received_brightness.append(record.newValue[0])
+        if record.varIndex != 5:
+            led.status_data[record.varIndex] = record.newValue[0]
+
+
+led.set_handler = apply_set
+dongle.add_device(led)
+db_manager.add_device_to_db(
+    {"uuid": LED, "id": 1, "version": 3, "battery_powered": False, "battery_level": 255,
+     "type": "LedController3Ch", "name": "led", "status_interval": 1, "last_seen": ""}
+)
+device_manager = DeviceManager(db_manager, dongle)
+device_manager.start()
+shutdown_flag = threading.Event()
+comm_manager = CommunicationManager(device_manager, shutdown_flag)
+transition_manager = TransitionManager(comm_manager, shutdown_flag)
+mqtt_manager = MQTTManager(db_manager, comm_manager, transition_manager, shutdown_flag)
+threads = [
+    threading.Thread(target=comm_manager.listen),
+    threading.Thread(target=comm_manager.send_pending_commands),
+    threading.Thread(target=transition_manager.run),
+    threading.Thread(target=mqtt_manager.run),
+]
+for thread in threads:
+    thread.start()
+time.sleep(0.5)
+
+led.status_data[1] = 42
+start = time.monotonic()
+while (BRIGHTNESS_TOPIC, 42) not in mqtt_manager.client.published and time.monotonic() - start < 2:
+    time.sleep(0.01)
+time.sleep(0.1)
+assert (BRIGHTNESS_TOPIC, 42) in mqtt_manager.client.published, "the brightness change was not published"
+published = [t for t in tracer.get_traces() if t["uuid"] == LED and t["stages"][-1]["stage"] == "mqtt"]
+assert published, "no trace of a status frame ended with the mqtt stage"
+print(f"status frame to MQTT: {[(s['stage'], s['duration_ms']) for s in published[-1]['stages']]}")
+
+device = db_manager.search_device_in_db(LED)
+discovery = json.loads(create_discovery_payload(device_manager.get_supported_device("LedController3Ch"), device, "light", "status"))
+assert discovery["schema"] == "json" and discovery["transition"], discovery
+assert discovery["command_topic"] == f"{LIGHT_TOPIC}/set"
+
+command = {"state": "ON", "brightness": 200, "transition": TRANSITION}
+mqtt_manager.on_message(None, None, Message(f"{LIGHT_TOPIC}/set", json.dumps(command).encode()))
+assert transition_manager.transitions, "the transition was not started"
+start = time.monotonic()
+while led.status_data[1] != 200 and time.monotonic() - start < 3 * TRANSITION:
+    time.sleep(0.01)
+fade = time.monotonic() - start
+assert led.status_data[1] == 200, "the device did not reach the brightness"
+assert len(set(received_brightness)) > 2, "the brightness was not faded"
+assert fade > 0.8 * TRANSITION, "the brightness was set at once"
+time.sleep(0.3)
+state = json.loads([payload for topic, payload in mqtt_manager.client.published if topic == f"{LIGHT_TOPIC}/state"][-1])
+assert state["state"] == "ON" and state["brightness"] == 200, state
+print(f"Home Assistant light command: {len(set(received_brightness))} brightness values in {fade:.2f}s, state {state}")
+
+shutdown_flag.set()
+for thread in threads:
+    thread.join()
+device_manager.stop()
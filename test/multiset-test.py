@@ -0,0 +1,72 @@
+import os
+import sys
+import time
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from simulator import SimulatedDongle, SimulatedDevice
+from nrf24Smart import MultiSetMessage, MSG_TYPES
+from src.DBManager import DBManager
+from src.DeviceManager import DeviceManager
+from src.CommunicationManager import CommunicationManager
+
+# Sets power, brightness and colour of a LedController3Ch with multi SET firmware and of one with older firmware.
+# The simulated dongle validates every SET message: it has to be a valid sequence of SetMessages and
+# must only contain a single SetMessage for firmware without multi SET support.
+
+STATUS = [1, 255, 0, 255, 0, 2, 0, 0, 128, 63]
+DEVICES = {1: ([10, 20, 30, 1], 3), 2: ([10, 20, 30, 2], 2)}
+PARAMETERS = [("power", "1"), ("brightness", "128"), ("rgb", "10,20,30"), ("status_interval", "5")]
+
+os.chdir(tempfile.mkdtemp())
+db_manager = DBManager()
+dongle = SimulatedDongle()
+for device_id, (uuid, version) in DEVICES.items():
+    dongle.add_device(SimulatedDevice(device_id, uuid, STATUS, version, status_rate=1))
+    db_manager.add_device_to_db(
+        {"uuid": uuid, "id": device_id, "version": version, "battery_powered": False, "battery_level": 255,
+         "type": "LedController3Ch", "name": f"led{device_id}", "status_interval": 1, "last_seen": ""}
+    )
+
+
+def validate_msg(destination: int, payload: list[int]) -> bool:
+    if payload[5] != MSG_TYPES.SET.value:
+        return True
+    if (msg := MultiSetMessage.from_raw(payload[6:-2])) is None:
+        print(f"invalid SET payload for device {destination}: {payload}")
+        return False
+    print(f"device {destination}: {msg}")
+    return DEVICES[destination][1] == 3 or len(msg) == 1
+
+
+dongle.validate_msg = validate_msg
+device_manager = DeviceManager(db_manager, dongle)
+device_manager.start()
+shutdown_flag = threading.Event()
+comm_manager = CommunicationManager(device_manager, shutdown_flag)
+threads = [
+    threading.Thread(target=comm_manager.listen),
+    threading.Thread(target=comm_manager.send_pending_commands),
+]
+for thread in threads:
+    thread.start()
+time.sleep(0.5)
+
+for device_id, (uuid, version) in DEVICES.items():
+    start = time.perf_counter()
+    for parameter, value in PARAMETERS:
+        comm_manager.set_device_param(uuid, parameter, value)
+    while comm_manager.parameter_buffer.get(str(uuid)):
+        time.sleep(0.001)
+    duration = time.perf_counter() - start
+    frames = sum(1 for destination, _, payload in dongle.received if destination == device_id and payload[5] == 3)
+    print(f"firmware {version}: {len(PARAMETERS)} parameters in {frames} SET messages, {1000 * duration:.1f} ms")
+
+shutdown_flag.set()
+for thread in threads:
+    thread.join()
+device_manager.stop()
+print(f"invalid messages: {dongle.invalid_msgs}")
+assert dongle.invalid_msgs == 0
@@ -0,0 +1,56 @@
+import os
+import sys
+import time
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from simulator import SimulatedDongle, SimulatedDevice
+from src.DBManager import DBManager
+from src.DeviceManager import DeviceManager
+from src.CommunicationManager import CommunicationManager
+
+# Switches on 30 new LedController3Ch at the same time during a provisioning session. Like the firmware
+# they send INIT every listen window until they got their ID. Reports the provisioning stats and checks
+# that every device got its own ID and no answer was taken by more than one device.
+
+NUM_DEVICES = 30
+STATUS = [1, 255, 0, 0, 0, 3, 0, 0, 128, 63]
+
+os.chdir(tempfile.mkdtemp())
+db_manager = DBManager()
+dongle = SimulatedDongle()
+device_manager = DeviceManager(db_manager, dongle)
+device_manager.start()
+shutdown_flag = threading.Event()
+comm_manager = CommunicationManager(device_manager, shutdown_flag)
+threads = [
+    threading.Thread(target=comm_manager.listen),
+    threading.Thread(target=comm_manager.send_pending_commands),
+    threading.Thread(target=comm_manager.pair_devices),
+]
+for thread in threads:
+    thread.start()
+
+comm_manager.pairing.start_provisioning()
+devices = [SimulatedDevice(255, [10, 20, 40, i], list(STATUS), 3, status_rate=1) for i in range(NUM_DEVICES)]
+for device in devices:
+    dongle.add_unpaired_device(device, "LedController3Ch")
+
+start = time.monotonic()
+while len(db_manager.get_all_devices()) < NUM_DEVICES and time.monotonic() - start < 30:
+    time.sleep(0.1)
+stats = comm_manager.pairing.stop_provisioning()
+shutdown_flag.set()
+for thread in threads:
+    thread.join()
+device_manager.stop()
+
+stored = db_manager.get_all_devices()
+ids = {device["id"] for device in stored}
+print(stats)
+print(f"{len(stored)} of {NUM_DEVICES} devices paired, {len(ids)} unique IDs, {dongle.pairing_collisions} collisions")
+assert len(stored) == NUM_DEVICES and len(ids) == NUM_DEVICES
+assert all(dongle.devices[device["id"]].uuid == device["uuid"] for device in stored)
+assert dongle.pairing_collisions == 0
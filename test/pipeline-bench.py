@@ -0,0 +1,99 @@
+import os
+import sys
+import time
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from simulator import SimulatedDongle, SimulatedDevice
+from src.DBManager import DBManager
+from src.DeviceManager import DeviceManager
+from src.CommunicationManager import CommunicationManager
+from src.Tracing import tracer
+
+# 40 simulated LedController3Ch send 10 status messages per second each while every DB update takes 10 ms,
+# so the DB can only keep up with a quarter of the messages. The messages are processed inline on the
+# listener thread like before and with the staged pipeline. Reports how long it took until a message
+# updated the state (median and 95th percentile), the frames still waiting in the receive queue and what the pipeline dropped.
+# Halfway through every device changes its brightness, the devices whose DB status still shows the old value
+# at the end are reported as stale. The persist stage merges the updates of a device and must not leave any.
+
+NUM_DEVICES = 40
+DURATION = 4.0
+DB_DELAY = 0.01
+STATUS = [1, 255, 0, 0, 0, 3, 0, 0, 128, 63]
+
+
+def run(pipeline: bool) -> dict:
+    os.chdir(tempfile.mkdtemp())
+    db_manager = DBManager()
+    dongle = SimulatedDongle()
+    devices = []
+    for i in range(1, NUM_DEVICES + 1):
+        uuid = [10, 20, 50, i]
+        devices.append(SimulatedDevice(i, uuid, list(STATUS), 3, status_rate=10))
+        dongle.add_device(devices[-1])
+        db_manager.add_device_to_db(
+            {"uuid": uuid, "id": i, "version": 3, "battery_powered": False, "battery_level": 255,
+             "type": "LedController3Ch", "name": f"led{i}", "status_interval": 1, "last_seen": "",
+             "offline": False}
+        )
+    update_device_in_db = db_manager.update_device_in_db
+
+    def slow_update(device_dict, trace=None):
+        time.sleep(DB_DELAY)
+        update_device_in_db(device_dict, trace)
+
+    db_manager.update_device_in_db = slow_update
+    device_manager = DeviceManager(db_manager, dongle)
+    device_manager.start()
+    shutdown_flag = threading.Event()
+    comm_manager = CommunicationManager(device_manager, shutdown_flag)
+
+    latencies = []
+    update_state = comm_manager.update_state
+
+    def timed_update_state(msg, device, class_obj, trace=None):
+        latencies.append(time.monotonic() - trace.rx_time)
+        return update_state(msg, device, class_obj, trace)
+
+    comm_manager.update_state = timed_update_state
+
+    def listen_inline():
+        while not shutdown_flag.is_set():
+            if (timed_msg := device_manager.get_device_message(timeout=0.5)) is not None:
+                data, rx_time = timed_msg
+                comm_manager.handle_device_message(data, tracer.start(rx_time))
+
+    thread = threading.Thread(target=comm_manager.listen if pipeline else listen_inline)
+    thread.start()
+    time.sleep(DURATION / 2)
+    for device in devices:
+        device.status_data[1] = 100
+    time.sleep(DURATION / 2)
+    backlog = device_manager.device.msg_queue.qsize()
+    stale = sum(1 for device in db_manager.get_all_devices() if device["status"]["brightness"] != 100)
+    shutdown_flag.set()
+    thread.join()
+    device_manager.stop()
+    latencies.sort()
+    return {
+        "handled": len(latencies),
+        "median_ms": round(1000 * latencies[len(latencies) // 2], 1),
+        "p95_ms": round(1000 * latencies[int(0.95 * len(latencies))], 1),
+        "rx_backlog": backlog,
+        "stale_devices": stale,
+        "dropped": {
+            stage.name: stage.dropped.get()
+            for stage in (comm_manager.decode_stage, comm_manager.state_stage, comm_manager.persist_stage)
+        },
+        "coalesced": comm_manager.persist_stage.coalesced.get(),
+    }
+
+
+inline = run(pipeline=False)
+staged = run(pipeline=True)
+print(f"inline:   {inline}")
+print(f"pipeline: {staged}")
+assert staged["stale_devices"] == 0, "the DB shows an outdated status"
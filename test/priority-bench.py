@@ -0,0 +1,59 @@
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from nrf24USB import NRF24Device, TX_PRIORITY
+from simulator import SimulatedDongle, SimulatedDevice
+from nrf24Smart import HostMessage, MSG_TYPES, LedController3Ch
+
+# Queues a burst of background and automation traffic and sends interactive commands while it drains.
+# Reports how long the interactive commands wait, once with priority lanes and once with everything
+# queued as interactive (which behaves like the plain FIFO used before).
+
+NUM_DEVICES = 20
+NUM_BULK = 200
+NUM_INTERACTIVE = 20
+
+dongle = SimulatedDongle(airtime=0.002)
+for i in range(NUM_DEVICES):
+    dongle.add_device(SimulatedDevice(i + 1, [10, 20, 30, i], [1, 255, 0, 255, 0, 2, 0, 0, 128, 63], 2, 0))
+
+device = NRF24Device(dongle, channel=101, address=0)
+device.wait_for_init()
+
+uuid = [1, 2, 3, 4]
+config_msg = HostMessage(uuid, MSG_TYPES.SET, LedController3Ch.create_set_message("status_interval", "10").get_raw())
+stream_msg = HostMessage(uuid, MSG_TYPES.SET, LedController3Ch.create_set_message("brightness", "100").get_raw())
+power_msg = HostMessage(uuid, MSG_TYPES.SET, LedController3Ch.create_set_message("power", "0").get_raw())
+
+
+def run(use_priorities: bool) -> list[float]:
+    background = TX_PRIORITY.BACKGROUND if use_priorities else TX_PRIORITY.INTERACTIVE
+    automation = TX_PRIORITY.AUTOMATION if use_priorities else TX_PRIORITY.INTERACTIVE
+    bulk = []
+    for i in range(NUM_BULK):
+        destination = i % NUM_DEVICES + 1
+        bulk.append(device.send_msg_async(destination, config_msg.get_raw(), priority=background))
+        bulk.append(device.send_msg_async(destination, stream_msg.get_raw(), False, priority=automation))
+    latencies = []
+    for i in range(NUM_INTERACTIVE):
+        start = time.perf_counter()
+        assert device.send_msg(i % NUM_DEVICES + 1, power_msg.get_raw()) is not None
+        latencies.append(time.perf_counter() - start)
+        time.sleep(0.02)
+    for request in bulk:
+        request.wait()
+    return latencies
+
+
+for use_priorities in (False, True):
+    latencies = run(use_priorities)
+    print(
+        f"priorities={use_priorities}: interactive mean {1000 * sum(latencies) / len(latencies):.1f} ms,"
+        f" max {1000 * max(latencies):.1f} ms"
+    )
+for lane, stats in device.tx_queue.get_stats().items():
+    print(f"{lane:12} {stats}")
+device.stop_read_loop()
@@ -0,0 +1,134 @@
+import os
+import sys
+import time
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from simulator import SimulatedDongle, SimulatedDevice
+from nrf24Smart import MultiSetMessage
+from src.DBManager import DBManager
+from src.DeviceManager import DeviceManager
+from src.CommunicationManager import CommunicationManager, set_updates_suppressed
+
+# A simulated LedController3Ch (firmware 3) that applies the SET messages it receives to its status.
+# 1. Commands that match the reported status must not be sent.
+# 2. After a reboot into its defaults the device has to get its desired state back in one SET message.
+# 3. A device that drifted while it was offline has to be reconciled once it is back online.
+# 4. A BOOT message of a device that is not in the DB is ignored.
+# 5. A command that matches the reported status but arrives while a different value is being sent must
+#    not be suppressed, with and without waiting for the OK status of the device.
+
+UUID = [10, 20, 30, 1]
+DEFAULTS = [1, 255, 0, 0, 0, 3, 0, 0, 128, 63]
+
+os.chdir(tempfile.mkdtemp())
+db_manager = DBManager()
+dongle = SimulatedDongle()
+led = SimulatedDevice(1, UUID, list(DEFAULTS), 3, status_rate=2)
+
+
+def apply_set(data: list[int]):
+    for record in MultiSetMessage.from_raw(data).set_messages:
+        if record.varIndex == 5:  # rgb
+            led.status_data[2:5] = record.newValue
+        else:
+            led.status_data[record.varIndex] = record.newValue[0]
+
+
+led.set_handler = apply_set
+dongle.add_device(led)
+db_manager.add_device_to_db(
+    {"uuid": UUID, "id": 1, "version": 3, "battery_powered": False, "battery_level": 255,
+     "type": "LedController3Ch", "name": "led", "status_interval": 1, "last_seen": ""}
+)
+device_manager = DeviceManager(db_manager, dongle)
+device_manager.start()
+shutdown_flag = threading.Event()
+comm_manager = CommunicationManager(device_manager, shutdown_flag)
+threads = [
+    threading.Thread(target=comm_manager.listen),
+    threading.Thread(target=comm_manager.send_pending_commands),
+]
+for thread in threads:
+    thread.start()
+
+
+def sets_sent() -> int:
+    return sum(1 for _, _, payload in dongle.received if payload[5] == 3)
+
+
+def wait_until(condition, timeout: float = 3.0) -> bool:
+    start = time.monotonic()
+    while not condition():
+        if time.monotonic() - start > timeout:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+assert wait_until(lambda: (db_manager.search_device_in_db(UUID) or {}).get("status"))
+
+first = sets_sent()
+for _ in range(10):
+    comm_manager.set_device_param(UUID, "power", "on")
+    comm_manager.set_device_param(UUID, "brightness_percent", "100")
+time.sleep(0.3)
+print(f"redundant commands: {sets_sent() - first} SET messages, {int(set_updates_suppressed.get())} suppressed")
+assert sets_sent() == first
+
+comm_manager.set_device_param(UUID, "brightness", "100")
+comm_manager.set_device_param(UUID, "cct", "4000")
+comm_manager.set_device_param(UUID, "ch_3", "50")
+assert wait_until(lambda: led.status_data[1] == 100 and led.status_data[4] == 50)
+desired = list(led.status_data)
+assert wait_until(lambda: db_manager.search_device_in_db(UUID)["status"]["ch_3"] == 50)
+
+first = sets_sent()
+dongle.reboot(led, list(DEFAULTS))
+assert wait_until(lambda: led.status_data == desired), "device did not converge after the reboot"
+print(f"after reboot: converged with {sets_sent() - first} SET message")
+time.sleep(0.5)
+
+db_manager.update_device_offline_status(UUID, True)
+led.status_data[0] = 0
+first = sets_sent()
+assert wait_until(lambda: led.status_data == desired), "device did not converge after coming back online"
+print(f"back online: converged with {sets_sent() - first} SET message")
+time.sleep(1)
+assert sets_sent() == first + 1, "converged device got further SET messages"
+
+# A BOOT message of a device that is not in the DB does not touch the liveness or reconcile state
+stranger = SimulatedDevice(9, [10, 20, 30, 9], list(DEFAULTS), 3)
+dongle.reboot(stranger, list(DEFAULTS))
+time.sleep(0.3)
+assert str(stranger.uuid) not in comm_manager.liveness.status_intervals
+assert str(stranger.uuid) not in comm_manager.needs_reconcile
+
+# The power is switched off and back on while the SET that switches it off is being sent
+send_request_to_device = device_manager.send_request_to_device
+
+
+def send_during_command(id, data, *args, **kwargs):
+    record = MultiSetMessage.from_raw(data[6:-2]).set_messages[0]
+    if record.varIndex == 0 and record.newValue == [0]:
+        comm_manager.set_device_param(UUID, "power", "1")
+    return send_request_to_device(id, data, *args, **kwargs)
+
+
+device_manager.send_request_to_device = send_during_command
+for wait_for_status_acks in (True, False):
+    comm_manager.wait_for_status_acks = wait_for_status_acks
+    assert wait_until(lambda: db_manager.search_device_in_db(UUID)["status"]["power"] == 1)
+    comm_manager.set_device_param(UUID, "power", "0")
+    time.sleep(0.5)
+    assert led.status_data[0] == 1, f"the device stayed off (wait_for_status_acks={wait_for_status_acks})"
+    assert db_manager.get_desired_state(UUID)["power"] == "1"
+print("command set during the send of another value: applied")
+device_manager.send_request_to_device = send_request_to_device
+
+shutdown_flag.set()
+for thread in threads:
+    thread.join()
+device_manager.stop()
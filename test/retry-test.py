@@ -0,0 +1,68 @@
+import os
+import sys
+import time
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from simulator import SimulatedDongle, SimulatedDevice
+from src.DBManager import DBManager
+from src.DeviceManager import DeviceManager
+from src.CommunicationManager import CommunicationManager, set_results, set_retries
+from src.RetryPolicy import RetryPolicy
+
+# Sends a SET to a device on a noisy channel (70% loss) and to a device that never answers.
+# The noisy device has to get the value through the backoff retries, the command to the other device
+# has to be dropped at its deadline. Reports the attempts and results per device.
+# Then checks that a send after DeviceManager.stop() fails right away.
+
+STATUS = [1, 255, 0, 255, 0, 2, 0, 0, 128, 63]
+DEVICES = {1: ([10, 20, 30, 1], 0.7), 2: ([10, 20, 30, 2], 1.0)}
+DEADLINE = 3.0
+
+os.chdir(tempfile.mkdtemp())
+db_manager = DBManager()
+dongle = SimulatedDongle()
+for device_id, (uuid, loss) in DEVICES.items():
+    dongle.add_device(SimulatedDevice(device_id, uuid, STATUS, 3, status_rate=0, loss=loss))
+    db_manager.add_device_to_db(
+        {"uuid": uuid, "id": device_id, "version": 3, "battery_powered": False, "battery_level": 255,
+         "type": "LedController3Ch", "name": f"led{device_id}", "status_interval": 1, "last_seen": ""}
+    )
+device_manager = DeviceManager(db_manager, dongle)
+device_manager.start()
+shutdown_flag = threading.Event()
+comm_manager = CommunicationManager(device_manager, shutdown_flag)
+comm_manager.retry_policy = RetryPolicy(deadline=DEADLINE)
+threads = [
+    threading.Thread(target=comm_manager.listen),
+    threading.Thread(target=comm_manager.send_pending_commands),
+]
+for thread in threads:
+    thread.start()
+time.sleep(0.5)
+
+start = time.monotonic()
+for uuid, _ in DEVICES.values():
+    comm_manager.set_device_param(uuid, "brightness", "42")
+while any(comm_manager.parameter_buffer.values()) and time.monotonic() - start < 2 * DEADLINE:
+    time.sleep(0.01)
+
+shutdown_flag.set()
+for thread in threads:
+    thread.join()
+device_manager.stop()
+
+for device_id, (uuid, loss) in DEVICES.items():
+    attempts = sum(1 for destination, _, _ in dongle.received if destination == device_id)
+    results = {result: int(set_results.labels(str(uuid), result).get()) for result in ("ok", "error", "expired")}
+    print(f"device {device_id} loss {loss:.0%}: {attempts} attempts, {int(set_retries.labels(str(uuid)).get())} retries, {results}")
+assert set_results.labels(str(DEVICES[1][0]), "ok").get() == 1, "noisy device did not get the value"
+assert set_results.labels(str(DEVICES[2][0]), "expired").get() == 1, "command to the dead device was not dropped"
+assert db_manager.search_device_in_db(DEVICES[2][0]).get("offline")
+
+# A send after the write loop stopped fails at once instead of waiting forever
+start = time.monotonic()
+assert device_manager.send_msg_to_device(1, [0]) is None
+print(f"send after stop failed after {1000 * (time.monotonic() - start):.1f} ms")
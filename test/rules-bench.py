@@ -0,0 +1,118 @@
+import os
+import sys
+import time
+import random
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.DBManager import DBManager
+from src.RulesEngine import RulesEngine
+
+# Loads 100, 1000 and 10000 rules on the sensors and remotes of 1000 devices and feeds status updates and
+# remote events of 10 devices with the same 10 rules each to the RulesEngine. Reports the cost per status
+# update and event, which should stay flat with the number of rules as only the rules of the device and
+# its fields are evaluated.
+# Then checks that a threshold rule only fires when its condition becomes true and that a step rule is
+# limited by its interval and clamped to its maximum.
+
+NUM_DEVICES = 1000
+NUM_UPDATES = 20_000
+SENSORS = [[10, 20, i // 256, i % 256] for i in range(NUM_DEVICES)]
+MEASURED = SENSORS[:10]
+LED = [10, 30, 0, 1]
+EVENTS = ["click_up", "click_down", "hold_up", "hold_down"]
+
+
+class CommManager:
+    """
+    The part of the CommunicationManager the RulesEngine uses, records the set parameters
+    """
+
+    def __init__(self, db_manager: DBManager):
+        self.db_manager = db_manager
+        self.status = {"brightness_percent": 50}
+        self.sets = []
+
+    def get_device_param(self, uuid, parameter):
+        return self.status.get(parameter)
+
+    def set_device_param(self, uuid, parameter, new_val) -> bool:
+        self.sets.append((parameter, new_val))
+        return True
+
+
+def random_rule(rng: random.Random, uuid: list[int]) -> dict:
+    if rng.random() < 0.5:
+        trigger = {"uuid": uuid, "field": rng.choice(("temperature", "humidity")), "op": ">", "value": rng.uniform(0, 100)}
+    else:
+        trigger = {"uuid": uuid, "event": rng.choice(EVENTS)}
+    return {"trigger": trigger, "actions": [{"uuid": LED, "parameter": "power", "value": "1"}]}
+
+
+os.chdir(tempfile.mkdtemp())
+db_manager = DBManager()
+comm_manager = CommManager(db_manager)
+engine = RulesEngine(comm_manager)
+rng = random.Random(1)
+
+for num_rules in (100, 1000, 10_000):
+    db_manager.rules_table.truncate()
+    measured_rules = [random_rule(rng, uuid) for uuid in MEASURED for _ in range(10)]
+    other_rules = [random_rule(rng, rng.choice(SENSORS[len(MEASURED):])) for _ in range(num_rules - len(measured_rules))]
+    db_manager.rules_table.insert_multiple(measured_rules + other_rules)
+    start = time.perf_counter()
+    engine.load()
+    load_time = time.perf_counter() - start
+
+    updates = [
+        (rng.choice(MEASURED), {"temperature": rng.uniform(0, 100), "humidity": rng.uniform(0, 100)})
+        for _ in range(NUM_UPDATES)
+    ]
+    events = [(rng.choice(MEASURED), rng.choice(EVENTS)) for _ in range(NUM_UPDATES)]
+    fired = 0
+    start = time.perf_counter()
+    for uuid, status in updates:
+        fired += engine.on_status(uuid, status)
+    status_time = time.perf_counter() - start
+    start = time.perf_counter()
+    for uuid, event in events:
+        fired += engine.on_event(uuid, event)
+    event_time = time.perf_counter() - start
+    print(
+        f"{num_rules:6} rules: load {1000 * load_time:6.1f} ms, status update {1e6 * status_time / NUM_UPDATES:5.2f} us,"
+        f" event {1e6 * event_time / NUM_UPDATES:5.2f} us, {fired} rules fired"
+    )
+
+# humidity > 70 turns the LED red, hold_up increases the brightness by 10% every 100 ms at most
+db_manager.rules_table.truncate()
+engine.load()
+sensor = SENSORS[0]
+humid = engine.add_rule({
+    "name": "humid", "trigger": {"uuid": sensor, "field": "humidity", "op": ">", "value": 70},
+    "actions": [{"uuid": LED, "parameter": "rgb", "value": "255,0,0"}],
+})
+hold = engine.add_rule({
+    "name": "brighter", "trigger": {"uuid": sensor, "event": "hold_up"}, "interval": 0.1,
+    "actions": [{"uuid": LED, "parameter": "brightness_percent", "step": 10, "max": 100}],
+})
+assert engine.add_rule({"trigger": {"uuid": sensor, "field": "humidity", "op": "~", "value": 1}, "actions": []}) is None
+assert humid is not None and hold is not None
+
+comm_manager.sets.clear()
+for humidity in (60, 75, 80, 65, 72):
+    engine.on_status(sensor, {"humidity": humidity})
+assert comm_manager.sets == [("rgb", "255,0,0")] * 2, comm_manager.sets
+
+comm_manager.sets.clear()
+start = time.monotonic()
+while time.monotonic() - start < 1:
+    engine.on_event(sensor, "hold_up")
+    time.sleep(0.02)
+print(f"hold_up for 1 s: {[value for _, value in comm_manager.sets]}")
+assert 5 <= len(comm_manager.sets) <= 11
+assert comm_manager.sets[:5] == [("brightness_percent", str(v)) for v in (60, 70, 80, 90, 100)]
+assert all(value == "100" for _, value in comm_manager.sets[5:])
+
+assert engine.remove_rule(humid) and not engine.remove_rule(humid)
+assert len(db_manager.get_rules()) == 1
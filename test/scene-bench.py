@@ -0,0 +1,129 @@
+import os
+import sys
+import time
+import random
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from simulator import SimulatedDongle, SimulatedDevice
+from nrf24Smart import MultiSetMessage
+from src.DBManager import DBManager
+from src.DeviceManager import DeviceManager
+from src.CommunicationManager import CommunicationManager, SetConfirmation
+from src.TransitionManager import TransitionManager
+from src.SceneManager import SceneManager
+
+# Captures the state of 20 simulated LedController3Ch as a scene, changes the devices and restores the scene,
+# once by setting every parameter of the scene with set_device_param (like a client restoring a scene through
+# the API) and once with SceneManager.apply_scene. Reports the wall time until all devices confirmed the
+# values and the number of SET messages, and checks that only the changed parameters were sent.
+# The number of send workers can be passed as argument (default 4).
+
+NUM_DEVICES = 20
+ROUNDS = 5
+SEND_WORKERS = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+
+os.chdir(tempfile.mkdtemp())
+db_manager = DBManager()
+dongle = SimulatedDongle()
+leds = []
+
+
+def apply_set(led: SimulatedDevice, data: list[int]):
+    for record in MultiSetMessage.from_raw(data).set_messages:
+        if record.varIndex == 5:  # rgb
+            led.status_data[2:5] = record.newValue[:3]
+        else:
+            led.status_data[record.varIndex] = record.newValue[0]
+
+
+for i in range(NUM_DEVICES):
+    led = SimulatedDevice(i + 1, [10, 40, 0, i], [1, 255, 0, 0, 0, 3, 0, 0, 128, 63], 3, status_rate=1)
+    led.set_handler = lambda data, led=led: apply_set(led, data)
+    dongle.add_device(led)
+    leds.append(led)
+    db_manager.add_device_to_db(
+        {"uuid": led.uuid, "id": i + 1, "version": 3, "battery_powered": False, "battery_level": 255,
+         "type": "LedController3Ch", "name": f"led{i}", "status_interval": 1, "last_seen": ""}
+    )
+device_manager = DeviceManager(db_manager, dongle)
+device_manager.start()
+shutdown_flag = threading.Event()
+comm_manager = CommunicationManager(device_manager, shutdown_flag)
+comm_manager.send_workers = SEND_WORKERS
+scene_manager = SceneManager(comm_manager, TransitionManager(comm_manager, shutdown_flag))
+threads = [
+    threading.Thread(target=comm_manager.listen),
+    threading.Thread(target=comm_manager.send_pending_commands),
+]
+for thread in threads:
+    thread.start()
+time.sleep(1.5)
+
+rng = random.Random(1)
+members = [led.uuid for led in leds]
+assert scene_manager.save_group("living_room", members)
+for led in leds:
+    led.status_data[:5] = [1, rng.randrange(256), rng.randrange(256), rng.randrange(256), rng.randrange(256)]
+time.sleep(1.5)
+scene = scene_manager.capture_scene("evening", scene_manager.get_members("living_room"))
+assert scene is not None and len(scene["devices"]) == NUM_DEVICES
+expected = [list(led.status_data[:5]) for led in leds]
+
+
+def scramble():
+    """
+    Changes the brightness of every device and the color of every other device, then waits for their status
+    """
+    for i, led in enumerate(leds):
+        led.status_data[1] = (led.status_data[1] + 100) % 256
+        if i % 2:
+            led.status_data[2:5] = [rng.randrange(256) for _ in range(3)]
+    time.sleep(1.5)
+
+
+def restore_individually() -> float:
+    start = time.monotonic()
+    confirmations = []
+    for entry in scene["devices"]:
+        for parameter, value in entry["state"].items():
+            confirmation = SetConfirmation(parameter, value)
+            comm_manager.set_device_param(entry["uuid"], parameter, value, confirmation=confirmation)
+            confirmations.append((entry["uuid"], confirmation))
+    for uuid, confirmation in confirmations:
+        assert comm_manager.wait_for_confirmation(uuid, confirmation, 5)
+    return time.monotonic() - start
+
+
+results = {"set_device_param": [], "apply_scene": []}
+frames = {name: 0 for name in results}
+for _ in range(ROUNDS):
+    for name in results:
+        scramble()
+        num_received = len(dongle.received)
+        if name == "apply_scene":
+            report = scene_manager.apply_scene("evening")
+            assert report["confirmed"] == report["sent"] == NUM_DEVICES + NUM_DEVICES // 2, report
+            results[name].append(report["wall_time_ms"] / 1000)
+        else:
+            results[name].append(restore_individually())
+        frames[name] += len(dongle.received) - num_received
+        assert [led.status_data[:5] for led in leds] == expected
+        time.sleep(0.3)
+
+shutdown_flag.set()
+for thread in threads:
+    thread.join()
+device_manager.stop()
+
+print(f"{NUM_DEVICES} devices, {SEND_WORKERS} send workers, last report: {report}")
+for name, times in results.items():
+    times.sort()
+    print(
+        f"{name:16} median {1000 * times[len(times) // 2]:6.1f} ms, max {1000 * times[-1]:6.1f} ms,"
+        f" {frames[name] / ROUNDS:.1f} SET messages per restore"
+    )
+desired = db_manager.get_desired_state(leds[0].uuid)
+assert desired == scene["devices"][0]["state"], desired
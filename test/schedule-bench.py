@@ -0,0 +1,123 @@
+import os
+import sys
+import time
+import random
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from nrf24USB import TX_PRIORITY
+from src.DBManager import DBManager
+from src.ScheduleManager import ScheduleManager, Job
+
+# Loads 1000, 10000 and 100000 schedules (cron expressions, intervals and single times) and runs a simulated
+# hour in steps of one second. Reports the cost of adding a job, of a tick without due jobs and of a run,
+# which should stay flat with the number of schedules as only the top of the heap is looked at.
+# Then checks the catch up after a restart two days later, the priority of the commands and that a job
+# added to the running ScheduleManager runs on time.
+
+LED = [10, 50, 0, 1]
+HOUR = 3600
+
+
+class CommManager:
+    """
+    The part of the CommunicationManager the ScheduleManager uses, records the set parameters
+    """
+
+    def __init__(self, db_manager: DBManager):
+        self.db_manager = db_manager
+        self.sets = []
+
+    def set_device_param(self, uuid, parameter, new_val, priority=None) -> bool:
+        self.sets.append((parameter, new_val, priority, time.time()))
+        return True
+
+
+def random_schedule(rng: random.Random, now: float) -> dict:
+    kind = rng.random()
+    if kind < 0.4:
+        trigger = {"cron": f"{rng.randrange(60)} {rng.randrange(24)} * * *" if rng.random() < 0.5 else f"*/{rng.randrange(5, 60)} * * * *"}
+    elif kind < 0.8:
+        trigger = {"every": rng.randrange(60, HOUR)}
+    else:
+        trigger = {"at": now + rng.uniform(0, 24 * HOUR)}
+    return {"trigger": trigger, "actions": [{"uuid": LED, "parameter": "power", "value": 0}], "created": now}
+
+
+os.chdir(tempfile.mkdtemp())
+db_manager = DBManager()
+comm_manager = CommManager(db_manager)
+shutdown_flag = threading.Event()
+rng = random.Random(1)
+
+for num_schedules in (1_000, 10_000, 100_000):
+    start_time = time.time()
+    db_manager.schedules_table.truncate()
+    db_manager.schedules_table.insert_multiple(random_schedule(rng, start_time) for _ in range(num_schedules))
+    start = time.perf_counter()
+    manager = ScheduleManager(comm_manager, shutdown_flag)
+    load_time = time.perf_counter() - start
+
+    jobs = [Job(num_schedules + i + 1, random_schedule(rng, start_time)) for i in range(1000)]
+    start = time.perf_counter()
+    with manager.condition:
+        for job in jobs:
+            manager.jobs[job.id] = job
+            manager.push(job, job.get_next_run(start_time))
+    insert_time = (time.perf_counter() - start) / len(jobs)
+
+    comm_manager.sets.clear()
+    tick_time = run_time = 0.0
+    ticks = 0
+    for second in range(1, HOUR + 1):
+        start = time.perf_counter()
+        ran = manager.run_pending(start_time + second)
+        elapsed = time.perf_counter() - start
+        if ran:
+            run_time += elapsed
+        else:
+            tick_time += elapsed
+            ticks += 1
+    runs = len(comm_manager.sets)
+    print(
+        f"{num_schedules:6} schedules: load {load_time:5.2f} s, add {1e6 * insert_time:4.1f} us,"
+        f" empty tick {1e6 * tick_time / ticks:4.1f} us, {1e6 * run_time / runs:5.1f} us per run ({runs} runs in 1 h)"
+    )
+
+# Restart two days later: the missed runs of a job are caught up once, or skipped without catch_up
+db_manager.schedules_table.truncate()
+now = time.time()
+manager = ScheduleManager(comm_manager, shutdown_flag)
+off = manager.add_schedule({"name": "off", "trigger": {"cron": "0 23 * * *"}, "actions": [{"uuid": LED, "parameter": "power", "value": 0}]})
+skip = manager.add_schedule({"name": "skip", "trigger": {"cron": "0 23 * * *"}, "catch_up": False, "actions": [{"uuid": LED, "parameter": "power", "value": 1}]})
+once = manager.add_schedule({"name": "once", "trigger": {"at": now + HOUR}, "actions": [{"uuid": LED, "parameter": "brightness", "value": 10}]})
+interval = manager.add_schedule({"name": "interval", "trigger": {"every": 600}, "actions": [{"uuid": LED, "parameter": "status_interval", "value": 5}]})
+assert manager.add_schedule({"trigger": {"cron": "0 0 30 2 *"}, "actions": [{"uuid": LED, "parameter": "power", "value": 1}]}) is None
+assert manager.add_schedule({"trigger": {"at": now - 1}, "actions": [{"uuid": LED, "parameter": "power", "value": 1}]}) is None
+comm_manager.sets.clear()
+assert manager.run_pending(now + 700) == 1  # The interval
+manager.persist_runs()
+
+restarted = ScheduleManager(comm_manager, shutdown_flag)
+restarted.load(now=now + 2 * 24 * HOUR)
+ran = restarted.run_pending(now + 2 * 24 * HOUR)
+print(f"restart after 2 days: {ran} jobs caught up, sets {[(p, v, r.name) for p, v, r, _ in comm_manager.sets]}")
+assert ran == 3
+assert [p for p, *_ in comm_manager.sets] == ["status_interval", "power", "brightness", "status_interval"]
+assert all(priority is TX_PRIORITY.AUTOMATION for _, _, priority, _ in comm_manager.sets)
+assert restarted.jobs[skip].next_run > now + 2 * 24 * HOUR and restarted.jobs[once].next_run is None
+assert restarted.remove_schedule(once) and not restarted.remove_schedule(once)
+
+# A job added to the running ScheduleManager runs on time
+thread = threading.Thread(target=restarted.run)
+thread.start()
+comm_manager.sets.clear()
+due = time.time() + 0.3
+restarted.add_schedule({"trigger": {"at": due}, "actions": [{"uuid": LED, "parameter": "power", "value": 1}]})
+time.sleep(0.6)
+shutdown_flag.set()
+thread.join()
+print(f"single run {1000 * (comm_manager.sets[0][3] - due):.1f} ms after its time")
+assert len(comm_manager.sets) == 1 and comm_manager.sets[0][3] - due < 0.05
@@ -0,0 +1,304 @@
+import heapq
+import random
+import threading
+import time
+from typing import Callable, Optional
+
+from nrf24USB import PACKET_TYPES, SpecialBytes
+
+
+class SimulatedDevice:
+    """
+    A virtual radio device for the SimulatedDongle.
+    It periodically sends STATUS messages with the given status data and acknowledges the messages sent to it.
+    Like the firmware it answers a SET message with an OK status.
+    A device with a listen_time (battery powered remotes) only receives for listen_time seconds after it sent a message.
+    set_handler can be set to a function that applies the data of a received SET message to status_data.
+    """
+
+    def __init__(
+        self,
+        device_id: int,
+        uuid: list[int],
+        status_data: list[int],
+        firmware_version: int = 1,
+        status_rate: float = 1.0,
+        battery: int = 0,
+        loss: float = 0.0,
+        listen_time: Optional[float] = None,
+    ):
+        self.device_id = device_id
+        self.uuid = uuid
+        self.status_data = status_data
+        self.firmware_version = firmware_version
+        self.status_rate = status_rate
+        self.battery = battery
+        self.loss = loss
+        self.listen_time = listen_time
+        self.last_send_time = 0.0
+        self.msg_num = 0
+        self.received: list[list[int]] = []
+        self.set_handler: Optional[Callable[[list[int]], None]] = None
+
+    def create_message(self, msg_type: int, data: list[int]) -> list[int]:
+        """
+        Returns a raw DeviceMessage including the checksum
+        """
+        self.msg_num = (self.msg_num + 1) % 256
+        self.last_send_time = time.monotonic()
+        status_interval = min(255, max(1, round(1 / self.status_rate))) if self.status_rate > 0 else 255
+        msg = [self.device_id] + self.uuid + [msg_type, self.firmware_version, self.battery, status_interval, self.msg_num]
+        msg += data
+        checksum = sum(msg)
+        return msg + [checksum >> 8 & 0xFF, checksum & 0xFF]
+
+    def create_remote(self, target_uuid: list[int], layer: int, value: int) -> list[int]:
+        """
+        Returns a raw RemoteMessage including the checksum
+        """
+        self.last_send_time = time.monotonic()
+        msg = [self.device_id] + self.uuid + [6] + target_uuid + [layer, value]  # MSG_TYPES.REMOTE
+        checksum = sum(msg)
+        return msg + [checksum >> 8 & 0xFF, checksum & 0xFF]
+
+    def create_status(self) -> list[int]:
+        return self.create_message(5, self.status_data)  # MSG_TYPES.STATUS
+
+    def receive(self, data: list[int]) -> bool:
+        """
+        Called with the payload of a message sent to this device. Returns whether the message was acknowledged.
+        """
+        if self.listen_time is not None and time.monotonic() - self.last_send_time > self.listen_time:
+            return False
+        if random.random() < self.loss:
+            return False
+        self.received.append(data)
+        if self.set_handler is not None and len(data) > 7 and data[5] == 3:  # MSG_TYPES.SET
+            self.set_handler(data[6:-2])
+        return True
+
+
+class SimulatedDongle:
+    """
+    Serial port like object that simulates a NRF24USB device in byte stuffing mode and the devices it talks to.
+    Can be passed to NRF24Device instead of a port name.
+
+    Every message written by the host is answered with OK or ERROR after airtime seconds.
+    All messages are recorded in received together with their destination, validate_msg can be set
+    to a function that checks the payload of every message.
+
+    Devices added with add_unpaired_device pair like the firmware: they send INIT messages with ID 255 and
+    listen for listen_window seconds after each one. An answer to ID 255 reaches every device that listens,
+    devices that check the UUID ignore answers for other devices. Answers taken by more than one device are
+    counted in pairing_collisions.
+    """
+
+    def __init__(
+        self,
+        airtime: float = 0.002,
+        timeout: float = 0.1,
+        firmware_version: int = 3,
+        serial_nr: Optional[list[int]] = None,
+    ):
+        self.airtime = airtime
+        self.timeout = timeout
+        self.firmware_version = firmware_version
+        self.serial_nr = serial_nr if serial_nr is not None else [0x85, 0x83, 0xF7, 0x7E]
+        self.devices: dict[int, SimulatedDevice] = {}
+        self.received: list[tuple[int, bool, list[int]]] = []
+        self.validate_msg: Optional[Callable[[int, list[int]], bool]] = None
+        self.invalid_msgs = 0
+        self.initialized = False
+        self.unpaired: list[SimulatedDevice] = []
+        self.listen_window = 2.0
+        self.pairing_collisions = 0
+
+        self.output = bytearray()
+        self.output_condition = threading.Condition()
+        self.input_buffer = []
+        self.in_escape = False
+        self.message_started = False
+        self.radio_busy_until = 0.0
+
+        self.events = []
+        self.event_num = 0
+        self.events_condition = threading.Condition()
+        self.closed = False
+        self.thread = threading.Thread(target=self.run, name="simulated_dongle", daemon=True)
+        self.thread.start()
+        self.schedule(0, self.send_init)
+
+    def add_device(self, device: SimulatedDevice):
+        self.devices[device.device_id] = device
+        if device.status_rate > 0:
+            self.schedule(random.random() / device.status_rate, lambda: self.stream_status(device))
+
+    def add_unpaired_device(self, device: SimulatedDevice, device_type: str, checks_uuid: bool = True):
+        """
+        Adds a device that pairs with device_type. With checks_uuid it ignores INIT answers for other devices.
+        """
+        device.device_id = 255
+        device.checks_init_uuid = checks_uuid
+        self.unpaired.append(device)
+        self.schedule(random.random() * self.listen_window, lambda: self.send_device_init(device, device_type))
+
+    # Serial port interface
+
+    @property
+    def in_waiting(self) -> int:
+        return len(self.output)
+
+    def read(self, size: int = 1) -> bytes:
+        with self.output_condition:
+            if not self.output:
+                self.output_condition.wait(self.timeout)
+            data = bytes(self.output[:size])
+            del self.output[:size]
+            return data
+
+    def read_all(self) -> bytes:
+        return self.read(len(self.output))
+
+    def reset_input_buffer(self):
+        with self.output_condition:
+            self.output.clear()
+
+    def write(self, data: bytes) -> int:
+        for b in data:
+            if not self.in_escape and b == SpecialBytes.ESCAPE_BYTE:
+                self.in_escape = True
+                continue
+            if not self.in_escape and b == SpecialBytes.MESSAGE_SEPERATOR:
+                if self.message_started and self.input_buffer:
+                    self.handle_packet(self.input_buffer)
+                    self.message_started = False
+                else:
+                    self.message_started = True
+                self.input_buffer = []
+                continue
+            self.input_buffer.append(b)
+            self.in_escape = False
+        return len(data)
+
+    def close(self):
+        self.closed = True
+        with self.events_condition:
+            self.events_condition.notify()
+
+    # Simulation
+
+    def schedule(self, delay: float, callback: Callable):
+        with self.events_condition:
+            self.event_num += 1
+            heapq.heappush(self.events, (time.monotonic() + delay, self.event_num, callback))
+            self.events_condition.notify()
+
+    def run(self):
+        while not self.closed:
+            with self.events_condition:
+                while not self.closed and (not self.events or self.events[0][0] > time.monotonic()):
+                    timeout = self.events[0][0] - time.monotonic() if self.events else None
+                    self.events_condition.wait(timeout)
+                if self.closed:
+                    return
+                _, _, callback = heapq.heappop(self.events)
+            callback()
+
+    def send_packet(self, packet_type: PACKET_TYPES, data: list[int]):
+        packet = bytearray([SpecialBytes.MESSAGE_SEPERATOR, packet_type.value])
+        for b in data:
+            if b in (SpecialBytes.MESSAGE_SEPERATOR, SpecialBytes.ESCAPE_BYTE):
+                packet.append(SpecialBytes.ESCAPE_BYTE)
+            packet.append(b)
+        packet.append(SpecialBytes.MESSAGE_SEPERATOR)
+        with self.output_condition:
+            self.output += packet
+            self.output_condition.notify()
+
+    def send_init(self):
+        if not self.initialized:
+            self.send_packet(PACKET_TYPES.INIT, [self.firmware_version] + self.serial_nr)
+            self.schedule(5.0, self.send_init)
+
+    def confirm_init(self):
+        # Devices are only forwarded after the OK, like on the real dongle
+        self.send_packet(PACKET_TYPES.OK, list(b"NRF INITIALIZED"))
+        self.initialized = True
+
+    def reboot(self, device: SimulatedDevice, status_data: list[int]):
+        """
+        Restarts a device with the given status data, it sends a BOOT message followed by its status
+        """
+        device.status_data = status_data
+        device.msg_num = 0
+        self.send_packet(PACKET_TYPES.MSG, device.create_message(2, []))  # MSG_TYPES.BOOT
+        self.schedule(self.airtime, lambda: self.send_packet(PACKET_TYPES.MSG, device.create_status()))
+
+    def press(self, device: SimulatedDevice, target_uuid: list[int], layer: int, value: int):
+        """
+        Sends a RemoteMessage of a remote, like a button press
+        """
+        self.send_packet(PACKET_TYPES.MSG, device.create_remote(target_uuid, layer, value))
+
+    def stream_status(self, device: SimulatedDevice):
+        if self.closed or device.device_id not in self.devices:
+            return
+        if self.initialized:
+            self.send_packet(PACKET_TYPES.MSG, device.create_status())
+        self.schedule(1 / device.status_rate, lambda: self.stream_status(device))
+
+    def send_device_init(self, device: SimulatedDevice, device_type: str):
+        if self.closed or device not in self.unpaired:
+            return
+        if self.initialized:
+            self.send_packet(PACKET_TYPES.MSG, device.create_message(1, list(device_type.encode())))  # MSG_TYPES.INIT
+        # The firmware sends the next INIT once it gave up waiting for the answer
+        delay = self.listen_window + 0.3 * random.random()
+        self.schedule(delay, lambda: self.send_device_init(device, device_type))
+
+    def receive_init(self, payload: list[int]) -> bool:
+        """
+        Delivers a message to ID 255 to all unpaired devices that listen. Returns whether one acknowledged it.
+        """
+        now = time.monotonic()
+        receivers = [
+            device for device in self.unpaired
+            if now - device.last_send_time <= self.listen_window and random.random() >= device.loss
+            and not (device.checks_init_uuid and len(payload) >= 13 and payload[7:11] != device.uuid)
+        ]
+        if len(receivers) > 1:
+            self.pairing_collisions += 1
+        for device in receivers:
+            device.received.append(payload)
+            if len(payload) > 6 and payload[5] == 1:  # MSG_TYPES.INIT
+                self.unpaired.remove(device)
+                device.device_id = payload[6]
+                self.add_device(device)
+                boot = device.create_message(2, payload[1:5])  # MSG_TYPES.BOOT with the server UUID
+                self.schedule(self.airtime, lambda boot=boot: self.send_packet(PACKET_TYPES.MSG, boot))
+        return bool(receivers)
+
+    def handle_packet(self, packet: list[int]):
+        packet_type, data = packet[0], packet[1:]
+        if packet_type == PACKET_TYPES.INIT.value:
+            self.schedule(0.001, self.confirm_init)
+        elif packet_type == PACKET_TYPES.MSG.value and len(data) >= 3:
+            destination, require_ack, payload = data[0], bool(data[1]), data[2:]
+            self.received.append((destination, require_ack, payload))
+            if self.validate_msg is not None and not self.validate_msg(destination, payload):
+                self.invalid_msgs += 1
+
+            # The radio sends one message after the other
+            now = time.monotonic()
+            self.radio_busy_until = max(now, self.radio_busy_until) + self.airtime
+            device = self.devices.get(destination)
+            if destination == 255:
+                acked = self.receive_init(payload)
+            else:
+                acked = device is not None and device.receive(payload)
+            response = PACKET_TYPES.OK if acked or not require_ack else PACKET_TYPES.ERROR
+            self.schedule(self.radio_busy_until - now, lambda: self.send_packet(response, []))
+            if acked and len(payload) > 5 and payload[5] == 3:  # MSG_TYPES.SET
+                self.radio_busy_until += self.airtime
+                status = device.create_message(7, device.status_data)  # MSG_TYPES.OK
+                self.schedule(self.radio_busy_until - now, lambda: self.send_packet(PACKET_TYPES.MSG, status))
@@ -0,0 +1,106 @@
+import os
+import sys
+import time
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from simulator import SimulatedDongle, SimulatedDevice
+from nrf24Smart import MultiSetMessage, MSG_TYPES
+from src.DBManager import DBManager
+from src.DeviceManager import DeviceManager
+from src.CommunicationManager import CommunicationManager
+
+# Streams brightness values to a simulated LedController3Ch like a dragged slider and compares it to plain SETs.
+# Reports the frames that reached the radio and checks that the final value was committed with an ack.
+# Also counts the passes of update_device, which wait for the stream rate limit instead of spinning, and
+# checks that a power SET during the drag is not held back until the stream pauses.
+
+UUID = [10, 20, 30, 1]
+STATUS = [1, 0, 0, 255, 0, 2, 0, 0, 128, 63]
+UPDATE_RATE = 60  # Slider updates per second
+DURATION = 2.0
+
+os.chdir(tempfile.mkdtemp())
+db_manager = DBManager()
+dongle = SimulatedDongle()
+dongle.add_device(SimulatedDevice(1, UUID, STATUS, firmware_version=2, status_rate=1))
+db_manager.add_device_to_db(
+    {"uuid": UUID, "id": 1, "version": 2, "battery_powered": False, "battery_level": 255,
+     "type": "LedController3Ch", "name": "led", "status_interval": 1, "last_seen": ""}
+)
+device_manager = DeviceManager(db_manager, dongle)
+device_manager.start()
+shutdown_flag = threading.Event()
+comm_manager = CommunicationManager(device_manager, shutdown_flag)
+passes = 0
+update_device = comm_manager.update_device
+
+
+def count_passes(uuid):
+    global passes
+    passes += 1
+    return update_device(uuid)
+
+
+comm_manager.update_device = count_passes
+threads = [
+    threading.Thread(target=comm_manager.listen),
+    threading.Thread(target=comm_manager.send_pending_commands),
+]
+for thread in threads:
+    thread.start()
+time.sleep(0.5)
+
+
+def drag_slider(stream: bool) -> tuple[list[tuple[bool, int, int]], float]:
+    """
+    Returns the SET frames as (require_ack, varIndex, value) and the delay of the power SET sent in the middle
+    """
+    first = len(dongle.received)
+    num_updates = int(UPDATE_RATE * DURATION)
+    power_sent = power_delay = None
+
+    def check_power():
+        nonlocal power_delay
+        if power_sent is not None and power_delay is None and any(
+            payload[5] == MSG_TYPES.SET.value and payload[6] == 0 for _, _, payload in dongle.received[first:]
+        ):
+            power_delay = time.monotonic() - power_sent
+
+    for i in range(num_updates):
+        comm_manager.set_device_param(UUID, "brightness", str(i * 255 // (num_updates - 1)), stream)
+        if i == num_updates // 2:
+            power_sent = time.monotonic()
+            comm_manager.set_device_param(UUID, "power", "0")
+        check_power()
+        time.sleep(1 / UPDATE_RATE)
+    while comm_manager.parameter_buffer.get(str(UUID)):
+        check_power()
+        time.sleep(0.01)
+    check_power()
+    frames = []
+    for _, require_ack, payload in dongle.received[first:]:
+        if payload[5] == MSG_TYPES.SET.value:
+            record = MultiSetMessage.from_raw(payload[6:-2]).set_messages[0]
+            frames.append((require_ack, record.varIndex, record.newValue[0]))
+    return frames, power_delay
+
+
+for stream in (False, True):
+    passes = 0
+    frames, power_delay = drag_slider(stream)
+    acked = [value for require_ack, index, value in frames if require_ack and index == 1]
+    print(
+        f"stream={stream}: {len(frames)} frames ({len(frames) / DURATION:.0f}/s), {len(acked)} acknowledged,"
+        f" {passes} update_device passes, power SET after {1000 * power_delay:.0f} ms"
+    )
+    assert acked and acked[-1] == 255, "final value was not committed"
+    assert power_delay < 0.2, "power SET waited for the stream"
+    assert passes < 20 * UPDATE_RATE * DURATION, "update_device spins while the stream is rate limited"
+
+shutdown_flag.set()
+for thread in threads:
+    thread.join()
+device_manager.stop()
@@ -0,0 +1,78 @@
+import os
+import sys
+import time
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from simulator import SimulatedDongle, SimulatedDevice
+from nrf24Smart import MultiSetMessage, MSG_TYPES
+from src.DBManager import DBManager
+from src.DeviceManager import DeviceManager
+from src.CommunicationManager import CommunicationManager
+from src.TransitionManager import TransitionManager
+
+# Fades the brightness of 30 simulated LedController3Ch at once.
+# Reports the frame rate the transitions achieved and checks that every device ends at the target value
+# and that all SET messages together, including the final values and commits, stay within the frame budget.
+
+NUM_DEVICES = 30
+DURATION = 3.0
+STATUS = [1, 0, 0, 255, 0, 2, 0, 0, 128, 63]
+
+os.chdir(tempfile.mkdtemp())
+db_manager = DBManager()
+dongle = SimulatedDongle()
+uuids = []
+for i in range(1, NUM_DEVICES + 1):
+    uuid = [10, 20, 30, i]
+    uuids.append(uuid)
+    dongle.add_device(SimulatedDevice(i, uuid, STATUS, firmware_version=3, status_rate=1))
+    db_manager.add_device_to_db(
+        {"uuid": uuid, "id": i, "version": 3, "battery_powered": False, "battery_level": 255,
+         "type": "LedController3Ch", "name": f"led{i}", "status_interval": 1, "last_seen": "",
+         "status": {"brightness": 0}}
+    )
+device_manager = DeviceManager(db_manager, dongle)
+device_manager.start()
+shutdown_flag = threading.Event()
+comm_manager = CommunicationManager(device_manager, shutdown_flag)
+transition_manager = TransitionManager(comm_manager, shutdown_flag)
+threads = [
+    threading.Thread(target=comm_manager.listen),
+    threading.Thread(target=comm_manager.send_pending_commands),
+    threading.Thread(target=transition_manager.run),
+]
+for thread in threads:
+    thread.start()
+time.sleep(0.5)
+
+first = len(dongle.received)
+start = time.monotonic()
+for uuid in uuids:
+    assert transition_manager.start_transition(uuid, "brightness", "255", DURATION)
+time.sleep(DURATION / 2)
+stats = transition_manager.get_stats()
+while transition_manager.transitions or any(comm_manager.parameter_buffer.values()):
+    time.sleep(0.01)
+duration = time.monotonic() - start
+
+last_values = {}
+frames = 0
+for destination, require_ack, payload in dongle.received[first:]:
+    if payload[5] == MSG_TYPES.SET.value:
+        frames += 1
+        if require_ack:
+            last_values[destination] = MultiSetMessage.from_raw(payload[6:-2]).set_messages[0].newValue[0]
+
+shutdown_flag.set()
+for thread in threads:
+    thread.join()
+device_manager.stop()
+
+print(f"transitions:     {NUM_DEVICES} x {DURATION}s")
+print(f"frame rate:      {stats['achieved_fps']} achieved / {stats['target_fps']} target per transition")
+print(f"radio frames:    {frames} in {duration:.2f}s ({frames / duration:.0f}/s, budget {stats['frame_budget']:.0f}/s)")
+assert all(last_values.get(i) == 255 for i in range(1, NUM_DEVICES + 1)), "not every device reached the target"
+assert frames / duration <= 1.05 * stats["frame_budget"], "the transitions exceeded the frame budget"